@@ -1,11 +1,38 @@
+import asyncio
 import socket
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor, as_completed,\
+    TimeoutError as FutureTimeoutError
+from functools import wraps
 from hashlib import sha1
-from time import sleep
+from heapq import heappush, heappop
+from time import sleep, monotonic, time, time_ns
+import itertools
 import threading
 import logging
+import weakref
 import random
 import re
-from cloudpickle import dumps, loads
+try:
+    from .rpc import ConnectionPool, RemoteError, FrameReader, send_frame,\
+        FLAG_RESPONSE, FLAG_ERROR, FLAG_ONEWAY, FLAG_BUSY, read_frame,\
+        write_frame, use_event_loop, ProtocolError, PendingCall, RPC_TIMEOUT,\
+        on_event_loop
+    from .codec import decode_request, encode_response, encode_error
+    from . import failure_detector
+    from .failure_detector import FailureDetector
+    from .storage import MemoryStore, QuotaError
+    from .merkle import MerkleTrees
+except ImportError:
+    from rpc import ConnectionPool, RemoteError, FrameReader, send_frame,\
+        FLAG_RESPONSE, FLAG_ERROR, FLAG_ONEWAY, FLAG_BUSY, read_frame,\
+        write_frame, use_event_loop, ProtocolError, PendingCall, RPC_TIMEOUT,\
+        on_event_loop
+    from codec import decode_request, encode_response, encode_error
+    import failure_detector
+    from failure_detector import FailureDetector
+    from storage import MemoryStore, QuotaError
+    from merkle import MerkleTrees
 
 logging.basicConfig(
         format="%(asctime)s %(levelname)s:%(message)s",
@@ -13,12 +40,131 @@ logging.basicConfig(
      )
 
 KEY_SIZE = 160
+MAX_KEY = 2**KEY_SIZE
 MAX_TRIES = 5
 DATA_RECV = 1024
+# Maintenance tasks run every minimum interval while the ring changes and\
+#  back off up to the maximum one while it stays the same
 STABILIZE_INTERVAL = 1
+STABILIZE_MAX_INTERVAL = 8
 FINGERS_INTERVAL = 4
+FINGERS_MAX_INTERVAL = 64
 UPDATE_SUCCESORS_INTERVAL = 1
+UPDATE_SUCCESORS_MAX_INTERVAL = 8
+INTERVAL_BACKOFF = 2
 MAX_SUCCESORS = 7  # log2(160) ~ 7
+# Proximity route selection: how many preceding nodes are considered for the\
+#  next hop, and how much faster than the closest one an alternative must be
+PRS_CANDIDATES = 3
+PRS_RTT_FACTOR = 0.5
+PING_TIMEOUT = 2
+# Finger refresh modes: one random finger per round, or every distinct finger\
+#  interval in one pass
+FINGERS_RANDOM = "random"
+FINGERS_BULK = "bulk"
+# Lookup modes: the origin walks the ring asking every hop for the next one,\
+#  or the query is forwarded hop to hop and the owner answers the origin
+ITERATIVE = "iterative"
+RECURSIVE = "recursive"
+LOOKUP_TIMEOUT = 3
+LOOKUP_CACHE_SIZE = 1024
+# Safety net for ring changes no node told us about
+LOOKUP_CACHE_TTL = 30
+# Engines to serve the RPCs: a thread per connection, or a single asyncio\
+#  event loop. Both hand the requests that block to a pool of workers.
+THREADED = "threaded"
+ASYNC = "async"
+# Threads running the maintenance tasks of the asyncio engine
+ASYNC_WORKERS = 4
+# Threads serving the requests and requests that may wait for one. Past\
+#  that the node answers busy and the caller retries later.
+WORKERS = 64
+WORKERS_QUEUE_SIZE = 256
+# Threads of the asyncio engine serving the local RPCs that block, apart\
+#  from the workers since those may be waiting for them
+LOCAL_WORKERS = 8
+QUEUE_TIME_DECAY = 0.1
+# Connections served by the threaded engine, further ones wait in the\
+#  listen backlog
+MAX_CONNECTIONS = 1024
+LISTEN_BACKLOG = 128
+# Threads used to send the per owner RPCs of a batch concurrently
+BATCH_WORKERS = 8
+# Virtual nodes run by a process, each one takes its own place in the ring
+VIRTUAL_NODES = 1
+# A joining node pulls its keys from its successor in chunks of this many\
+#  keys, pacing itself not to take more than the rate from the successor.
+HANDOFF_CHUNK_KEYS = 512
+HANDOFF_KEYS_PER_SECOND = 20000
+HANDOFF_RETRIES = 5
+# Seconds between the snapshots of our succesors and fingers, saved with\
+#  the store for a restart to find its place in the ring again
+RING_SNAPSHOT_INTERVAL = 10
+# Most queued messages returned by a fetch
+MAX_FETCH_MESSAGES = 256
+# Bytes of queued messages accepted for a key, and for all the keys a node\
+#  holds (replicas included). Messages over them are rejected to the sender.
+QUEUE_QUOTA = 2**20
+MESSAGES_QUOTA = 2**29
+# Seconds queued messages and values live, 0 keeps them until removed.\
+#  Messages of abandoned accounts expire, values are kept by default.
+MESSAGE_TTL = 30 * 24 * 3600
+VALUE_TTL = 0
+# Seconds between the sweeps dropping what expired
+EXPIRY_INTERVAL = 5
+EXPIRE_VALUE = "value"
+EXPIRE_QUEUE = "queue"
+# Replication modes: writes are sent to the succesors as they happen, or\
+#  only reconciled by the anti entropy rounds of the owner
+SYNC_REPLICATION = "sync"
+LAZY_REPLICATION = "lazy"
+# Replicas of every key besides its owner (N), and how many of them must\
+#  acknowledge a write before it returns (W)
+REPLICAS = MAX_SUCCESORS
+WRITE_QUORUM = 1
+# Replicas a read asks, the value with the highest version wins. 0 reads\
+#  from the owner only, a quorum R with R + W > N sees the last write.
+READ_QUORUM = 0
+REPLICATION_WORKERS = 16
+ANTI_ENTROPY_INTERVAL = 5
+ANTI_ENTROPY_MAX_INTERVAL = 40
+# Replicas keep the trees asked about for the walk of an anti entropy round
+MERKLE_CACHE_TTL = 5
+# Seconds a node that left the ring keeps answering, for the replies in\
+#  flight (like the one to the leave RPC) to go out before the process exits
+LEAVE_LINGER = 1
+# RPCs that never talk to other nodes. Both engines serve them right where\
+#  they are read: queued for the workers they could wait behind requests\
+#  that are waiting on us, like forwarded writes for the replica we hold.
+LOCAL_RPCS = frozenset((
+    "ping",
+    "predecessor",
+    "get_succesors",
+    "simple_put",
+    "simple_enqueue",
+    "simple_dequeue",
+    "simple_ack",
+    "remove_key",
+    "remove_keys",
+    "simple_multi_put",
+    "simple_multi_enqueue",
+    "get_fingers",
+    "churn",
+    "simple_get",
+))
+# The local RPCs reading or writing the store. On disk they block, the\
+#  asyncio engine hands them to the local workers then.
+STORE_RPCS = frozenset((
+    "simple_put",
+    "simple_enqueue",
+    "simple_dequeue",
+    "simple_ack",
+    "remove_key",
+    "remove_keys",
+    "simple_multi_put",
+    "simple_multi_enqueue",
+    "simple_get",
+))
 URL_REGEX = re.compile(
     r'chord://(?P<host>([A-Za-z0-9]|\.)+):(?P<port>[1-9][0-9]{3,4})'
     )
@@ -42,10 +188,21 @@ def request(url, action, *args):
         raise Exception("Invalid Request")
 
 
+def node_id(ip, port):
+    return int.from_bytes(
+        sha1(bytes("%s:%d" % (ip, port), 'ascii')).digest(),
+        'big'
+    ) % MAX_KEY
+
+
 def between(c, a, b):
-    a = a % 2**KEY_SIZE
-    b = b % 2**KEY_SIZE
-    c = c % 2**KEY_SIZE
+    # Identifiers are already reduced almost always, avoid the modulos
+    if not 0 <= a < MAX_KEY:
+        a %= MAX_KEY
+    if not 0 <= b < MAX_KEY:
+        b %= MAX_KEY
+    if not 0 <= c < MAX_KEY:
+        c %= MAX_KEY
     if a < b:
         return a <= c < b
     return a <= c or c < b
@@ -55,20 +212,312 @@ class NoResponseException(Exception):
     pass
 
 
-def repeat_after_time(sleepTime):
+class QuorumError(Exception):
+    '''
+    Exception raised when fewer replicas than the quorum answered a read or
+    acknowledged a write. The owner has the write anyway, anti entropy
+    spreads it later.
+    '''
+    pass
+
+
+def expired(deadline, now=None):
+    # Deadlines are unix seconds, 0 never expires
+    return 0 < deadline <= (time() if now is None else now)
+
+
+def deadline(ttl):
+    return int(time()) + ttl if ttl else 0
+
+
+def unversioned(entry):
+    # Values are stored as (version, value, deadline) entries, missing and\
+    #  expired keys are False
+    if entry is None or expired(entry[2]):
+        return False
+    return entry[1]
+
+
+class ExpiryIndex(object):
+    '''
+    Deadlines of the values and queues of a node in a heap, so the sweeper\
+    only looks at the keys due instead of scanning the store. A key is\
+    pushed again only when it gets an earlier deadline: the sweeper checks\
+    the store when it pops, and puts back the next deadline it finds there.
+    '''
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def add(self, kind, key, deadline):
+        if not deadline:
+            return
+        with self.lock:
+            current = self.deadlines.get((kind, key))
+            if current is None or deadline < current:
+                self.deadlines[(kind, key)] = deadline
+                heappush(self.heap, (deadline, kind, key))
+
+    def due(self, now):
+        '''
+        Pop the (kind, key) pairs whose deadline is up to now.
+        '''
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, kind, key = heappop(self.heap)
+                # Skip the deadlines replaced by an earlier one
+                if self.deadlines.get((kind, key)) == deadline:
+                    del self.deadlines[(kind, key)]
+                    due.append((kind, key))
+        return due
+
+
+class Handoff(object):
+    '''
+    Transfer of the keys (start, end] of a joining node from its successor.\
+    Keys up to cursor are already here. Keys a client needs before their\
+    chunk arrives are claimed, fetched on their own.
+    '''
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.cursor = start
+        self.claimed = set()
+        self.lock = threading.Lock()
+
+    def pending(self, key):
+        return self.cursor != self.end and\
+            between(key, self.cursor + 1, self.end + 1)
+
+
+class AdaptiveInterval(object):
+    '''
+    Time between the runs of a maintenance task. It grows geometrically\
+    after every run and snaps back to the minimum when reset, which also\
+    wakes the waiting task (never running it twice within the minimum).
+    '''
+    def __init__(self, minimum, maximum, factor=INTERVAL_BACKOFF):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.current = minimum
+        self.changed = False
+        self.wakeup = threading.Event()
+        self.loop = None
+        self.async_wakeup = None
+
+    def backoff(self):
+        if self.changed:
+            self.changed = False
+            self.current = self.minimum
+        else:
+            self.current = min(self.current * self.factor, self.maximum)
+
+    def reset(self):
+        self.changed = True
+        self.current = self.minimum
+        self.wakeup.set()
+        if self.async_wakeup is not None:
+            self.loop.call_soon_threadsafe(self.async_wakeup.set)
+
+    def wait(self):
+        start = monotonic()
+        self.wakeup.wait(self.current)
+        self.wakeup.clear()
+        remaining = self.minimum - (monotonic() - start)
+        if remaining > 0:
+            sleep(remaining)
+
+    async def wait_async(self):
+        if self.async_wakeup is None:
+            self.loop = asyncio.get_running_loop()
+            self.async_wakeup = asyncio.Event()
+        start = monotonic()
+        try:
+            await asyncio.wait_for(self.async_wakeup.wait(), self.current)
+        except asyncio.TimeoutError:
+            pass
+        self.async_wakeup.clear()
+        remaining = self.minimum - (monotonic() - start)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+
+
+class BoundedExecutor(object):
+    '''
+    Pool of worker threads with a bounded queue. Submitting to a full pool\
+    fails right away, so an overloaded node sheds requests instead of\
+    piling up threads.
+    '''
+    def __init__(self, workers, queue_size, name="worker"):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+
+    def submit(self, fn, *args):
+        '''
+        Future of fn(*args), or None when the pool is full.
+        '''
+        with self.lock:
+            if self.pending >= self.workers + self.queue_size:
+                self.rejected += 1
+                return None
+            self.pending += 1
+        return self.executor.submit(self._run, monotonic(), fn, args)
+
+    def _run(self, queued_at, fn, args):
+        waited = monotonic() - queued_at
+        with self.lock:
+            self.queue_time += QUEUE_TIME_DECAY * (waited - self.queue_time)
+            self.max_queue_time = max(self.max_queue_time, waited)
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "pending": self.pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "queue_time": self.queue_time,
+                "max_queue_time": self.max_queue_time,
+            }
+
+
+class LookupCache(object):
+    '''
+    Node local cache of the key ranges (predecessor, owner] found by the
+    lookups, so repeated requests for the same keys skip the routing.
+    Entries are dropped when the ring is seen changing around them.
+    '''
+    def __init__(self, size=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        # Sorted owner identifiers, and owner id -> (pred id, owner, expiry)
+        self.ends = []
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if self.ends:
+                end = self.ends[bisect_left(self.ends, key) % len(self.ends)]
+                start, owner, expiry = self.entries[end]
+                if between(key, start + 1, end + 1) and\
+                        monotonic() < expiry:
+                    self.hits += 1
+                    return owner
+            self.misses += 1
+            return None
+
+    def put(self, pred, owner):
+        start, end = pred.id(), owner.id()
+        with self.lock:
+            # Whatever overlaps the new range is stale
+            for other in [
+                other for other, (other_start, _, _) in self.entries.items()
+                if other != end and (
+                    between(other, start + 1, end) or
+                    between(other_start, start + 1, end)
+                )
+            ]:
+                self._remove(other)
+            if end not in self.entries:
+                if len(self.entries) >= self.size:
+                    self._remove(min(
+                        self.entries,
+                        key=lambda e: self.entries[e][2]
+                    ))
+                insort(self.ends, end)
+            self.entries[end] = (start, owner, monotonic() + self.ttl)
+
+    def _remove(self, end):
+        self.entries.pop(end)
+        self.ends.pop(bisect_left(self.ends, end))
+
+    def invalidate_node(self, node):
+        '''
+        node left the ring: forget the ranges it owned or bounded.
+        '''
+        node_id = node.id()
+        with self.lock:
+            for end in [
+                end for end, (start, _, _) in self.entries.items()
+                if node_id in (start, end)
+            ]:
+                self._remove(end)
+
+    def invalidate_point(self, node_id):
+        '''
+        A node joined at node_id: the range containing it was split.
+        '''
+        with self.lock:
+            for end in [
+                end for end, (start, _, _) in self.entries.items()
+                if between(node_id, start + 1, end)
+            ]:
+                self._remove(end)
+
+    def clear(self):
+        with self.lock:
+            self.ends = []
+            self.entries = {}
+
+
+def repeat_after_time(sleepTime, maxTime=None):
+    '''
+    Run the task until it returns False, waiting between runs on the\
+    adaptive interval of the node named after it, which starts at sleepTime\
+    and backs off up to maxTime.
+    '''
     def func_wrapper(func):
+        @wraps(func)
         def inner(self, *args, **kwargs):
+            interval = self.intervals[func.__name__]
             while 1:
-                sleep(sleepTime)
-                ret = func(self, *args, **kwargs)
-                if not ret:
+                interval.wait()
+                if self.left.is_set():
                     return
+                if self.leaving.is_set():
+                    # Paused while leaving, resumed if that fails
+                    continue
+                try:
+                    if not func(self, *args, **kwargs):
+                        return
+                except Exception:
+                    # A busy or failing peer must not end the task, retry\
+                    #  at the fastest pace
+                    logging.exception(f"Error in {func.__name__}")
+                    interval.reset()
+                interval.backoff()
+        inner.interval = (sleepTime, maxTime or sleepTime)
         return inner
     return func_wrapper
 
 
 def repeat_when_socket_fail(retries):
     def func_wrapper(func):
+        @wraps(func)
         def inner(self, *args, **kwargs):
             retry_count = 0
             while retry_count < retries:
@@ -84,26 +533,33 @@ def repeat_when_socket_fail(retries):
     return func_wrapper
 
 
-def safe_connection_required(func):
-    def inner(self, *args, **kwargs):
-        # Make a Thread safe socket connection
-        self.lock.acquire()
-        self.open_connection()
-        ret = func(self, *args, **kwargs)
-        self.close_connection()
-        self.lock.release()
-        return ret
-    return inner
-
-
 class RemoteNodeReference(object):
     '''
-    Reference to a remote node to wrapp RPC and ease the implementation
+    Reference to a remote node to wrapp RPC and ease the implementation.
+
+    References are interned: building a reference to an address that is
+    already referenced somewhere returns the same object, so routing state
+    shares them instead of allocating (and hashing) new ones.
     '''
-    def __init__(self, node_ip, node_port):
-        self.ip = node_ip
-        self.port = node_port
-        self.lock = threading.BoundedSemaphore()
+    __slots__ = ('ip', 'port', 'pool', '_id', '__weakref__')
+    _references = weakref.WeakValueDictionary()
+    _references_lock = threading.Lock()
+
+    def __new__(cls, node_ip, node_port):
+        address = (node_ip, node_port)
+        reference = cls._references.get(address)
+        if reference is not None:
+            return reference
+        with cls._references_lock:
+            reference = cls._references.get(address)
+            if reference is None:
+                reference = super().__new__(cls)
+                reference.ip = node_ip
+                reference.port = node_port
+                reference.pool = ConnectionPool.for_address(address)
+                reference._id = node_id(node_ip, node_port)
+                cls._references[address] = reference
+        return reference
 
     def __str__(self):
         return f"<{self.ip}:{self.port}>"
@@ -112,142 +568,337 @@ class RemoteNodeReference(object):
         return str(self)
 
     def id(self, offset=0):
-        digest = int(
-            sha1(
-                bytes("%s:%d" % (self.ip, self.port), 'ascii')
-                ).hexdigest(),
-            16)
-        return (digest + offset) % 2**(KEY_SIZE)
-
-    def open_connection(self):
-        self.socket_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket_.connect((self.ip, self.port))
-
-    def close_connection(self):
-        self.socket_.close()
-        self.socket_ = None
-
-    def send(self, data):
-        self.socket_.sendall(dumps(data) + b"!!")
-        self.trace = data
-
-    def recv(self):
-        data = b''
-        while 1:
-            rec = self.socket_.recv(64)
-            if rec[-2:] == b"!!":
-                data += rec[:-2]
-                break
-            data += rec
-        return data
+        if not offset:
+            return self._id
+        return (self._id + offset) % MAX_KEY
 
-    def ping(self):
+    def _call(self, *request):
         try:
-            sock = socket.socket()
-            sock.connect((self.ip, self.port))
-            sock.sendall(b"pinging!!")
-            sock.close()
-            return True
+            return self.pool.call(request)
         except socket.error:
-            return False
+            detector = failure_detector.installed()
+            if detector is not None:
+                detector.observe((self.ip, self.port), False)
+            raise
+
+    def _send(self, *request):
+        try:
+            self.pool.send(request)
+        except socket.error:
+            detector = failure_detector.installed()
+            if detector is not None:
+                detector.observe((self.ip, self.port), False)
+            raise
+
+    def rtt(self):
+        '''
+        Estimated round trip time to the node in seconds, None if unknown.
+        '''
+        return self.pool.rtt
+
+    def ping(self):
+        # Ask the failure detector of the node first, only peers it knows\
+        #  nothing about yet need a round trip
+        detector = failure_detector.installed()
+        if detector is not None:
+            alive = detector.is_alive((self.ip, self.port))
+            if alive is not None:
+                return alive
+        try:
+            alive = self.pool.call(("ping",), PING_TIMEOUT)
+        except (socket.error, RemoteError):
+            alive = False
+        if detector is not None:
+            detector.observe((self.ip, self.port), alive)
+        return alive
 
-    @safe_connection_required
     def get_succesors(self):
-        self.send(["get_succesors"])
-        response = self.recv()
-        if response == b"":
+        response = self._call("get_succesors")
+        if not response:
             return []
-        response = loads(response)
-        return map(lambda x: RemoteNodeReference(x[0], x[1]), response)
+        return [RemoteNodeReference(x[0], x[1]) for x in response]
 
-    @safe_connection_required
     def succesor(self):
-        self.send(["succesor"])
-        response = self.recv()
-        response = loads(response)
+        response = self._call("succesor")
         return RemoteNodeReference(response[0], response[1])
 
-    @safe_connection_required
     def predecessor(self):
-        self.send(["predecessor"])
-        response = loads(self.recv())
+        response = self._call("predecessor")
+        if response is None:
+            return None
         return RemoteNodeReference(response[0], response[1])
 
-    @safe_connection_required
+    def get_fingers(self):
+        response = self._call("get_fingers")
+        return [RemoteNodeReference(x[0], x[1]) for x in response]
+
+    def get_replicas(self):
+        response = self._call("get_replicas")
+        return [RemoteNodeReference(x[0], x[1]) for x in response]
+
     def closest_preceding_node(self, key):
-        self.send(["closest_preceding_node", key])
-        response = loads(self.recv())
+        response = self._call("closest_preceding_node", key)
         return RemoteNodeReference(response[0], response[1])
 
-    @safe_connection_required
     def find_succesor(self, key):
-        self.send(["find_successor", key])
-        response = loads(self.recv())
+        response = self._call("find_successor", key)
         return RemoteNodeReference(response[0], response[1])
 
-    @safe_connection_required
+    def find_successor_step(self, key):
+        done, response = self._call("find_successor_step", key)
+        return done, RemoteNodeReference(response[0], response[1])
+
+    def forward_lookup(self, key, origin, lookup_id):
+        self._send("forward_lookup", key, origin, lookup_id)
+
+    def lookup_reply(self, lookup_id, pred, owner):
+        self._send("lookup_reply", lookup_id, pred, owner)
+
     def notify(self, node):
-        remote_node_reference = RemoteNodeReference(node.ip, node.port)
-        remote_node_reference.lock = None
-        self.send(['notify', remote_node_reference])
+        self._call("notify", (node.ip, node.port))
+
+    def leave(self):
+        return self._call("leave")
+
+    def node_left(self, node, pred, succ):
+        self._call(
+            "node_left",
+            (node.ip, node.port),
+            (pred.ip, pred.port) if pred is not None else None,
+            (succ.ip, succ.port)
+        )
+
+    def churn(self):
+        self._send("churn")
 
-    @safe_connection_required
     def simple_put(self, key, val):
-        self.send(["simple_put", key, val])
+        self._call("simple_put", key, val)
+
+    def simple_get(self, key):
+        return self._call("simple_get", key)
 
-    @safe_connection_required
     def put(self, key, val):
-        self.send(["put", key, val])
+        self._call("put", key, val)
 
-    @safe_connection_required
     def get(self, key):
-        self.send(["get", key])
-        response = loads(self.recv())
-        return response
+        return self._call("get", key)
 
-    @safe_connection_required
-    def enqueue_message(self, key, msg):
-        self.send(["enqueue_message", key, msg])
+    def enqueue_message(self, key, msg, ttl=None):
+        if ttl is None:
+            self._call("enqueue_message", key, msg)
+        else:
+            self._call("enqueue_expiring", key, msg, ttl)
 
-    @safe_connection_required
     def simple_enqueue(self, key, msg):
-        self.send(["simple_enqueue", key, msg])
+        self._call("simple_enqueue", key, msg)
 
-    @safe_connection_required
     def simple_dequeue(self, key):
-        self.send(["simple_dequeue", key])
+        self._call("simple_dequeue", key)
 
-    @safe_connection_required
     def dequeue_messages(self, key):
-        self.send(["dequeue_messages", key])
-        msg_list = loads(self.recv())
-        return msg_list
+        return self._call("dequeue_messages", key)
+
+    def fetch(self, key, after, limit):
+        return self._call("fetch", key, after, limit)
+
+    def ack(self, key, upto):
+        self._call("ack", key, upto)
+
+    def simple_ack(self, key, upto):
+        self._call("simple_ack", key, upto)
 
-    @safe_connection_required
     def get_keys(self, key):
-        self.send(["get_keys", key])
-        key_val, key_msg = loads(self.recv())
+        key_val, key_msg = self._call("get_keys", key)
         return key_val, key_msg
 
-    @safe_connection_required
+    def get_range(self, start, end, limit):
+        cursor, done, key_val, key_msg = self._call(
+            "get_range", start, end, limit
+        )
+        return cursor, done, key_val, key_msg
+
+    def release_range(self, start, end):
+        self._call("release_range", start, end)
+
+    def merkle_nodes(self, start, end, level, indices):
+        return self._call("merkle_nodes", start, end, level, indices)
+
+    def sync_range(self, start, end, key_val, key_msg):
+        return self._call("sync_range", start, end, key_val, key_msg)
+
     def remove_key(self, key):
-        self.send(["remove_key", key])
+        self._call("remove_key", key)
+
+    def remove_keys(self, keys):
+        self._call("remove_keys", keys)
+
+    def multi_get(self, keys):
+        return self._call("multi_get", keys)
+
+    def multi_put(self, items):
+        self._call("multi_put", items)
+
+    def simple_multi_put(self, items):
+        self._call("simple_multi_put", items)
+
+    def multi_enqueue(self, items):
+        self._call("multi_enqueue", items)
+
+    def simple_multi_enqueue(self, items):
+        self._call("simple_multi_enqueue", items)
+
+
+def start_virtual_nodes(ip, port, count=VIRTUAL_NODES, dest_host=None,
+                        mode=THREADED, stores=None, **kwargs):
+    '''
+    Start count virtual nodes in this process, on consecutive ports from\
+    port. Each one is a full node with its own identifier and store, so the\
+    keys move and replicate per virtual node, but all of them share the\
+    threads serving requests: a machine gets a share of the ring\
+    proportional to its count instead of to the luck of one hash.
+    @param stores: one store per virtual node, in memory if not given
+    @kwargs      : options of every Node
+    Returns the nodes.
+    '''
+    nodes = []
+    for i in range(count):
+        node = Node(
+            ip,
+            port + i,
+            dest_host,
+            store=stores[i] if stores else None,
+            primary=nodes[0] if nodes else None,
+            **kwargs
+        )
+        node.start_service(mode)
+        node.serving.wait()
+        nodes.append(node)
+        # The rest join the ring through the first one
+        dest_host = dest_host or (ip, port)
+    return nodes
 
 
 # TODO: Agregar logica para almacenar las llaves, y negociarlas con la entrada\
     #  de nuevos nodos
 class Node:
-    def __init__(self, node_ip, node_port, dest_host=None):
+    def __init__(self, node_ip, node_port, dest_host=None,
+                 lookup_mode=ITERATIVE, fingers_mode=FINGERS_BULK,
+                 workers=WORKERS, queue_size=WORKERS_QUEUE_SIZE,
+                 backlog=LISTEN_BACKLOG, store=None,
+                 replication=SYNC_REPLICATION, replicas=REPLICAS,
+                 write_quorum=WRITE_QUORUM, read_quorum=READ_QUORUM,
+                 queue_quota=QUEUE_QUOTA, messages_quota=MESSAGES_QUOTA,
+                 message_ttl=MESSAGE_TTL, value_ttl=VALUE_TTL, primary=None):
         self.ip = node_ip
         self.port = node_port
+        self._id = node_id(node_ip, node_port)
         self.succesors = []
         self._predecessor = None
         self.fingers = [None] * KEY_SIZE
         self.callbacks = {}
-        self.storage = {}
-        self.messages = {}
+        self.lookup_mode = lookup_mode
+        self.fingers_mode = fingers_mode
+        self.lookups = {}
+        self.lookup_ids = itertools.count()
+        self.lookup_cache = LookupCache()
+        # Values and message queues of the keys we hold, see storage
+        self.store = store if store is not None else MemoryStore()
+        self.queue_quota = queue_quota
+        self.messages_quota = messages_quota
+        self.message_ttl = message_ttl
+        self.value_ttl = value_ttl
+        # Deadlines of what we hold, including what a previous run stored
+        self.expiry = ExpiryIndex()
+        # Versions and sequence numbers we hand out keep growing after the\
+        #  ones of the entries we hold, reentrant for the writes that store\
+        #  under it
+        self.last_version = 0
+        self.versions_lock = threading.RLock()
+        for key, entry in self.store.items():
+            self.expiry.add(EXPIRE_VALUE, key, entry[2])
+            self.see_version(entry[0])
+        for key, msgs in self.store.queues():
+            for entry in msgs:
+                self.expiry.add(EXPIRE_QUEUE, key, entry[1][1])
+                self.see_version(entry[0])
+        self.handoff = None
+        self.replication = replication
+        self.replication_factor = min(replicas, MAX_SUCCESORS)
+        self.write_quorum = write_quorum
+        self.read_quorum = read_quorum
+        # Owner id -> (owner and its replicas, expiry) for replica reads
+        self.replica_sets = {}
+        # Trees of the ranges we compare with other nodes, kept up to date\
+        #  as we write, and the copies replicas keep for the walk of a round
+        self.digests = MerkleTrees(self.store)
+        self.merkle_trees = {}
+        self.executor = None
+        self.maintenance = (
+            Node.stabilize,
+            Node.fix_fingers,
+            Node.update_succesors,
+            Node.anti_entropy,
+            Node.expire,
+            Node.snapshot_ring,
+        )
+        self.intervals = {
+            task.__name__: AdaptiveInterval(*task.interval)
+            for task in self.maintenance
+        }
+        self.primary = primary
+        if primary is not None:
+            # The detector of the first node watches the peers of all the\
+            #  nodes of the process, and tells all of them about failures
+            self.detector = primary.detector
+            self.local_nodes = primary.local_nodes
+            self.local_nodes.append(self)
+        else:
+            self.local_nodes = [self]
+            self.detector = FailureDetector(
+                (node_ip, node_port),
+                on_rtt=lambda address, rtt:
+                    ConnectionPool.for_address(address).record_rtt(rtt),
+                on_failure=lambda address: [
+                    node.churn() for node in self.local_nodes
+                ]
+            )
+        self.backlog = backlog
+        self.serving = threading.Event()
+        # Set when leave starts, pausing the maintenance tasks, and when the\
+        #  node is out of the ring. While leaving the succesor taking our\
+        #  keys is the heir, it gets every write we take.
+        self.leaving = threading.Event()
+        self.left = threading.Event()
+        self.heir = None
+        if primary is not None:
+            # A virtual node shares the threads and the connection slots of\
+            #  the first node of its process
+            self.workers = primary.workers
+            self.local_workers = primary.local_workers
+            self.connection_slots = primary.connection_slots
+            self.batch_executor = primary.batch_executor
+            self.replication_executor = primary.replication_executor
+        else:
+            self.workers = BoundedExecutor(workers, queue_size, "rpc")
+            self.local_workers = BoundedExecutor(
+                LOCAL_WORKERS,
+                queue_size,
+                "local"
+            )
+            self.connection_slots = threading.BoundedSemaphore(
+                MAX_CONNECTIONS
+            )
+            self.batch_executor = ThreadPoolExecutor(
+                BATCH_WORKERS,
+                thread_name_prefix="batch"
+            )
+            self.replication_executor = ThreadPoolExecutor(
+                REPLICATION_WORKERS,
+                thread_name_prefix="replication"
+            )
 
-        self.join(dest_host)
+        # A restarted node joins through its old succesors if not told how
+        self.join(self.restore_ring() or dest_host)
 
     def __str__(self):
         return f"<{self.ip}:{self.port}>"
@@ -264,62 +915,330 @@ class Node:
             succ = self.fingers[0] = remote_node_reference.find_succesor(
                 self.id()
             )
-            # Negotiate with succesor the keys
-            # keys <= self.identifier
-            key_val, key_msg = succ.get_keys(self.id())
-            for k, v in key_val:
-                self.simple_put(k, v)
-            for k, msg in key_msg:
-                self.simple_enqueue(k, msg)
+            # Negotiate with succesor the keys between its predecessor and\
+            #  us. They are streamed in the background, we can serve them\
+            #  meanwhile.
+            pred = succ.predecessor()
+            start = pred.id() if pred is not None else succ.id()
+            self.handoff = Handoff(succ, start, self.id())
+            threading.Thread(target=self.receive_handoff, daemon=True).start()
 
         else:
             self.fingers[0] = self
 
+    def restore_ring(self):
+        '''
+        Take back the succesors and fingers saved by a previous run, so\
+        lookups don't wait for the finger table to be rebuilt. Our\
+        identifier only depends on our address, a restart keeps it.\
+        Returns the address of a live succesor to join through, if any.
+        '''
+        meta = self.store.load_meta()
+        if not meta:
+            return None
+        succesors, fingers = meta
+
+        def reference(address):
+            if address is None or tuple(address) == (self.ip, self.port):
+                return None
+            return RemoteNodeReference(address[0], address[1])
+
+        self.succesors = [
+            node for node in map(reference, succesors) if node is not None
+        ]
+        self.fingers[1:] = [reference(address) for address in fingers[1:]]
+        for node in self.succesors:
+            if node.ping():
+                return node.ip, node.port
+        return None
+
+    @repeat_after_time(RING_SNAPSHOT_INTERVAL)
+    def snapshot_ring(self):
+        '''
+        Save our succesors and fingers with the store when they changed.
+        '''
+        meta = (
+            [(node.ip, node.port) for node in self.succesors],
+            [
+                (node.ip, node.port) if isinstance(node, RemoteNodeReference)
+                else None
+                for node in self.fingers
+            ]
+        )
+        if meta != self.store.load_meta():
+            self.store.save_meta(meta)
+        return True
+
+    def receive_handoff(self):
+        handoff = self.handoff
+        ranges = [(handoff.start, handoff.end)]
+        if self.store.range(handoff.start, handoff.end, 1):
+            # We were here before the restart, only fetch the parts of the\
+            #  range that changed meanwhile
+            tree = self.digests.tree(handoff.start, handoff.end)
+            try:
+                ranges = self.differing_ranges(handoff.source, tree)
+            except (socket.error, RemoteError) as e:
+                logging.debug(f"Handoff falls back to the whole range: {e}")
+        for start, end in ranges:
+            with handoff.lock:
+                handoff.cursor = start
+            if not self.stream_range(handoff, end):
+                # Leaving the ring, the keys still pending stay at the source
+                return
+        self.handoff = None
+        try:
+            handoff.source.release_range(handoff.start, handoff.end)
+        except (socket.error, RemoteError):
+            pass
+
+    def stream_range(self, handoff, end):
+        '''
+        Pull the keys from the cursor of the handoff up to end in chunks.\
+        Failures are retried from the cursor for as long as it takes, the\
+        handoff is only over when we have every key. Returns False if we\
+        leave the ring before.
+        '''
+        failures = 0
+        done = False
+        while not done:
+            if self.left.is_set():
+                return False
+            started = monotonic()
+            try:
+                cursor, done, key_val, key_msg = handoff.source.get_range(
+                    handoff.cursor,
+                    end,
+                    HANDOFF_CHUNK_KEYS
+                )
+            except (socket.error, RemoteError) as e:
+                # Resume from the last chunk received. When the source keeps\
+                #  failing, resume from our succesor if it changed: it\
+                #  replicated the range of the source.
+                failures += 1
+                if failures > HANDOFF_RETRIES:
+                    logging.error(f"Handoff from {handoff.source} failed: {e}")
+                    succ = self.succesor()
+                    if succ is not self and succ.id() != handoff.source.id():
+                        handoff.source = succ
+                        failures = 0
+                sleep(0.1 * 2**min(failures, HANDOFF_RETRIES))
+                continue
+            failures = 0
+            with handoff.lock:
+                self.apply_handoff(
+                    handoff,
+                    handoff.cursor,
+                    end if done else cursor,
+                    key_val,
+                    key_msg
+                )
+                handoff.cursor = end if done else cursor
+            elapsed = monotonic() - started
+            pause = (len(key_val) + len(key_msg)) / HANDOFF_KEYS_PER_SECOND
+            if pause > elapsed:
+                sleep(pause - elapsed)
+        return True
+
+    def apply_handoff(self, handoff, start, end, key_val, key_msg):
+        # The chunk replaces whatever we had in (start, end], like data of a\
+        #  previous run of the node, but keys claimed since we own them are\
+        #  newer than the chunk
+        claimed = handoff.claimed
+        self.store.remove_many([
+            key for key in self.store.range(start, end) if key not in claimed
+        ])
+        for key, val in key_val:
+            if key not in claimed:
+                self.store_value(key, val)
+        for key, msgs in key_msg:
+            if key not in claimed:
+                for msg in msgs:
+                    self.store_message(key, msg)
+
+    def claim(self, key):
+        '''
+        Make sure key is here if it is still to come in the handoff.
+        '''
+        handoff = self.handoff
+        if handoff is None or not handoff.pending(key):
+            return
+        with handoff.lock:
+            if key in handoff.claimed or not handoff.pending(key):
+                return
+            start = (key - 1) % MAX_KEY
+            _, _, key_val, key_msg = handoff.source.get_range(start, key, 1)
+            self.apply_handoff(handoff, start, key, key_val, key_msg)
+            handoff.claimed.add(key)
+
+    def get_range(self, start, end, limit):
+        '''
+        A chunk of the keys in (start, end]: the last key in it, whether it\
+        is the last chunk, and the values and queues of its keys.
+        '''
+        keys = self.store.range(start, end, limit)
+        cursor = keys[-1] if keys else end
+        return cursor, len(keys) < limit,\
+            self.store.items(keys), self.store.queues(keys)
+
+    def release_range(self, start, end):
+        # The range of a node that joined right before us is now kept by\
+        #  it, by us and by our first replication_factor - 1 replicas: our\
+        #  last replica doesn't hold it anymore, unless the ring is so small\
+        #  that there are not that many replicas (or it is the node itself)
+        replicas = self.replicas()
+        if len(replicas) < self.replication_factor or\
+                replicas[-1].id() in (end, self.id()):
+            return True
+        node = replicas[-1]
+        keys = self.store.range(start, end)
+        if keys and node.ping():
+            node.remove_keys(keys)
+        return True
+
     def get_keys(self, key):
-        # Get our storaged keys that are now responsability of key
-        key_val = []
-        key_msg = []
-        keys = []
-        for storkey in self.storage.keys():
-            if storkey <= key:
-                key_val.append((storkey, self.storage[storkey]))
-                keys.append(storkey)
-        for storkey in self.messages.keys():
-            if storkey <= key:
-                key_msg.append((storkey, self.messages[storkey]))
-                keys.append(storkey)
-        node = self.succesors[-1:]
-        if node and node[0].ping():
-            for k in keys:
-                node[0].remove_key(k)
+        # Get our storaged keys that are now responsability of key: the ones\
+        #  between our predecessor and key, a node joining right before us
+        pred = self.predecessor()
+        start = pred.id() if pred is not None else self.id()
+        keys = self.store.range(start, key)
+        key_val = self.store.items(keys)
+        key_msg = self.store.queues(keys)
+        self.release_range(start, key)
         return key_val, key_msg
 
     def remove_key(self, key):
-        self.storage.pop(key, None)
-        self.messages.pop(key, None)
+        self.store.remove(key)
+        return True
+
+    def remove_keys(self, keys):
+        self.store.remove_many(keys)
         return True
 
     def id(self, offset=0):
-        digest = int(
-            sha1(
-                bytes("%s:%d" % (self.ip, self.port), 'ascii')
-                ).hexdigest(),
-            16)
-        return (digest + offset) % 2**(KEY_SIZE)
+        if not offset:
+            return self._id
+        return (self._id + offset) % MAX_KEY
 
     def ping(self):
         return True
 
+    def rtt(self):
+        return 0
+
+    def leave(self, force=False):
+        '''
+        Leave the ring: bring the replica of our keys at our succesor up to\
+        date in bulk, then tell our predecessor and succesor to point to\
+        each other right away instead of waiting for them to detect that\
+        we are gone. The process can exit once left is set.
+        If the handoff fails we stay in the ring and return False, unless\
+        forced to leave anyway: the replicas keep our keys.
+        '''
+        if self.leaving.is_set():
+            return True
+        self.leaving.set()
+        pred, succ = self.predecessor(), self.succesor()
+        if succ is not self:
+            start = pred.id() if pred is not None else succ.id()
+            logging.info(f"{self} leaving, handing its keys to {succ}")
+            self.heir = succ
+            try:
+                self.hand_over(succ, start)
+            except (socket.error, RemoteError) as e:
+                logging.error(f"{self} could not hand its keys over: {e}")
+                if not force:
+                    self.heir = None
+                    self.leaving.clear()
+                    return False
+            for node in (pred, succ):
+                if node is None or node is self:
+                    continue
+                try:
+                    node.node_left(self, pred, succ)
+                except (socket.error, RemoteError) as e:
+                    logging.debug(f"Could not tell {node} we left: {e}")
+        self.left.set()
+        return True
+
+    def hand_over(self, succ, start):
+        '''
+        Send succ the keys of (start, id] where its replica differs from\
+        ours, in chunks.
+        '''
+        tree = self.digests.tree(start, self.id())
+        try:
+            ranges = self.differing_ranges(succ, tree)
+        except (socket.error, RemoteError):
+            ranges = [(start, self.id())]
+        for range_start, range_end in ranges:
+            cursor, done = range_start, False
+            while not done:
+                chunk_start = cursor
+                cursor, done, key_val, key_msg = self.get_range(
+                    cursor,
+                    range_end,
+                    HANDOFF_CHUNK_KEYS
+                )
+                succ.sync_range(
+                    chunk_start,
+                    range_end if done else cursor,
+                    key_val,
+                    key_msg
+                )
+
+    def node_left(self, node, pred, succ):
+        '''
+        The node at address node left the ring between pred and succ (also\
+        addresses), take it out of our tables.
+        '''
+        def reference(address):
+            if address is None:
+                return None
+            if tuple(address) == (self.ip, self.port):
+                return self
+            return RemoteNodeReference(address[0], address[1])
+
+        node, pred, succ = reference(node), reference(pred), reference(succ)
+        if node is self:
+            return True
+        self.lookup_cache.invalidate_node(node)
+        self.replica_sets.clear()
+        if self._predecessor is not None and\
+                self._predecessor.id() == node.id():
+            self._predecessor = pred
+        self.succesors = [n for n in self.succesors if n.id() != node.id()]
+        # Keys that went to node go to its succesor now, fingers too
+        self.fingers = [
+            succ if n is not None and n.id() == node.id() else n
+            for n in self.fingers
+        ]
+        self.churn()
+        return True
+
+    def churn(self):
+        '''
+        The ring around us changed or a peer failed, run the maintenance
+        tasks at their fastest pace again.
+        '''
+        for interval in self.intervals.values():
+            interval.reset()
+
     def succesor(self) -> RemoteNodeReference:
         for remote in [self.fingers[0]] + self.succesors:
             if remote.ping():
+                if remote is not self.fingers[0]:
+                    self.lookup_cache.invalidate_node(self.fingers[0])
+                    self.churn()
                 self.fingers[0] = remote
                 return remote
         logging.info("No Succesor Found, reseting to ourselves")
+        self.lookup_cache.clear()
+        self.churn()
         self.fingers[0] = self
         return self
 
-    @repeat_after_time(STABILIZE_INTERVAL)
+    @repeat_after_time(STABILIZE_INTERVAL, STABILIZE_MAX_INTERVAL)
     @repeat_when_socket_fail(MAX_TRIES)
     def stabilize(self):
         succesor = self.succesor()
@@ -329,6 +1248,8 @@ class Node:
         pred = succesor.predecessor()
         if pred is not None and between(pred.id(), self.id(1), succesor.id())\
                 and self.id(1) != succesor.id() and pred.ping():
+            self.lookup_cache.invalidate_point(pred.id())
+            self.churn()
             self.fingers[0] = pred
 
         self.succesor().notify(self)
@@ -344,44 +1265,282 @@ class Node:
             self.predecessor().id(1),
             self.id()
         ):
+            if self._predecessor is None or\
+                    self._predecessor.id() != remote_node_reference.id():
+                if self._predecessor is not None:
+                    self.lookup_cache.invalidate_node(self._predecessor)
+                    # Our old predecessor may be backed off, tell it that\
+                    #  its successor changed
+                    try:
+                        self._predecessor.churn()
+                    except socket.error:
+                        pass
+                self.churn()
+            self.lookup_cache.invalidate_point(remote_node_reference.id())
             self._predecessor = remote_node_reference
 
     def find_successor(self, key):
+        return self.lookup(key)[1]
+
+    def find_predecessor(self, key):
+        return self.lookup(key, cached=False)[0]
+
+    def lookup(self, key, cached=True):
+        '''
+        Find the node responsible for key. Returns it along with its
+        predecessor, the node that answered the lookup (None when the owner
+        came from the lookup cache).
+        '''
         if self.predecessor() and between(
             key,
             self.predecessor().id(1),
             self.id(1)
         ):
-            return self
-        node = self.find_predecessor(key)
-        return node.succesor()
-
-    def find_predecessor(self, key):
+            return self.predecessor(), self
+        owner = self.lookup_cache.get(key) if cached else None
+        if owner is not None:
+            if owner.ping():
+                return None, owner
+            self.lookup_cache.invalidate_node(owner)
+
+        if self.lookup_mode == RECURSIVE:
+            pred, owner = self.lookup_recursive(key)
+        else:
+            pred, owner = self.lookup_iterative(key)
+        if pred is not self and owner is not self:
+            self.lookup_cache.put(pred, owner)
+        return pred, owner
+
+    def route(self, key, call):
+        '''
+        Run call on the node responsible for key. A failed RPC means the
+        owner we knew is gone, so it is looked up again, once.
+        '''
+        owner = self.find_owner(key)
+        try:
+            return call(owner)
+        except socket.error:
+            self.lookup_cache.invalidate_node(owner)
+            return call(self.find_owner(key))
+
+    def find_owner(self, key):
+        owner = self.find_successor(key)
+        if owner.id() == self.id() and self.predecessor() is not None:
+            # Only we know about the node that just joined behind us, the\
+            #  ring still leads its keys to us. Sending them back to us would\
+            #  loop until the ring stabilizes.
+            return self.predecessor()
+        return owner
+
+    def find_successor_step(self, key):
+        '''
+        One hop of a lookup: (True, succesor) when our succesor is
+        responsible for key, otherwise (False, next hop).
+        '''
+        succ = self.succesor()
+        if succ.id() == self.id() or between(key, self.id(1), succ.id(1)):
+            return True, succ
+        node = self.closest_preceding_node(key)
+        # No live finger closer to key, our succesor is the best guess
+        if node.id() == self.id():
+            return True, succ
+        return False, node
+
+    def lookup_iterative(self, key):
+        # One round trip per hop
         node = self
+        for _ in range(KEY_SIZE):
+            done, next_node = node.find_successor_step(key)
+            if done:
+                return node, next_node
+            node = next_node
+        raise NoResponseException(f"Lookup of {key} did not converge")
+
+    def lookup_recursive(self, key):
+        done, next_node = self.find_successor_step(key)
+        if done:
+            return self, next_node
+
+        lookup_id = next(self.lookup_ids) & 0xFFFFFFFF
+        pending = self.lookups[lookup_id] = PendingCall("lookup")
+        try:
+            next_node.forward_lookup(key, (self.ip, self.port), lookup_id)
+            if pending.event.wait(LOOKUP_TIMEOUT):
+                return pending.value
+        except socket.error:
+            pass
+        finally:
+            self.lookups.pop(lookup_id, None)
+        # The query got lost on its way, walk the ring ourselves
+        logging.debug(f"Recursive lookup of {key} failed, going iterative")
+        return self.lookup_iterative(key)
+
+    def forward_lookup(self, key, origin, lookup_id):
+        done, next_node = self.find_successor_step(key)
+        if not done:
+            next_node.forward_lookup(key, origin, lookup_id)
+        elif origin == (self.ip, self.port):
+            self.lookup_reply(lookup_id, self, next_node)
+        else:
+            RemoteNodeReference(*origin).lookup_reply(
+                lookup_id,
+                (self.ip, self.port),
+                (next_node.ip, next_node.port)
+            )
 
-        if node.succesor().id() == node.id():
-            return node
-        while not between(key, node.id(1), node.succesor().id(1)):
-            node = node.closest_preceding_node(key)
-        return node
+    def lookup_reply(self, lookup_id, pred, owner):
+        pending = self.lookups.get(lookup_id)
+        if pending is not None:
+            if not isinstance(pred, (Node, RemoteNodeReference)):
+                pred = RemoteNodeReference(*pred)
+                owner = RemoteNodeReference(*owner)
+            pending.resolve(True, (pred, owner))
 
     def closest_preceding_node(self, key):
+        candidates = []
+        seen = set()
         for node in reversed(self.succesors + self.fingers):
-            if node is not None and between(
+            if node is None or node.id() in seen or not between(
                 node.id(),
                 self.id(1),
                 key
-            ) and node.ping():
-                return node
-        return self
-
-    @repeat_after_time(FINGERS_INTERVAL)
+            ):
+                continue
+            seen.add(node.id())
+            if node.ping():
+                candidates.append(node)
+                if len(candidates) == PRS_CANDIDATES:
+                    break
+        if not candidates:
+            return self
+        return self.nearest_hop(candidates, key)
+
+    def nearest_hop(self, candidates, key):
+        '''
+        Proximity route selection. The closest preceding node makes the most
+        progress, but a node leaving at most twice its distance to the key\
+        costs at most one more hop, so take it when it is much nearer to us.
+        '''
+        def distance(node):
+            return (key - node.id()) % MAX_KEY
+
+        closest = min(candidates, key=distance)
+        closest_rtt = closest.rtt()
+        if closest_rtt is None:
+            return closest
+        best, best_rtt = closest, closest_rtt * PRS_RTT_FACTOR
+        for node in candidates:
+            rtt = node.rtt()
+            if rtt is not None and rtt < best_rtt and\
+                    distance(node) <= 2 * distance(closest):
+                best, best_rtt = node, rtt
+        return best
+
+    @repeat_after_time(FINGERS_INTERVAL, FINGERS_MAX_INTERVAL)
     def fix_fingers(self):
+        if self.fingers_mode == FINGERS_BULK:
+            self.refresh_fingers()
+            return True
         i = random.randrange(KEY_SIZE - 1) + 1
-        self.fingers[i] = self.find_successor(self.id(2**i))
+        succ = self.find_successor(self.id(2**i))
+        self.fingers[i] = self.nearest_finger(i, succ)
         return True
 
-    @repeat_after_time(UPDATE_SUCCESORS_INTERVAL)
+    def get_fingers(self):
+        '''
+        Distinct nodes of the finger table, for other nodes to use as hints.
+        '''
+        seen = set()
+        fingers = []
+        for node in self.fingers:
+            if node is not None and node.id() not in seen:
+                seen.add(node.id())
+                fingers.append((node.ip, node.port))
+        return fingers
+
+    def refresh_fingers(self):
+        '''
+        Refresh the whole finger table in one pass. Consecutive fingers whose\
+        interval start falls before the successor found for a previous one\
+        share it, so only the distinct fingers (about log N) are looked up.\
+        Every lookup first tries the nearest node known from our tables and\
+        the fingers of our successor, checked with a single RPC.
+        '''
+        known = {
+            node.id(): node for node in self.succesors + self.fingers
+            if isinstance(node, RemoteNodeReference)
+        }
+        succ = self.succesor()
+        if succ is not self:
+            try:
+                for node in succ.get_fingers():
+                    known.setdefault(node.id(), node)
+            except (socket.error, RemoteError):
+                pass
+        known.pop(self.id(), None)
+        hints = sorted(known)
+
+        i = 1
+        while i < KEY_SIZE:
+            start = self.id(2**i)
+            try:
+                # Fingers repair the lookup cache, never trust it here
+                owner = self.guess_successor(start, hints, known) or\
+                    self.lookup(start, cached=False)[1]
+                self.fingers[i] = self.nearest_finger(i, owner)
+            except (socket.error, RemoteError, NoResponseException):
+                logging.debug(f"Could not refresh finger {i} of {self}")
+                i += 1
+                continue
+            i += 1
+            while i < KEY_SIZE and\
+                    between(self.id(2**i), start, owner.id(1)):
+                self.fingers[i] = owner
+                i += 1
+
+    def guess_successor(self, key, hints, known):
+        '''
+        Nearest known node at or after key, if its predecessor confirms it\
+        is the successor of key.
+        '''
+        if not hints:
+            return None
+        guess = known[hints[bisect_left(hints, key) % len(hints)]]
+        try:
+            pred = guess.predecessor()
+        except (socket.error, RemoteError):
+            return None
+        if pred is not None and between(key, pred.id(1), guess.id(1)):
+            return guess
+        return None
+
+    def nearest_finger(self, i, succ):
+        '''
+        Proximity neighbour selection. Any node in [id + 2^i, id + 2^(i+1))\
+        is a valid i-th finger, pick the one with the lowest round trip time\
+        among the successor of the interval start and its successors.
+        '''
+        if not isinstance(succ, RemoteNodeReference):
+            return succ
+        start, end = self.id(2**i), self.id(2**(i + 1))
+        try:
+            candidates = [
+                node for node in succ.get_succesors()
+                if between(node.id(), start, end) and node.ping()
+            ]
+        except (socket.error, RemoteError):
+            return succ
+        best, best_rtt = succ, succ.rtt()
+        for node in candidates:
+            rtt = node.rtt()
+            if rtt is not None and (best_rtt is None or rtt < best_rtt):
+                best, best_rtt = node, rtt
+        return best
+
+    @repeat_after_time(
+        UPDATE_SUCCESORS_INTERVAL,
+        UPDATE_SUCCESORS_MAX_INTERVAL
+    )
     def update_succesors(self):
         # Manage cases when we are not alone in the ring
         succ = self.succesor()
@@ -390,6 +1549,13 @@ class Node:
             succ_list = succ.get_succesors()
             if succ_list:
                 successors += succ_list
+            # Nodes we didn't know about split some cached range
+            known = set(map(id, self.succesors))
+            for node in successors:
+                if id(node) not in known:
+                    self.lookup_cache.invalidate_point(node.id())
+            if list(map(id, successors)) != list(map(id, self.succesors)):
+                self.churn()
             self.succesors = successors
         return True
 
@@ -404,16 +1570,6 @@ class Node:
                 (node.ip, node.port) for node in self.succesors
             ]
 
-    def recv(self, sock):
-        data = b''
-        while 1:
-            rec = sock.recv(64)
-            if rec[-2:] == b"!!":
-                data += rec[:-2]
-                break
-            data += rec
-        return data
-
     def __dispatch_rpc(self, action, *args):
         if hasattr(self, action):
             func = getattr(self, action)
@@ -421,58 +1577,267 @@ class Node:
             func = self.callbacks[action]
         return func(*args)
 
+    def stats(self):
+        '''
+        Load of the request workers of the node, and bytes of queued\
+        messages it holds.
+        '''
+        stats = self.workers.stats()
+        stats["messages_size"] = self.store.messages_size
+        return stats
+
     def serve_rpc_requests(self):
         # Create the socket server
         server_sock = socket.socket()
+        # A restarted node takes its old address back, and with it its\
+        #  identifier, while connections of the previous run linger
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_sock.bind((self.ip, self.port))
-        server_sock.listen(100)  # TODO: Pherhaps use a threshold here??
+        server_sock.listen(self.backlog)
+        self.serving.set()
 
         while True:
+            # Stop accepting while every connection slot is taken, new\
+            #  peers wait in the listen backlog
+            self.connection_slots.acquire()
             try:
                 client_sock, addr = server_sock.accept()
                 threading.Thread(
                     target=self.handle_client,
                     args=(client_sock, addr)).start()
             except socket.error:
+                self.connection_slots.release()
                 logging.info("Error in the RPC server socket. Continue")
                 continue
 
     def handle_client(self, client_sock, addr):
-        request = self.recv(client_sock)
-        # Ignore garbage
-        if request != b"pinging":
-            request = loads(request)
-            command = request[0]
-            request = request[1:]
-            # Valid command
-            if hasattr(self, command) or command in self.callbacks.keys():
-                # This is needed because cloudpickle wont serialize lock\
-                #  objects
-                if command == "notify":
-                    request[0].lock = threading.BoundedSemaphore()
-                response = self.__dispatch_rpc(command, *request)
-
-                if isinstance(response, (RemoteNodeReference, Node)):
-                    response = (response.ip, response.port)
-
-                client_sock.sendall(dumps(response) + b"!!")
-        else:
-            # logging.debug(f"Receive ping from {addr}")
+        # Connections are persistent, keep serving requests until the peer\
+        #  hangs up. Requests are handed to the workers so a slow one doesn't\
+        #  block the others multiplexed on the same socket, except the local\
+        #  ones: they are quick, and the workers may be waiting for them.
+        send_lock = threading.Lock()
+        reader = FrameReader(client_sock)
+        try:
+            while True:
+                try:
+                    flags, req_id, body = reader.read()
+                except socket.error:
+                    break
+                try:
+                    request = decode_request(body)
+                except Exception as e:
+                    logging.exception(f"Undecodable request from {addr}")
+                    request = ["invalid", e]
+                if request[0] in LOCAL_RPCS and not flags & FLAG_ONEWAY:
+                    self.serve_request(client_sock, send_lock, req_id,
+                                       request, flags)
+                    continue
+                future = self.workers.submit(
+                    self.serve_request,
+                    client_sock, send_lock, req_id, request, flags
+                )
+                if future is None:
+                    self.reject_request(req_id, request, flags,
+                                        client_sock, send_lock)
+        finally:
+            client_sock.close()
+            self.connection_slots.release()
+
+    def reject_request(self, req_id, request, flags, client_sock=None,
+                       send_lock=None, writer=None):
+        '''
+        Answer busy to a request the workers had no room for.
+        '''
+        logging.debug(f"Too busy to serve {request[0]}")
+        if flags & FLAG_ONEWAY:
+            return
+        flags = FLAG_RESPONSE | FLAG_ERROR | FLAG_BUSY
+        body = encode_error("Busy")
+        if writer is not None:
+            write_frame(writer, flags, req_id, body)
+            return
+        try:
+            with send_lock:
+                send_frame(client_sock, flags, req_id, body)
+        except socket.error:
             pass
-        client_sock.close()
 
-    def start_service(self):
+    def serve_request(self, client_sock, send_lock, req_id, request,
+                      request_flags=0):
+        flags, body = self.execute_request(request)
+        if request_flags & FLAG_ONEWAY:
+            return
+        try:
+            with send_lock:
+                send_frame(client_sock, flags, req_id, body)
+        except socket.error:
+            logging.debug(f"Could not answer {request[0]}, peer is gone")
+
+    def execute_request(self, request):
+        '''
+        Serve a decoded request. Returns the flags and the body of the
+        response frame.
+        '''
+        command = request[0]
+        args = request[1:]
+        # Valid command
+        if hasattr(self, command) or command in self.callbacks.keys():
+            if command == "notify":
+                args = [RemoteNodeReference(*args[0])]
+            try:
+                response = self.__dispatch_rpc(command, *args)
+                ok = True
+            except Exception as e:
+                logging.exception(f"Error serving {command}")
+                response = f"{type(e).__name__}: {e}"
+                ok = False
+
+            response = self._to_wire(response)
+        else:
+            response = f"Invalid Request {command}"
+            ok = False
+
+        try:
+            if ok:
+                return FLAG_RESPONSE, encode_response(command, response)
+            return FLAG_RESPONSE | FLAG_ERROR, encode_error(response)
+        except Exception as e:
+            logging.exception(f"Could not encode the response to {command}")
+            return FLAG_RESPONSE | FLAG_ERROR,\
+                encode_error(f"{type(e).__name__}: {e}")
+
+    def blocks(self, command):
+        '''
+        Whether the local RPC command may block: the store ones do on disk,\
+        and while we leave the writes wait for our heir to get them too.\
+        The asyncio engine serves those on the local workers instead of\
+        the event loop.
+        '''
+        return command in STORE_RPCS and\
+            (self.store.persistent or self.heir is not None)
+
+    def _to_wire(self, response):
+        # Node references travel as their address
+        if isinstance(response, (RemoteNodeReference, Node)):
+            return (response.ip, response.port)
+        if type(response) is tuple:
+            return tuple(self._to_wire(item) for item in response)
+        return response
+
+    async def handle_client_async(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        loop = asyncio.get_running_loop()
+
+        def reply(req_id, future):
+            if writer.is_closing():
+                return
+            try:
+                flags, body = future.result()
+            except Exception as e:
+                flags = FLAG_RESPONSE | FLAG_ERROR
+                body = encode_error(f"{type(e).__name__}: {e}")
+            write_frame(writer, flags, req_id, body)
+
+        try:
+            while True:
+                flags, req_id, body = await read_frame(reader)
+                try:
+                    request = decode_request(body)
+                except Exception as e:
+                    logging.exception("Undecodable request")
+                    request = ["invalid", e]
+
+                workers = self.workers
+                if request[0] in LOCAL_RPCS and not flags & FLAG_ONEWAY:
+                    if not self.blocks(request[0]):
+                        flags, body = self.execute_request(request)
+                        write_frame(writer, flags, req_id, body)
+                        await writer.drain()
+                        continue
+                    workers = self.local_workers
+                future = workers.submit(self.execute_request, request)
+                if future is None:
+                    self.reject_request(req_id, request, flags,
+                                        writer=writer)
+                elif not flags & FLAG_ONEWAY:
+                    asyncio.wrap_future(future, loop=loop).add_done_callback(
+                        lambda f, req_id=req_id: reply(req_id, f)
+                    )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            writer.close()
+
+    async def _repeat_async(self, task):
+        # Same as repeat_after_time, but waiting on the event loop
+        loop = asyncio.get_running_loop()
+        step = task.__wrapped__
+        interval = self.intervals[task.__name__]
+        while True:
+            await interval.wait_async()
+            if self.left.is_set():
+                return
+            if self.leaving.is_set():
+                continue
+            try:
+                if not await loop.run_in_executor(self.executor, step, self):
+                    return
+            except Exception:
+                logging.exception(f"Error in {task.__name__}")
+                interval.reset()
+            interval.backoff()
+
+    async def serve_async(self):
+        loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(ASYNC_WORKERS)
+        use_event_loop(loop)
+        if self.primary is None:
+            await self.detector.start_async()
+        else:
+            await self.detector.listen_async((self.ip, self.port))
+        server = await asyncio.start_server(
+            self.handle_client_async,
+            self.ip,
+            self.port,
+            backlog=self.backlog
+        )
+        self.serving.set()
+        for task in self.maintenance:
+            loop.create_task(self._repeat_async(task))
+        async with server:
+            await server.serve_forever()
+
+    def start_service(self, mode=THREADED):
+        if mode == ASYNC:
+            threading.Thread(
+                target=asyncio.run,
+                args=(self.serve_async(),)
+            ).start()
+            return
+
+        if self.primary is None:
+            self.detector.start()
+        else:
+            self.detector.listen((self.ip, self.port))
         stabilize_daemon = threading.Thread(target=self.stabilize)
         fix_fingers_daemon = threading.Thread(target=self.fix_fingers)
         update_succesors_daemon = threading.Thread(
             target=self.update_succesors
         )
+        anti_entropy_daemon = threading.Thread(target=self.anti_entropy)
+        expire_daemon = threading.Thread(target=self.expire)
+        snapshot_daemon = threading.Thread(target=self.snapshot_ring)
         rpc_daemon = threading.Thread(target=self.serve_rpc_requests)
 
         rpc_daemon.start()
         stabilize_daemon.start()
         fix_fingers_daemon.start()
         update_succesors_daemon.start()
+        anti_entropy_daemon.start()
+        expire_daemon.start()
+        snapshot_daemon.start()
 
         # while 1:
         #     logging.debug(" ** ******* NODE STATE *********\n" +
@@ -484,70 +1849,599 @@ class Node:
     def put(self, key, val):
         logging.debug(f"Putting {key} in <{self.ip}:{self.port}")
         if between(key, self.predecessor().id(1), self.id()):
-            self.storage[key] = val
+            self.claim(key)
+            entry = (self.next_version(), val, deadline(self.value_ttl))
+            with self.versions_lock:
+                self.store_value(key, entry)
             # make that our succesors update the key
-            for node in [self.fingers[0]] + self.succesors:
-                if node.ping():
-                    node.simple_put(key, val)
+            self.replicate(lambda node: node.simple_put(key, entry))
         else:
             logging.debug(f"{self} not responsible for key {key}")
-            node = self.find_successor(key)
-            node.put(key, val)
+            self.route(key, lambda node: node.put(key, val))
         return True
 
     def simple_put(self, key, val):
-        self.storage[key] = val
+        self.keep_newest(key, val)
+        self.pass_on(lambda node: node.simple_put(key, val))
+        return True
+
+    def keep_newest(self, key, val):
+        # Replicated writes may arrive out of order, keep the newest
+        with self.versions_lock:
+            current = self.store.get(key)
+            if current is None or current[0] < val[0]:
+                self.store_value(key, val)
+
+    def pass_on(self, call):
+        '''
+        While we are leaving, run call on our heir too: whatever the mode\
+        it must get the writes it doesn't have in the handoff, including\
+        those forwarded to us by a node that left before us. Returns the\
+        heir, None when we are not leaving.
+        '''
+        heir = self.heir
+        if heir is None:
+            return None
+        if on_event_loop():
+            # Served from the event loop just as we started leaving, waiting\
+            #  for the heir there would stall the loop serving its answer
+            self.replication_executor.submit(call, heir)
+        else:
+            call(heir)
+        return heir
+
+    def store_value(self, key, entry):
+        self.store.put(key, entry)
+        self.expiry.add(EXPIRE_VALUE, key, entry[2])
+        self.see_version(entry[0])
+
+    def store_message(self, key, entry, queue_quota=None, total_quota=None):
+        # Messages are stored as (sequence, (message, deadline)) entries
+        self.store.enqueue(key, entry, queue_quota, total_quota)
+        self.expiry.add(EXPIRE_QUEUE, key, entry[1][1])
+        self.see_version(entry[0])
+
+    def next_version(self):
+        '''
+        Version of a write to a key we own: the wall clock in nanoseconds,\
+        so versions keep growing when the key moves to another owner, but\
+        never repeated here.
+        '''
+        with self.versions_lock:
+            self.last_version = max(time_ns(), self.last_version + 1)
+            return self.last_version
+
+    def see_version(self, version):
+        '''
+        Keep numbering after version, of an entry numbered by another owner\
+        (before a join or a restart) whose clock may be ahead of ours.\
+        Otherwise new messages could get sequence numbers below ones a\
+        client already fetched, and its ack would drop them undelivered.
+        '''
+        with self.versions_lock:
+            if version > self.last_version:
+                self.last_version = version
 
     def get(self, key):
+        if self.read_quorum:
+            return self.read_replicas(key)
         # If we are responsible for key, return it
         if between(key, self.predecessor().id(1), self.id()):
-            return self.storage.get(key, False)
+            self.claim(key)
+            return unversioned(self.store.get(key))
         else:
             # Find the node responsible for that key
-            node = self.find_successor(key)
-            return node.get(key)
-
-    def enqueue_message(self, key, msg):
+            return self.route(key, lambda node: node.get(key))
+
+    def simple_get(self, key):
+        '''
+        Our (version, value, deadline) entry of key, None if we don't have\
+        it.
+        '''
+        return self.store.get(key)
+
+    def read_replicas(self, key):
+        '''
+        Read key from the read quorum of its owner and replicas, the nearest\
+        ones first, and return the value with the highest version. Replicas\
+        found stale get it written back.
+        '''
+        if self.is_responsible(key):
+            self.claim(key)
+            owner = self
+        else:
+            owner = self.find_successor(key)
+        candidates = sorted(
+            self.replica_set(owner),
+            key=lambda node: (node.rtt() is None, node.rtt() or 0)
+        )
+        quorum = min(self.read_quorum, len(candidates))
+        answers = []
+        while len(answers) < quorum and candidates:
+            # Ask as many as answers are missing, the next ones if any fails
+            wave = candidates[:quorum - len(answers)]
+            del candidates[:len(wave)]
+            futures = [
+                (node, None if node is self or len(wave) == 1 else
+                 self.replication_executor.submit(node.simple_get, key))
+                for node in wave
+            ]
+            for node, future in futures:
+                try:
+                    entry = node.simple_get(key) if future is None else\
+                        future.result(RPC_TIMEOUT)
+                    answers.append((node, entry))
+                except (socket.error, RemoteError, FutureTimeoutError) as e:
+                    logging.debug(f"Read of {key} from {node} failed: {e}")
+                    self.replica_sets.pop(owner.id(), None)
+                    self.lookup_cache.invalidate_node(node)
+        if len(answers) < quorum:
+            raise QuorumError(f"{len(answers)} of {quorum} replicas answered")
+
+        newest = max(
+            (entry for _, entry in answers if entry is not None),
+            key=lambda entry: entry[0],
+            default=None
+        )
+        if newest is not None:
+            for node, entry in answers:
+                if entry is None or entry[0] < newest[0]:
+                    self.replication_executor.submit(
+                        node.simple_put, key, newest
+                    )
+        return unversioned(newest)
+
+    def replica_set(self, owner):
+        '''
+        owner followed by the succesors replicating its keys. Other owners\
+        are asked for their replicas, then cached a while.
+        '''
+        if owner is self:
+            return [self] + self.replicas()
+        now = monotonic()
+        nodes, expiry = self.replica_sets.get(owner.id(), (None, 0))
+        if expiry < now:
+            nodes = [
+                self if node.id() == self.id() else node
+                for node in [owner] + owner.get_replicas()
+            ]
+            for other, (_, other_expiry) in list(self.replica_sets.items()):
+                if other_expiry < now:
+                    self.replica_sets.pop(other, None)
+            self.replica_sets[owner.id()] = (nodes, now + LOOKUP_CACHE_TTL)
+        return list(nodes)
+
+    def enqueue_message(self, key, msg, ttl=None):
+        '''
+        Queue msg for key, dropping it after ttl seconds (the message_ttl of\
+        the owner if not given, 0 never drops it).
+        '''
         # If we are responsible for key, then enqueue msg
         if between(key, self.predecessor().id(1), self.id(1)):
-            try:
-                self.messages[key].append(msg)
-            except KeyError:
-                self.messages[key] = [msg]
+            self.claim(key)
+            # Messages are numbered like the versions of the values, the\
+            #  replicas get the deadline to expire them at the same time
+            entry = (
+                self.next_version(),
+                (msg, deadline(self.message_ttl if ttl is None else ttl))
+            )
+            self.store_message(
+                key,
+                entry,
+                self.queue_quota,
+                self.messages_quota
+            )
             # Update queue of succesors
-            for node in [self.fingers[0]] + self.succesors:
-                if node.ping():
-                    node.simple_enqueue(key, msg)
+            self.replicate(lambda node: node.simple_enqueue(key, entry))
         else:
             # Search for responsible of key
-            node = self.find_successor(key)
-            node.enqueue_message(key, msg)
+            self.route(key, lambda node: node.enqueue_message(key, msg, ttl))
         return True
 
-    def simple_enqueue(self, key, msg):
-        try:
-            self.messages[key].append(msg)
-        except KeyError:
-            self.messages[key] = []
+    def enqueue_expiring(self, key, msg, ttl):
+        return self.enqueue_message(key, msg, ttl)
+
+    def simple_enqueue(self, key, entry):
+        self.store_message(key, entry)
+        self.pass_on(lambda node: node.simple_enqueue(key, entry))
 
     def dequeue_messages(self, key):
         # If We are responsible for key, dequeue it and return
         if between(key, self.predecessor().id(1), self.id(1)):
-            msg_list = self.messages.get(key, [])
-            self.messages[key] = []
+            self.claim(key)
+            now = time()
+            msg_list = [
+                msg for _, (msg, msg_deadline) in self.store.dequeue(key)
+                if not expired(msg_deadline, now)
+            ]
             # Remove msgs entries in succesors
-            for node in [self.fingers[0]] + self.succesors:
-                if node.ping():
-                    node.simple_dequeue(key)
+            self.replicate(lambda node: node.simple_dequeue(key))
             return msg_list
         else:
             # Find responsible for key
-            node = self.find_successor(key)
-            response = node.dequeue_messages(key)
-            return response
+            return self.route(key, lambda node: node.dequeue_messages(key))
 
     def simple_dequeue(self, key):
-        self.messages[key] = []
+        self.store.dequeue(key)
+        self.pass_on(lambda node: node.simple_dequeue(key))
+
+    def fetch(self, key, after, limit):
+        '''
+        A page of the messages queued for key: the first (sequence, message)\
+        entries after the sequence number after, at most limit of them.\
+        Fetching doesn't remove them, see ack.
+        '''
+        limit = min(limit, MAX_FETCH_MESSAGES)
+        if between(key, self.predecessor().id(1), self.id(1)):
+            self.claim(key)
+            # Drop the expired messages the sweeper didn't reach yet, a\
+            #  short page would tell the client there are no more
+            while True:
+                page = self.store.fetch(key, after, limit)
+                if not self.expire_messages(key, page):
+                    return [(seq, msg) for seq, (msg, _) in page]
+        else:
+            return self.route(key, lambda node: node.fetch(key, after, limit))
+
+    def ack(self, key, upto):
+        '''
+        The messages of key up to the sequence number upto were delivered,\
+        drop them here and in the replicas.
+        '''
+        if between(key, self.predecessor().id(1), self.id(1)):
+            self.claim(key)
+            self.store.ack(key, upto)
+            self.replicate(lambda node: node.simple_ack(key, upto))
+        else:
+            self.route(key, lambda node: node.ack(key, upto))
+        return True
+
+    def simple_ack(self, key, upto):
+        self.store.ack(key, upto)
+        self.pass_on(lambda node: node.simple_ack(key, upto))
+        return True
+
+    @repeat_after_time(EXPIRY_INTERVAL)
+    def expire(self):
+        '''
+        Drop the values and queued messages past their deadline. Replicas\
+        got the same deadlines with the entries, and drop them on their own.
+        '''
+        now = int(time())
+        for kind, key in self.expiry.due(now):
+            if kind == EXPIRE_VALUE:
+                # Don't race a newer write of the key
+                with self.versions_lock:
+                    entry = self.store.get(key)
+                    if entry is not None and expired(entry[2], now):
+                        self.store.discard_value(key)
+                    elif entry is not None:
+                        self.expiry.add(EXPIRE_VALUE, key, entry[2])
+            else:
+                for _, msgs in self.store.queues([key]):
+                    self.expire_messages(key, msgs, now)
+        return True
+
+    def expire_messages(self, key, msgs, now=None):
+        '''
+        Discard the expired ones of the (sequence, (message, deadline))\
+        entries of key, and track the next deadline of the rest. Returns\
+        whether any expired.
+        '''
+        now = time() if now is None else now
+        seqs = []
+        for seq, (_, msg_deadline) in msgs:
+            if expired(msg_deadline, now):
+                seqs.append(seq)
+            else:
+                self.expiry.add(EXPIRE_QUEUE, key, msg_deadline)
+        if seqs:
+            self.store.discard_messages(key, seqs)
+        return bool(seqs)
+
+    def replicate(self, call):
+        '''
+        Send a write to every live replica at once, unless the anti entropy\
+        rounds take care of them. Returns as soon as the write quorum of\
+        them acknowledged it, the others finish in the background.
+        '''
+        heir = self.pass_on(call)
+        if self.replication == LAZY_REPLICATION:
+            return
+        replicas = [
+            node for node in self.replicas()
+            if node.ping() and (heir is None or node.id() != heir.id())
+        ]
+        quorum = min(self.write_quorum, len(replicas))
+        futures = [
+            self.replication_executor.submit(call, node)
+            for node in replicas
+        ]
+        acks = failures = 0
+        if not quorum:
+            return
+        try:
+            for future in as_completed(futures, RPC_TIMEOUT):
+                try:
+                    future.result()
+                    acks += 1
+                    if acks == quorum:
+                        return
+                except (socket.error, RemoteError) as e:
+                    logging.debug(f"Replication failed: {e}")
+                    failures += 1
+                    if failures > len(replicas) - quorum:
+                        break
+        except FutureTimeoutError:
+            pass
+        if acks < quorum:
+            raise QuorumError(f"{acks} of {quorum} replicas acknowledged")
+
+    def replicas(self):
+        '''
+        Distinct succesors holding a replica of our keys. The virtual nodes\
+        of our process are skipped, they would go down with us: N replicas\
+        are on N other processes.
+        '''
+        replicas = []
+        seen = {node.id() for node in self.local_nodes}
+        for node in [self.fingers[0]] + self.succesors:
+            if node.id() not in seen:
+                seen.add(node.id())
+                replicas.append(node)
+        return replicas[:self.replication_factor]
+
+    def get_replicas(self):
+        return [(node.ip, node.port) for node in self.replicas()]
+
+    @repeat_after_time(ANTI_ENTROPY_INTERVAL, ANTI_ENTROPY_MAX_INTERVAL)
+    def anti_entropy(self):
+        '''
+        Reconcile the replicas of the keys we own with our copy.
+        '''
+        pred = self.predecessor()
+        # Until the handoff brought the whole range our copy is partial, and\
+        #  would make the replicas drop the queues still to come
+        if pred is None or self.handoff is not None:
+            return True
+        start, end = pred.id(), self.id()
+        tree = self.digests.tree(start, end)
+        for node in self.replicas():
+            try:
+                if self.reconcile(node, tree):
+                    self.intervals['anti_entropy'].reset()
+            except (socket.error, RemoteError) as e:
+                logging.debug(f"Anti entropy with {node} failed: {e}")
+        return True
+
+    def reconcile(self, node, tree):
+        '''
+        Send node the keys of the buckets where its replica of our range\
+        differs from ours. Returns whether there were any.
+        '''
+        ranges = self.differing_ranges(node, tree)
+        for start, end in ranges:
+            keys = self.store.range(start, end)
+            newer = node.sync_range(
+                start,
+                end,
+                self.store.items(keys),
+                self.store.queues(keys)
+            )
+            # Values the replica has and we missed
+            self.simple_multi_put(newer)
+        return bool(ranges)
+
+    def differing_ranges(self, node, tree):
+        '''
+        Walk down the Merkle tree of node for the range of tree along the\
+        subtrees that differ from ours. Returns the ring intervals covering\
+        the buckets that differ, clockwise.
+        '''
+        indices = [0]
+        for level in range(tree.depth + 1):
+            digests = node.merkle_nodes(tree.start, tree.end, level, indices)
+            differing = tree.diff(level, indices, digests)
+            if not differing or level == tree.depth:
+                break
+            indices = [child for i in differing for child in (2*i, 2*i + 1)]
+
+        # Runs of contiguous buckets go together
+        runs = []
+        for bucket in differing:
+            if runs and runs[-1][1] == bucket - 1:
+                runs[-1][1] = bucket
+            else:
+                runs.append([bucket, bucket])
+        return [tree.bucket_range(first, last) for first, last in runs]
+
+    def merkle_nodes(self, start, end, level, indices):
+        '''
+        Digests of some nodes of a level of our Merkle tree of (start, end].
+        '''
+        now = monotonic()
+        tree, expiry = self.merkle_trees.get((start, end), (None, 0))
+        if level == 0 or expiry < now:
+            # A new walk starts at the root, bring the tree up to date
+            tree = self.digests.tree(start, end)
+            for interval, (_, expiry) in list(self.merkle_trees.items()):
+                if expiry < now:
+                    self.merkle_trees.pop(interval, None)
+            self.merkle_trees[(start, end)] = (tree, now + MERKLE_CACHE_TTL)
+        return [tree.node(level, index) for index in indices]
+
+    def sync_range(self, start, end, key_val, key_msg):
+        '''
+        Reconcile our replica of the keys in (start, end] with the owner's.\
+        The newest version of every value wins, the values we have newer\
+        than the owner (or it lacks) are returned for it to take. Queues\
+        follow the owner, which alone decides what was delivered.
+        '''
+        theirs = dict(key_val)
+        keys = self.store.range(start, end)
+        newer = []
+        with self.versions_lock:
+            for key, entry in self.store.items(keys):
+                other = theirs.get(key)
+                if (other is None or other[0] < entry[0]) and\
+                        not expired(entry[2]):
+                    newer.append((key, entry))
+            for key, entry in key_val:
+                current = self.store.get(key)
+                if current is None or current[0] < entry[0]:
+                    self.store_value(key, entry)
+        for key, _ in self.store.queues(keys):
+            self.store.dequeue(key)
+        for key, msgs in key_msg:
+            for msg in msgs:
+                self.store_message(key, msg)
+        return newer
+
+    def is_responsible(self, key):
+        return self.predecessor() is not None and\
+            between(key, self.predecessor().id(1), self.id(1))
+
+    def partition(self, keys):
+        '''
+        Group the positions of keys by the node responsible for them.
+        Returns a list of (node, positions) pairs.
+        '''
+        # Walking the keys clockwise from us, the keys of the same owner are\
+        #  contiguous: once the owner of a key is known every following key\
+        #  up to the owner identifier is his too, so only one lookup per\
+        #  owner is needed.
+        start = self.id(1)
+        order = sorted(
+            range(len(keys)),
+            key=lambda i: (keys[i] - start) % MAX_KEY
+        )
+        groups = []
+        i = 0
+        while i < len(order):
+            key = keys[order[i]]
+            owner = self if self.is_responsible(key) else\
+                self.find_successor(key)
+            limit = (owner.id() - start) % MAX_KEY
+            group = []
+            while i < len(order) and\
+                    (keys[order[i]] - start) % MAX_KEY <= limit:
+                group.append(order[i])
+                i += 1
+            # Everything left is ours when we own the first key
+            if owner.id() == self.id():
+                group += order[i:]
+                i = len(order)
+            groups.append((owner, group))
+        return groups
+
+    def _batch(self, keys, local, remote):
+        '''
+        Run a batch operation with one call per owner of the keys. local
+        gets the positions we are responsible for, remote the owner and the
+        positions of every other group. Returns (positions, result) pairs.
+        '''
+        results = []
+        futures = []
+        for owner, positions in self.partition(keys):
+            if owner.id() == self.id():
+                results.append((positions, local(positions)))
+            else:
+                futures.append((
+                    owner,
+                    positions,
+                    self.batch_executor.submit(remote, owner, positions)
+                ))
+        for owner, positions, future in futures:
+            try:
+                results.append((positions, future.result()))
+            except socket.error:
+                self.lookup_cache.invalidate_node(owner)
+                raise
+        return results
+
+    def multi_get(self, keys):
+        values = [False] * len(keys)
+
+        def local(positions):
+            for i in positions:
+                self.claim(keys[i])
+            return [unversioned(self.store.get(keys[i])) for i in positions]
+
+        def remote(owner, positions):
+            return owner.multi_get([keys[i] for i in positions])
+
+        for positions, result in self._batch(keys, local, remote):
+            for i, value in zip(positions, result):
+                values[i] = value
+        return values
+
+    def multi_put(self, items):
+        keys = [key for key, _ in items]
+
+        def local(positions):
+            owned = [items[i] for i in positions]
+            for key, _ in owned:
+                self.claim(key)
+            expires = deadline(self.value_ttl)
+            owned = [
+                (key, (self.next_version(), val, expires))
+                for key, val in owned
+            ]
+            self.simple_multi_put(owned)
+            self.replicate(lambda node: node.simple_multi_put(owned))
+
+        def remote(owner, positions):
+            owner.multi_put([items[i] for i in positions])
+
+        self._batch(keys, local, remote)
+        return True
+
+    def simple_multi_put(self, items):
+        for key, val in items:
+            self.keep_newest(key, val)
+        self.pass_on(lambda node: node.simple_multi_put(items))
+        return True
+
+    def multi_enqueue(self, items):
+        keys = [key for key, _ in items]
+
+        def local(positions):
+            owned = [items[i] for i in positions]
+            for key, _ in owned:
+                self.claim(key)
+            accepted = []
+            rejected = 0
+            expires = deadline(self.message_ttl)
+            for key, msg in owned:
+                entry = (self.next_version(), (msg, expires))
+                try:
+                    self.store_message(
+                        key,
+                        entry,
+                        self.queue_quota,
+                        self.messages_quota
+                    )
+                    accepted.append((key, entry))
+                except QuotaError:
+                    rejected += 1
+            if accepted:
+                self.replicate(
+                    lambda node: node.simple_multi_enqueue(accepted)
+                )
+            if rejected:
+                raise QuotaError(f"{rejected} messages over quota")
+
+        def remote(owner, positions):
+            owner.multi_enqueue([items[i] for i in positions])
+
+        self._batch(keys, local, remote)
+        return True
+
+    def simple_multi_enqueue(self, items):
+        for key, entry in items:
+            self.store_message(key, entry)
+        self.pass_on(lambda node: node.simple_multi_enqueue(items))
+        return True
 
     def register(self, callback_name, callback):
         self.callbacks[callback_name] = callback
@@ -0,0 +1,432 @@
+'''
+Compact encoding of the CHORD RPC messages.
+
+The core RPCs have a fixed schema: a request is its opcode followed by the
+packed arguments, and the response is packed according to the RPC it answers.
+Keys travel as fixed 20 bytes integers and node addresses as packed ip/port
+pairs. Values stored in the DHT use a small tagged encoding. Anything without
+a schema (registered callbacks) falls back to cloudpickle.
+'''
+import socket
+import struct
+from cloudpickle import dumps, loads
+
+KEY_BYTES = 20
+
+U8 = struct.Struct("!B")
+U16 = struct.Struct("!H")
+U32 = struct.Struct("!I")
+I64 = struct.Struct("!q")
+IPV4_ADDRESS = struct.Struct("!B4sH")
+
+
+class CodecError(ValueError):
+    '''
+    Exception raised when a message can't be encoded or decoded.
+    '''
+    pass
+
+
+class Field(object):
+    '''
+    A field of a RPC schema. Knows how to append a python value to a buffer
+    and how to read it back from a memoryview at a given offset.
+    '''
+    def pack(self, out, value):
+        raise NotImplementedError
+
+    def unpack(self, view, offset):
+        raise NotImplementedError
+
+
+class KeyField(Field):
+    def pack(self, out, value):
+        try:
+            out += value.to_bytes(KEY_BYTES, 'big')
+        except (OverflowError, AttributeError):
+            raise CodecError(f"Invalid key {value!r}")
+
+    def unpack(self, view, offset):
+        end = offset + KEY_BYTES
+        return int.from_bytes(view[offset:end], 'big'), end
+
+
+class AddressField(Field):
+    '''
+    (host, port) tuple. Dotted IPv4 hosts take 4 bytes, anything else
+    (hostnames like localhost) is sent as a short string.
+    '''
+    IPV4 = 4
+    NAME = 0
+    # A node talks to a handful of peers, so cache their packed addresses
+    CACHE_SIZE = 4096
+
+    def __init__(self):
+        self.packed = {}
+        self.hosts = {}
+
+    def _pack(self, host, port):
+        try:
+            packed = U8.pack(self.IPV4) +\
+                socket.inet_pton(socket.AF_INET, host)
+        except OSError:
+            name = host.encode('ascii')
+            packed = U8.pack(self.NAME) + U8.pack(len(name)) + name
+        return packed + U16.pack(port)
+
+    def pack(self, out, value):
+        address = (value[0], value[1])
+        try:
+            out += self.packed[address]
+        except KeyError:
+            packed = self._pack(*address)
+            if len(self.packed) < self.CACHE_SIZE:
+                self.packed[address] = packed
+            out += packed
+
+    def unpack(self, view, offset):
+        if view[offset] == self.IPV4:
+            _, packed_host, port = IPV4_ADDRESS.unpack_from(view, offset)
+            try:
+                host = self.hosts[packed_host]
+            except KeyError:
+                host = socket.inet_ntop(socket.AF_INET, packed_host)
+                if len(self.hosts) < self.CACHE_SIZE:
+                    self.hosts[packed_host] = host
+            return (host, port), offset + IPV4_ADDRESS.size
+        size = view[offset + 1]
+        offset += 2
+        host = str(view[offset:offset + size], 'ascii')
+        port, = U16.unpack_from(view, offset + size)
+        return (host, port), offset + size + U16.size
+
+
+class UIntField(Field):
+    def pack(self, out, value):
+        out += U32.pack(value)
+
+    def unpack(self, view, offset):
+        return U32.unpack_from(view, offset)[0], offset + U32.size
+
+
+class IntField(Field):
+    def pack(self, out, value):
+        out += I64.pack(value)
+
+    def unpack(self, view, offset):
+        return I64.unpack_from(view, offset)[0], offset + I64.size
+
+
+class OptionalField(Field):
+    def __init__(self, field):
+        self.field = field
+
+    def pack(self, out, value):
+        if value is None:
+            out += U8.pack(0)
+        else:
+            out += U8.pack(1)
+            self.field.pack(out, value)
+
+    def unpack(self, view, offset):
+        if not view[offset]:
+            return None, offset + 1
+        return self.field.unpack(view, offset + 1)
+
+
+class ListField(Field):
+    def __init__(self, field):
+        self.field = field
+
+    def pack(self, out, value):
+        out += U32.pack(len(value))
+        pack = self.field.pack
+        for item in value:
+            pack(out, item)
+
+    def unpack(self, view, offset):
+        count, = U32.unpack_from(view, offset)
+        offset += U32.size
+        unpack = self.field.unpack
+        items = []
+        for _ in range(count):
+            item, offset = unpack(view, offset)
+            items.append(item)
+        return items, offset
+
+
+class TupleField(Field):
+    def __init__(self, *fields):
+        self.fields = fields
+
+    def pack(self, out, value):
+        for field, item in zip(self.fields, value):
+            field.pack(out, item)
+
+    def unpack(self, view, offset):
+        items = []
+        for field in self.fields:
+            item, offset = field.unpack(view, offset)
+            items.append(item)
+        return tuple(items), offset
+
+
+class ValueField(Field):
+    '''
+    Self describing encoding for the values stored in the DHT: a type tag
+    followed by the packed value. Types without a tag are pickled.
+    '''
+    NONE, FALSE, TRUE, INT, BIGINT, BYTES, STR, TUPLE, LIST, PICKLE =\
+        range(10)
+
+    def __init__(self):
+        self.packers = {
+            type(None): self._pack_none,
+            bool: self._pack_bool,
+            int: self._pack_int,
+            bytes: self._pack_bytes,
+            bytearray: self._pack_bytes,
+            memoryview: self._pack_bytes,
+            str: self._pack_str,
+            tuple: self._pack_sequence,
+            list: self._pack_sequence,
+        }
+        self.unpackers = [self._unpack_unknown] * 256
+        self.unpackers[self.NONE] = self._unpack_none
+        self.unpackers[self.FALSE] = self._unpack_false
+        self.unpackers[self.TRUE] = self._unpack_true
+        self.unpackers[self.INT] = self._unpack_int
+        self.unpackers[self.BIGINT] = self._unpack_bigint
+        self.unpackers[self.BYTES] = self._unpack_bytes
+        self.unpackers[self.STR] = self._unpack_str
+        self.unpackers[self.TUPLE] = self._unpack_tuple
+        self.unpackers[self.LIST] = self._unpack_items
+        self.unpackers[self.PICKLE] = self._unpack_pickle
+
+    def pack(self, out, value):
+        self.packers.get(type(value), self._pack_pickle)(out, value)
+
+    def _pack_none(self, out, value):
+        out += U8.pack(self.NONE)
+
+    def _pack_bool(self, out, value):
+        out += U8.pack(self.TRUE if value else self.FALSE)
+
+    def _pack_int(self, out, value):
+        if -2**63 <= value < 2**63:
+            out += U8.pack(self.INT)
+            out += I64.pack(value)
+        else:
+            packed = value.to_bytes(
+                (value.bit_length() + 8) // 8, 'big', signed=True
+            )
+            out += U8.pack(self.BIGINT)
+            out += U8.pack(len(packed))
+            out += packed
+
+    def _pack_bytes(self, out, value):
+        out += U8.pack(self.BYTES)
+        out += U32.pack(len(value))
+        out += value
+
+    def _pack_str(self, out, value):
+        packed = value.encode('utf-8')
+        out += U8.pack(self.STR)
+        out += U32.pack(len(packed))
+        out += packed
+
+    def _pack_sequence(self, out, value):
+        out += U8.pack(self.TUPLE if type(value) is tuple else self.LIST)
+        out += U32.pack(len(value))
+        pack = self.pack
+        for item in value:
+            pack(out, item)
+
+    def _pack_pickle(self, out, value):
+        packed = dumps(value)
+        out += U8.pack(self.PICKLE)
+        out += U32.pack(len(packed))
+        out += packed
+
+    def unpack(self, view, offset):
+        return self.unpackers[view[offset]](view, offset + 1)
+
+    def _unpack_none(self, view, offset):
+        return None, offset
+
+    def _unpack_false(self, view, offset):
+        return False, offset
+
+    def _unpack_true(self, view, offset):
+        return True, offset
+
+    def _unpack_int(self, view, offset):
+        return I64.unpack_from(view, offset)[0], offset + I64.size
+
+    def _unpack_bigint(self, view, offset):
+        end = offset + 1 + view[offset]
+        return int.from_bytes(view[offset + 1:end], 'big', signed=True), end
+
+    def _unpack_sized(self, view, offset):
+        size, = U32.unpack_from(view, offset)
+        offset += U32.size
+        return view[offset:offset + size], offset + size
+
+    def _unpack_bytes(self, view, offset):
+        data, offset = self._unpack_sized(view, offset)
+        return bytes(data), offset
+
+    def _unpack_str(self, view, offset):
+        data, offset = self._unpack_sized(view, offset)
+        return str(data, 'utf-8'), offset
+
+    def _unpack_pickle(self, view, offset):
+        data, offset = self._unpack_sized(view, offset)
+        return loads(data), offset
+
+    def _unpack_items(self, view, offset):
+        count, = U32.unpack_from(view, offset)
+        offset += U32.size
+        unpack = self.unpack
+        items = []
+        for _ in range(count):
+            item, offset = unpack(view, offset)
+            items.append(item)
+        return items, offset
+
+    def _unpack_tuple(self, view, offset):
+        items, offset = self._unpack_items(view, offset)
+        return tuple(items), offset
+
+    def _unpack_unknown(self, view, offset):
+        raise CodecError(f"Unknown value tag {view[offset - 1]}")
+
+
+KEY = KeyField()
+UINT = UIntField()
+INT = IntField()
+ADDRESS = AddressField()
+OPTIONAL_ADDRESS = OptionalField(ADDRESS)
+ADDRESS_LIST = ListField(ADDRESS)
+VALUE = ValueField()
+VALUE_LIST = ListField(VALUE)
+KEY_LIST = ListField(KEY)
+UINT_LIST = ListField(UINT)
+ENTRY_LIST = ListField(TupleField(KEY, VALUE))
+STEP = TupleField(VALUE, ADDRESS)
+# (sequence, message) entries of a queue
+MESSAGE_LIST = ListField(TupleField(INT, VALUE))
+QUEUE_LIST = ListField(TupleField(KEY, MESSAGE_LIST))
+# cursor, done, values, queues
+RANGE_CHUNK = TupleField(KEY, VALUE, ENTRY_LIST, QUEUE_LIST)
+
+# Opcode 0 is reserved for requests without schema (pickled)
+OP_PICKLE = 0
+
+# command: (opcode, argument fields, response field)
+# Opcodes are part of the wire protocol, never reuse or renumber them.
+SCHEMAS = {
+    "ping": (1, (), VALUE),
+    "find_successor": (2, (KEY,), ADDRESS),
+    "closest_preceding_node": (3, (KEY,), ADDRESS),
+    "succesor": (4, (), ADDRESS),
+    "predecessor": (5, (), OPTIONAL_ADDRESS),
+    "get_succesors": (6, (), ADDRESS_LIST),
+    "notify": (7, (ADDRESS,), VALUE),
+    "get": (8, (KEY,), VALUE),
+    "put": (9, (KEY, VALUE), VALUE),
+    "simple_put": (10, (KEY, VALUE), VALUE),
+    "enqueue_message": (11, (KEY, VALUE), VALUE),
+    "simple_enqueue": (12, (KEY, VALUE), VALUE),
+    "dequeue_messages": (13, (KEY,), VALUE_LIST),
+    "simple_dequeue": (14, (KEY,), VALUE),
+    "get_keys": (15, (KEY,), VALUE),
+    "remove_key": (16, (KEY,), VALUE),
+    "multi_get": (17, (KEY_LIST,), VALUE_LIST),
+    "multi_put": (18, (ENTRY_LIST,), VALUE),
+    "simple_multi_put": (19, (ENTRY_LIST,), VALUE),
+    "multi_enqueue": (20, (ENTRY_LIST,), VALUE),
+    "simple_multi_enqueue": (21, (ENTRY_LIST,), VALUE),
+    "find_successor_step": (22, (KEY,), STEP),
+    "forward_lookup": (23, (KEY, ADDRESS, UINT), VALUE),
+    "lookup_reply": (24, (UINT, ADDRESS, ADDRESS), VALUE),
+    "get_fingers": (25, (), ADDRESS_LIST),
+    "churn": (26, (), VALUE),
+    "remove_keys": (27, (KEY_LIST,), VALUE),
+    "get_range": (28, (KEY, KEY, UINT), RANGE_CHUNK),
+    "release_range": (29, (KEY, KEY), VALUE),
+    "merkle_nodes": (30, (KEY, KEY, UINT, UINT_LIST), VALUE_LIST),
+    "sync_range": (31, (KEY, KEY, ENTRY_LIST, QUEUE_LIST), ENTRY_LIST),
+    "simple_get": (32, (KEY,), VALUE),
+    "fetch": (33, (KEY, INT, UINT), MESSAGE_LIST),
+    "ack": (34, (KEY, INT), VALUE),
+    "simple_ack": (35, (KEY, INT), VALUE),
+    "enqueue_expiring": (36, (KEY, VALUE, UINT), VALUE),
+    "leave": (37, (), VALUE),
+    "node_left": (38, (ADDRESS, OPTIONAL_ADDRESS, ADDRESS), VALUE),
+    "get_replicas": (39, (), ADDRESS_LIST),
+}
+COMMANDS = {
+    opcode: (command, args)
+    for command, (opcode, args, _) in SCHEMAS.items()
+}
+
+
+def encode_request(request):
+    command, args = request[0], request[1:]
+    try:
+        opcode, fields, _ = SCHEMAS[command]
+    except KeyError:
+        return U8.pack(OP_PICKLE) + dumps(request)
+    if len(args) != len(fields):
+        raise CodecError(f"{command} takes {len(fields)} arguments")
+
+    out = bytearray(U8.pack(opcode))
+    for field, arg in zip(fields, args):
+        field.pack(out, arg)
+    return out
+
+
+def decode_request(body):
+    view = memoryview(body)
+    opcode = view[0]
+    if opcode == OP_PICKLE:
+        return loads(view[1:])
+    try:
+        command, fields = COMMANDS[opcode]
+    except KeyError:
+        raise CodecError(f"Unknown opcode {opcode}")
+
+    request = [command]
+    offset = 1
+    for field in fields:
+        arg, offset = field.unpack(view, offset)
+        request.append(arg)
+    return request
+
+
+def encode_response(command, value):
+    try:
+        field = SCHEMAS[command][2]
+    except KeyError:
+        return dumps(value)
+    out = bytearray()
+    field.pack(out, value)
+    return out
+
+
+def decode_response(command, body):
+    try:
+        field = SCHEMAS[command][2]
+    except KeyError:
+        return loads(body)
+    value, _ = field.unpack(memoryview(body), 0)
+    return value
+
+
+def encode_error(message):
+    return message.encode('utf-8')
+
+
+def decode_error(body):
+    return str(body, 'utf-8')
@@ -0,0 +1,305 @@
+'''
+Phi accrual failure detector over UDP heartbeats.
+
+Every node runs a detector bound to the UDP port with the same number as its
+RPC port. Virtual nodes share the detector of the first node of their
+process, which answers the heartbeats sent to their ports too. The detector
+heartbeats the peers somebody asked about and keeps, for each of them, the
+history of the heartbeat replies. The suspicion level
+(phi) of a peer is computed from the time since its last reply, so asking
+whether a node is alive is a local lookup instead of a round trip.
+'''
+import asyncio
+import itertools
+import logging
+import math
+import selectors
+import socket
+import struct
+import threading
+from collections import deque
+from time import monotonic, sleep
+
+HEARTBEAT_INTERVAL = 0.5
+PHI_THRESHOLD = 8
+# Samples kept per peer to estimate the heartbeat inter arrival times
+SAMPLES_WINDOW = 100
+MIN_STD_DEVIATION = 0.1
+ACCEPTABLE_PAUSE = 1
+# Peers nobody asked about for this long are not heartbeated anymore
+MONITOR_TIMEOUT = 30
+# How long an RPC answer counts as evidence for a peer without heartbeats
+OBSERVATION_TIMEOUT = 5
+
+HEARTBEAT = struct.Struct("!cI")
+PING = b"P"
+ACK = b"A"
+
+_detector = None
+
+
+def installed():
+    '''
+    Failure detector of the nodes running in this process, if any.
+    '''
+    return _detector
+
+
+def install(detector):
+    global _detector
+    # Virtual nodes share one detector. Independent nodes only share the\
+    #  process in tests, the first one serves all of them.
+    if _detector is None:
+        _detector = detector
+
+
+class PeerState(object):
+    __slots__ = (
+        'address',
+        'token',
+        'intervals',
+        'intervals_sum',
+        'squares_sum',
+        'last_heartbeat',
+        'last_observation',
+        'observed_alive',
+        'last_query',
+        'last_ping',
+        'suspected',
+    )
+
+    def __init__(self, address, token):
+        self.address = address
+        self.token = token
+        self.intervals = deque(maxlen=SAMPLES_WINDOW)
+        # Running sums of the intervals in the window and of their squares
+        self.intervals_sum = 0.0
+        self.squares_sum = 0.0
+        self.last_heartbeat = None
+        self.last_observation = None
+        self.observed_alive = False
+        self.last_query = monotonic()
+        self.last_ping = None
+        self.suspected = False
+
+    def heartbeat(self, now):
+        if self.last_heartbeat is not None:
+            if len(self.intervals) == SAMPLES_WINDOW:
+                oldest = self.intervals.popleft()
+                self.intervals_sum -= oldest
+                self.squares_sum -= oldest * oldest
+            interval = now - self.last_heartbeat
+            self.intervals.append(interval)
+            self.intervals_sum += interval
+            self.squares_sum += interval * interval
+        self.last_heartbeat = now
+
+    def phi(self, now):
+        if not self.intervals:
+            mean, std = HEARTBEAT_INTERVAL, HEARTBEAT_INTERVAL / 4
+        else:
+            count = len(self.intervals)
+            mean = self.intervals_sum / count
+            # Rounding of the running sums can take it slightly below zero
+            variance = max(self.squares_sum / count - mean * mean, 0.0)
+            std = math.sqrt(variance)
+        mean += ACCEPTABLE_PAUSE
+        std = max(std, MIN_STD_DEVIATION)
+        # Logistic approximation of the normal CDF, as in the paper
+        y = (now - self.last_heartbeat - mean) / std
+        try:
+            e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        except OverflowError:
+            return 0.0
+        # So long a silence that its probability rounds to zero
+        if e == 0.0:
+            return math.inf
+        if y > 0:
+            return -math.log10(e / (1 + e))
+        return -math.log10(1 - 1 / (1 + e))
+
+
+class FailureDetector(object):
+    '''
+    Keeps the liveness table of the peers of a node.
+    '''
+    def __init__(self, address, interval=HEARTBEAT_INTERVAL,
+                 threshold=PHI_THRESHOLD, on_rtt=None, on_failure=None):
+        self.address = address
+        # Called with the address of a peer and a round trip time sample
+        self.on_rtt = on_rtt
+        # Called with the address of a peer when it starts being suspected
+        self.on_failure = on_failure
+        self.interval = interval
+        self.threshold = threshold
+        self.peers = {}
+        self.tokens = {}
+        self.next_token = itertools.count(1)
+        self.lock = threading.Lock()
+        self.sock = None
+        self.selector = None
+        self.transport = None
+
+    def is_alive(self, address):
+        '''
+        True or False when the detector knows the peer, None when it must
+        be probed by other means (the answer is then given to observe).
+        '''
+        now = monotonic()
+        state = self.peers.get(address)
+        if state is None:
+            self._watch(address)
+            return None
+        state.last_query = now
+        if state.last_heartbeat is not None and\
+                (state.last_observation is None or
+                 state.last_observation <= state.last_heartbeat):
+            return self._suspect(state, state.phi(now) >= self.threshold)
+        # No heartbeats seen since the last RPC evidence
+        if state.last_observation is not None and\
+                now - state.last_observation < OBSERVATION_TIMEOUT:
+            return state.observed_alive
+        return None
+
+    def observe(self, address, alive):
+        '''
+        Evidence from the RPC layer: a probe to address succeeded or a call
+        to it failed.
+        '''
+        state = self.peers.get(address) or self._watch(address)
+        state.last_observation = monotonic()
+        state.observed_alive = alive
+        if not alive:
+            # Heartbeats received before the failure don't count anymore
+            state.last_heartbeat = None
+        self._suspect(state, not alive)
+
+    def _suspect(self, state, suspected):
+        '''
+        Record whether the peer is suspected, telling on_failure when it
+        starts to be. Returns whether it is alive.
+        '''
+        if suspected and not state.suspected and self.on_failure is not None:
+            self.on_failure(state.address)
+        state.suspected = suspected
+        return not suspected
+
+    def _watch(self, address):
+        with self.lock:
+            state = self.peers.get(address)
+            if state is None:
+                state = PeerState(address, next(self.next_token))
+                self.peers[address] = state
+                self.tokens[state.token] = state
+            return state
+
+    def datagram_received(self, data, addr, sendto):
+        # sendto answers from the address the heartbeat was sent to
+        try:
+            kind, token = HEARTBEAT.unpack(data)
+        except struct.error:
+            return
+        if kind == PING:
+            try:
+                sendto(HEARTBEAT.pack(ACK, token), addr)
+            except (socket.error, ValueError) as e:
+                logging.debug(f"Could not answer {addr}: {e}")
+        elif kind == ACK:
+            state = self.tokens.get(token)
+            if state is not None:
+                now = monotonic()
+                state.heartbeat(now)
+                if self.on_rtt is not None and state.last_ping is not None:
+                    self.on_rtt(state.address, now - state.last_ping)
+
+    def tick(self):
+        '''
+        Heartbeat every watched peer, forgetting those nobody cares about.
+        '''
+        now = monotonic()
+        with self.lock:
+            for state in list(self.peers.values()):
+                if now - state.last_query > MONITOR_TIMEOUT:
+                    self.peers.pop(state.address)
+                    self.tokens.pop(state.token)
+            peers = list(self.peers.values())
+        for state in peers:
+            state.last_ping = now
+            self._sendto(HEARTBEAT.pack(PING, state.token), state.address)
+
+    def _sendto(self, data, address):
+        try:
+            if self.transport is not None:
+                self.transport.sendto(data, address)
+            else:
+                self.sock.sendto(data, address)
+        except (socket.error, ValueError) as e:
+            logging.debug(f"Could not heartbeat {address}: {e}")
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(self.address)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        install(self)
+        threading.Thread(target=self._receive, daemon=True).start()
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    def listen(self, address):
+        '''
+        Also answer the heartbeats sent to address, the port of another\
+        node of the process. Needs start first.
+        '''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(address)
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    def _receive(self):
+        while True:
+            for key, _ in self.selector.select():
+                try:
+                    data, addr = key.fileobj.recvfrom(HEARTBEAT.size)
+                except socket.error:
+                    continue
+                self.datagram_received(data, addr, key.fileobj.sendto)
+
+    def _heartbeat(self):
+        while True:
+            self.tick()
+            sleep(self.interval)
+
+    async def start_async(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: DetectorProtocol(self),
+            local_addr=self.address
+        )
+        install(self)
+        loop.create_task(self._heartbeat_async())
+
+    async def listen_async(self, address):
+        '''
+        Same as listen, on the event loop of the caller.
+        '''
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(
+            lambda: DetectorProtocol(self),
+            local_addr=address
+        )
+
+    async def _heartbeat_async(self):
+        while True:
+            self.tick()
+            await asyncio.sleep(self.interval)
+
+
+class DetectorProtocol(asyncio.DatagramProtocol):
+    def __init__(self, detector):
+        self.detector = detector
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.detector.datagram_received(data, addr, self.transport.sendto)
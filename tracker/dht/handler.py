@@ -1,6 +1,11 @@
 import chord as chord
+import storage
 import argparse
+import logging
+import os
 import re
+import signal
+from time import sleep
 
 
 def main():
@@ -11,18 +16,146 @@ def main():
                             help='url of a known peer of a CHORD ring\
                                  to join this node to'
                             )
+    argsparser.add_argument('-m',
+                            help='engine serving the RPCs',
+                            choices=(chord.THREADED, chord.ASYNC),
+                            default=chord.THREADED
+                            )
+    argsparser.add_argument('-l',
+                            help='how lookups are routed',
+                            choices=(chord.ITERATIVE, chord.RECURSIVE),
+                            default=chord.ITERATIVE
+                            )
+    argsparser.add_argument('-f',
+                            help='how the finger table is refreshed',
+                            choices=(chord.FINGERS_BULK, chord.FINGERS_RANDOM),
+                            default=chord.FINGERS_BULK
+                            )
+    argsparser.add_argument('-w',
+                            type=int,
+                            help='threads serving the requests',
+                            default=chord.WORKERS
+                            )
+    argsparser.add_argument('-q',
+                            type=int,
+                            help='requests waiting for a thread before\
+                                 the node answers busy',
+                            default=chord.WORKERS_QUEUE_SIZE
+                            )
+    argsparser.add_argument('-r',
+                            help='how writes reach the replicas',
+                            choices=(chord.SYNC_REPLICATION,
+                                     chord.LAZY_REPLICATION),
+                            default=chord.SYNC_REPLICATION
+                            )
+    argsparser.add_argument('-n',
+                            type=int,
+                            help='replicas of every key besides its owner',
+                            default=chord.REPLICAS
+                            )
+    argsparser.add_argument('-W',
+                            type=int,
+                            help='replicas that must acknowledge a write\
+                                 before it returns',
+                            default=chord.WRITE_QUORUM
+                            )
+    argsparser.add_argument('-R',
+                            type=int,
+                            help='replicas a read asks for the freshest\
+                                 value (0 reads from the owner only)',
+                            default=chord.READ_QUORUM
+                            )
+    argsparser.add_argument('-v',
+                            type=int,
+                            help='virtual nodes to run, on consecutive\
+                                 ports from the given one',
+                            default=chord.VIRTUAL_NODES
+                            )
+    argsparser.add_argument('-Q',
+                            type=int,
+                            help='bytes of queued messages accepted for a\
+                                 user',
+                            default=chord.QUEUE_QUOTA
+                            )
+    argsparser.add_argument('-M',
+                            type=int,
+                            help='bytes of queued messages accepted for all\
+                                 the users of a node',
+                            default=chord.MESSAGES_QUOTA
+                            )
+    argsparser.add_argument('-e',
+                            type=int,
+                            help='seconds queued messages are kept (0 keeps\
+                                 them until delivered)',
+                            default=chord.MESSAGE_TTL
+                            )
+    argsparser.add_argument('-E',
+                            type=int,
+                            help='seconds values are kept (0 keeps them\
+                                 until replaced)',
+                            default=chord.VALUE_TTL
+                            )
+    argsparser.add_argument('-d',
+                            help='log file keeping the data of the node\
+                                 across restarts (in memory otherwise)'
+                            )
 
     args = argsparser.parse_args()
     ip, port, target_url = args.i, args.p, args.t
     if None in (ip, port):
         print("Suply ip and port for node")
         exit(0)
-    if target_url is None:
-        node = chord.Node(ip, port)
-    else:
+    # The first virtual node keeps the log file given, the others add\
+    #  their number to its name
+    stores = [
+        storage.LogStore(f"{args.d}.{i}" if i else args.d)
+        for i in range(args.v)
+    ] if args.d else None
+    if target_url is not None:
         target_url = target_url.split(':')
-        node = chord.Node(ip, port, (target_url[0], int(target_url[1])))
-    node.start_service()
+        target_url = (target_url[0], int(target_url[1]))
+    nodes = chord.start_virtual_nodes(
+        ip,
+        port,
+        args.v,
+        target_url,
+        args.m,
+        stores,
+        lookup_mode=args.l,
+        fingers_mode=args.f,
+        workers=args.w,
+        queue_size=args.q,
+        replication=args.r,
+        replicas=args.n,
+        write_quorum=args.W,
+        read_quorum=args.R,
+        queue_quota=args.Q,
+        messages_quota=args.M,
+        message_ttl=args.e,
+        value_ttl=args.E
+    )
+
+    def leave(signum, frame):
+        # One virtual node after the other, each one hands its keys to the\
+        #  next, maybe another one of ours on its way out too
+        for node in nodes:
+            try:
+                # Go even if the handoff fails, the replicas keep the keys
+                node.leave(force=True)
+            except Exception:
+                logging.exception(f"{node} could not leave cleanly")
+                node.left.set()
+
+    signal.signal(signal.SIGTERM, leave)
+    # Serve until every node left, on SIGTERM or through the leave RPC.\
+    #  Executors stop taking work once the main thread is gone, stay here.
+    for node in nodes:
+        node.left.wait()
+    sleep(chord.LEAVE_LINGER)
+    for store in stores or ():
+        store.close()
+    logging.shutdown()
+    os._exit(0)
 
 
 if __name__ == '__main__':
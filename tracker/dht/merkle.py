@@ -0,0 +1,204 @@
+'''
+Merkle trees over ranges of the ring.
+
+The range is split in 2^depth buckets of the same width, every leaf hashes
+the keys of a bucket with their value and queued messages, and every inner
+node hashes its two children. Two replicas of a range compare their trees
+top down, descending only into the subtrees that differ, to find the buckets
+they disagree on with a traffic proportional to the differences.
+
+MerkleTrees keeps the trees of the ranges a node compares up to date as its
+store changes, so building them again only hashes the buckets that changed.
+'''
+import threading
+from hashlib import blake2b
+from time import monotonic
+try:
+    from .codec import VALUE, KEY_BYTES
+except ImportError:
+    from codec import VALUE, KEY_BYTES
+
+MAX_KEY = 2**(KEY_BYTES * 8)
+DEPTH = 10
+DIGEST_SIZE = 16
+EMPTY = bytes(DIGEST_SIZE)
+# Seconds a tree nobody asked for is kept up to date, longer than the anti\
+#  entropy rounds are apart
+UNUSED_TREE_TTL = 300
+
+
+def range_size(start, end):
+    # (start, end] covers the whole ring when they are equal
+    return (end - start) % MAX_KEY or MAX_KEY
+
+
+def combine(left, right):
+    if left == EMPTY and right == EMPTY:
+        return EMPTY
+    return blake2b(left + right, digest_size=DIGEST_SIZE).digest()
+
+
+class MerkleTree(object):
+    '''
+    Tree of the keys of a store in the ring interval (start, end]. Level 0
+    is the root, level depth holds the leaves.
+    '''
+    def __init__(self, start, end, depth=DEPTH):
+        self.start = start
+        self.end = end
+        self.depth = depth
+        self.size = range_size(start, end)
+        self.levels = []
+
+    @classmethod
+    def build(cls, store, start, end, depth=DEPTH):
+        tree = cls(start, end, depth)
+        level = [EMPTY] * 2**depth
+        for bucket, digest in tree.hash_keys(
+            store,
+            store.range(start, end)
+        ).items():
+            level[bucket] = digest
+        tree.levels = [level]
+        while len(level) > 1:
+            level = [
+                combine(level[i], level[i + 1])
+                for i in range(0, len(level), 2)
+            ]
+            tree.levels.insert(0, level)
+        return tree
+
+    def hash_keys(self, store, keys):
+        '''
+        Digests of the buckets of the given keys, taken in clockwise order,\
+        from their values and queued messages in store.
+        '''
+        values = dict(store.items(keys))
+        queues = dict(store.queues(keys))
+        hashes = {}
+        for key in keys:
+            entry = bytearray(key.to_bytes(KEY_BYTES, 'big'))
+            VALUE.pack(entry, (key in values, values.get(key),
+                               queues.get(key, [])))
+            bucket = self.bucket(key)
+            try:
+                digest = hashes[bucket]
+            except KeyError:
+                digest = hashes[bucket] = blake2b(digest_size=DIGEST_SIZE)
+            digest.update(len(entry).to_bytes(4, 'big'))
+            digest.update(entry)
+        return {bucket: digest.digest() for bucket, digest in hashes.items()}
+
+    def rehash(self, store, buckets):
+        '''
+        Hash the given buckets again from store, and the nodes above them.
+        '''
+        keys = []
+        for bucket in sorted(buckets):
+            start, end = self.bucket_range(bucket, bucket)
+            # Buckets of ranges narrower than the tree may be empty
+            if start != end:
+                keys += store.range(start, end)
+        digests = self.hash_keys(store, keys)
+        leaves = self.levels[self.depth]
+        for bucket in buckets:
+            leaves[bucket] = digests.get(bucket, EMPTY)
+        indices = set(buckets)
+        for level in range(self.depth - 1, -1, -1):
+            indices = {index // 2 for index in indices}
+            below = self.levels[level + 1]
+            for index in indices:
+                self.levels[level][index] = combine(
+                    below[2 * index],
+                    below[2 * index + 1]
+                )
+
+    def contains(self, key):
+        return (key - self.start - 1) % MAX_KEY < self.size
+
+    def copy(self):
+        tree = MerkleTree(self.start, self.end, self.depth)
+        tree.levels = [list(level) for level in self.levels]
+        return tree
+
+    def node(self, level, index):
+        return self.levels[level][index]
+
+    def bucket(self, key):
+        return ((key - self.start - 1) % MAX_KEY) * 2**self.depth //\
+            self.size
+
+    def bucket_range(self, first, last):
+        '''
+        Ring interval (start, end] covering the buckets first to last.
+        '''
+        leaves = 2**self.depth
+        start = -(-first * self.size // leaves)
+        end = -(-(last + 1) * self.size // leaves)
+        return (self.start + start) % MAX_KEY, (self.start + end) % MAX_KEY
+
+    def diff(self, level, indices, digests):
+        '''
+        Indices of the given nodes of a level whose digests differ from the
+        ones of another tree.
+        '''
+        return [
+            index for index, digest in zip(indices, digests)
+            if digest != self.levels[level][index]
+        ]
+
+
+class MerkleTrees(object):
+    '''
+    Trees of ranges of a store kept up to date as it changes: a change only\
+    marks the bucket of its key dirty in the trees covering it, and asking\
+    for a tree again hashes just the dirty buckets. Trees nobody asked for\
+    in a while are dropped.
+    '''
+    def __init__(self, store, depth=DEPTH, ttl=UNUSED_TREE_TTL):
+        self.store = store
+        self.depth = depth
+        self.ttl = ttl
+        # (start, end) -> (tree, dirty buckets, last asked)
+        self.trees = {}
+        self.lock = threading.Lock()
+        # Serializes the updates, the writes only wait for the lock
+        self.updating = threading.Lock()
+        store.watch(self.changed)
+
+    def __len__(self):
+        return len(self.trees)
+
+    def changed(self, key):
+        with self.lock:
+            for tree, dirty, _ in self.trees.values():
+                if tree.contains(key):
+                    dirty.add(tree.bucket(key))
+
+    def tree(self, start, end):
+        '''
+        Copy of the current tree of the ring interval (start, end].
+        '''
+        with self.updating:
+            now = monotonic()
+            with self.lock:
+                for interval in [
+                    interval for interval, (_, _, asked) in self.trees.items()
+                    if asked + self.ttl < now
+                ]:
+                    del self.trees[interval]
+                tree, dirty, _ = self.trees.get((start, end), (None, None, 0))
+                if tree is None:
+                    # Only the buckets matter for the changes while building
+                    tree = MerkleTree(start, end, self.depth)
+                # Changes from now on are for the next time
+                self.trees[(start, end)] = (tree, set(), now)
+            if dirty is None:
+                built = MerkleTree.build(self.store, start, end, self.depth)
+                with self.lock:
+                    _, dirty, asked = self.trees[(start, end)]
+                    self.trees[(start, end)] = (built, dirty, asked)
+                tree = built
+            elif dirty:
+                tree.rehash(self.store, dirty)
+            return tree.copy()
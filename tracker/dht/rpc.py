@@ -0,0 +1,544 @@
+'''
+Connection management for the CHORD RPC protocol.
+
+Every remote peer gets a pool of long lived sockets. Each request carries an
+id, so several calls in flight can share a single connection: a reader thread
+per connection matches the responses back to the waiting callers.
+
+When the node runs its asyncio engine (see use_event_loop) the connections
+live on the event loop instead, and blocking callers just wait for the
+result of the coroutine.
+'''
+import asyncio
+import itertools
+import logging
+import random
+import socket
+import struct
+import threading
+from time import monotonic, sleep
+try:
+    from .codec import encode_request, decode_response, decode_error
+except ImportError:
+    from codec import encode_request, decode_response, decode_error
+
+RPC_TIMEOUT = 10
+CONNECT_TIMEOUT = 3
+POOL_SIZE = 2
+# Weight of a sample above the current round trip time estimate
+RTT_DECAY = 0.1
+# Busy peers are retried this many times, doubling the wait every time
+BUSY_RETRIES = 4
+BUSY_BACKOFF = 0.05
+
+# Wire format: every message is a fixed size header followed by the body.
+# The header holds the protocol version, the frame flags, the request id the
+# frame belongs to and the length of the body. Bodies are encoded by codec.
+PROTOCOL_VERSION = 2
+FRAME_HEADER = struct.Struct("!BBII")
+FLAG_RESPONSE = 0x01
+FLAG_ERROR = 0x02
+# Requests nobody waits an answer for, the server doesn't reply to them
+FLAG_ONEWAY = 0x04
+# The server had no room to queue the request (sent along FLAG_ERROR, so\
+#  older clients just see a failed request). Safe to retry.
+FLAG_BUSY = 0x08
+MAX_FRAME_SIZE = 64 * 2**20
+READ_BUFFER_SIZE = 64 * 2**10
+# Bodies up to this size are sent along the header in a single syscall
+COALESCE_SIZE = 64 * 2**10
+
+
+class RemoteError(Exception):
+    '''
+    Exception raised when the remote node failed serving the request.
+    '''
+    pass
+
+
+class BusyError(RemoteError):
+    '''
+    Exception raised when the remote node is overloaded and didn't even
+    queue the request.
+    '''
+    pass
+
+
+def busy_backoff(attempt):
+    return BUSY_BACKOFF * 2**attempt * random.uniform(0.5, 1.5)
+
+
+class ProtocolError(ConnectionError):
+    '''
+    Exception raised when the peer sends a malformed frame. The stream can't
+    be trusted after that, so the connection must be dropped.
+    '''
+    pass
+
+
+# Event loop the connections live on, None for the threaded engine
+_event_loop = None
+
+
+def on_event_loop():
+    '''
+    Whether the caller runs an event loop, which a blocking call would stall.
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def use_event_loop(loop):
+    '''
+    Move the outbound connections of this process to the given event loop.
+    '''
+    global _event_loop
+    # Virtual nodes share the process, the loop of the first one keeps the\
+    #  connections of all of them
+    if _event_loop is not None and not _event_loop.is_closed():
+        return
+    _event_loop = loop
+    # The threaded connections opened so far won't be used anymore, the\
+    #  calls in flight on them (like the handoff started by a join) finish\
+    #  first: failing them would make the peers look dead
+    for pool in list(ConnectionPool._pools.values()):
+        pool.retire()
+
+
+def parse_header(header):
+    version, flags, req_id, size = FRAME_HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {size} bytes exceeds the limit")
+    return flags, req_id, size
+
+
+def send_frame(sock, flags, req_id, body):
+    header = FRAME_HEADER.pack(PROTOCOL_VERSION, flags, req_id, len(body))
+    if len(body) <= COALESCE_SIZE:
+        sock.sendall(header + body)
+    else:
+        sock.sendall(header)
+        sock.sendall(body)
+
+
+class FrameReader(object):
+    '''
+    Read frames from a socket straight into preallocated buffers.
+
+    The body returned by read() is a memoryview over an internal buffer that
+    is reused by the next call, so it must be decoded before reading again.
+    '''
+    def __init__(self, sock, buffer_size=READ_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.header = bytearray(FRAME_HEADER.size)
+        self.header_view = memoryview(self.header)
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+    def _recv_into(self, view):
+        received = 0
+        size = len(view)
+        while received < size:
+            count = self.sock.recv_into(view[received:])
+            if not count:
+                raise ConnectionResetError("Connection closed by peer")
+            received += count
+
+    def read(self):
+        self._recv_into(self.header_view)
+        flags, req_id, size = parse_header(self.header)
+
+        if size > len(self.buffer):
+            self.buffer = bytearray(size)
+            self.view = memoryview(self.buffer)
+        elif len(self.buffer) > self.buffer_size and\
+                size <= self.buffer_size:
+            # Don't keep a huge buffer around after a big transfer
+            self.buffer = bytearray(self.buffer_size)
+            self.view = memoryview(self.buffer)
+
+        body = self.view[:size]
+        self._recv_into(body)
+        return flags, req_id, body
+
+
+class PendingCall(object):
+    '''
+    Slot where the reader thread leaves the response of a request.
+    '''
+    __slots__ = ('command', 'event', 'ok', 'value')
+
+    def __init__(self, command):
+        self.command = command
+        self.event = threading.Event()
+        self.ok = False
+        self.value = None
+
+    def resolve(self, ok, value):
+        self.ok = ok
+        self.value = value
+        self.event.set()
+
+
+class Connection(object):
+    '''
+    A persistent, multiplexed connection to a remote node.
+    '''
+    def __init__(self, address):
+        self.address = address
+        self.sock = socket.create_connection(address, CONNECT_TIMEOUT)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.reader = FrameReader(self.sock)
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count()
+        self.closed = False
+        # Closing once the calls in flight are answered, see retire
+        self.retiring = False
+        threading.Thread(target=self._read_responses, daemon=True).start()
+
+    def __str__(self):
+        return "<Connection %s:%d>" % self.address
+
+    def in_flight(self):
+        return len(self.pending)
+
+    def call(self, request, timeout=RPC_TIMEOUT):
+        pending = PendingCall(request[0])
+        body = encode_request(request)
+        with self.lock:
+            if self.closed:
+                raise ConnectionResetError(f"{self} is closed")
+            req_id = next(self.ids) & 0xFFFFFFFF
+            self.pending[req_id] = pending
+        try:
+            with self.send_lock:
+                send_frame(self.sock, 0, req_id, body)
+        except socket.error:
+            self.close()
+            raise
+
+        if not pending.event.wait(timeout):
+            with self.lock:
+                self.pending.pop(req_id, None)
+                idle = self.retiring and not self.pending
+            if idle:
+                self.close()
+            raise socket.timeout(f"No response from {self} to {request[0]}")
+        if pending.ok:
+            return pending.value
+        raise pending.value
+
+    def send(self, request):
+        body = encode_request(request)
+        with self.lock:
+            if self.closed:
+                raise ConnectionResetError(f"{self} is closed")
+            req_id = next(self.ids) & 0xFFFFFFFF
+        try:
+            with self.send_lock:
+                send_frame(self.sock, FLAG_ONEWAY, req_id, body)
+        except socket.error:
+            self.close()
+            raise
+
+    def _read_responses(self):
+        try:
+            while True:
+                flags, req_id, body = self.reader.read()
+                with self.lock:
+                    pending = self.pending.pop(req_id, None)
+                    idle = self.retiring and not self.pending
+                # Late responses of timed out requests are dropped
+                if pending is None:
+                    if idle:
+                        break
+                    continue
+                if flags & FLAG_BUSY:
+                    pending.resolve(False, BusyError(f"{self} is busy"))
+                elif flags & FLAG_ERROR:
+                    pending.resolve(False, RemoteError(decode_error(body)))
+                else:
+                    try:
+                        value = decode_response(pending.command, body)
+                        pending.resolve(True, value)
+                    except Exception as e:
+                        pending.resolve(False, RemoteError(
+                            f"Bad response to {pending.command}: {e}"))
+                if idle:
+                    break
+        except (socket.error, EOFError):
+            pass
+        finally:
+            self.close()
+
+    def retire(self):
+        '''
+        Close the connection once the calls in flight are answered. The\
+        pool no longer hands it out.
+        '''
+        with self.lock:
+            self.retiring = True
+            idle = not self.pending
+        if idle:
+            self.close()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        for call in pending.values():
+            call.resolve(False, ConnectionResetError(f"{self} was closed"))
+
+
+def write_frame(writer, flags, req_id, body):
+    writer.write(
+        FRAME_HEADER.pack(PROTOCOL_VERSION, flags, req_id, len(body))
+    )
+    writer.write(body)
+
+
+async def read_frame(reader):
+    flags, req_id, size = parse_header(
+        await reader.readexactly(FRAME_HEADER.size)
+    )
+    body = await reader.readexactly(size)
+    return flags, req_id, body
+
+
+class AsyncConnection(object):
+    '''
+    A persistent, multiplexed connection living on the event loop.
+    '''
+    def __init__(self, address, reader, writer):
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.ids = itertools.count()
+        self.closed = False
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        asyncio.ensure_future(self._read_responses())
+
+    @classmethod
+    async def open(cls, address):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(*address),
+            CONNECT_TIMEOUT
+        )
+        return cls(address, reader, writer)
+
+    def __str__(self):
+        return "<AsyncConnection %s:%d>" % self.address
+
+    def in_flight(self):
+        return len(self.pending)
+
+    async def call(self, request, timeout=RPC_TIMEOUT):
+        if self.closed:
+            raise ConnectionResetError(f"{self} is closed")
+        command = request[0]
+        body = encode_request(request)
+        req_id = next(self.ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self.pending[req_id] = (command, future)
+        try:
+            write_frame(self.writer, 0, req_id, body)
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout(f"No response from {self} to {command}")
+        finally:
+            self.pending.pop(req_id, None)
+
+    async def send(self, request):
+        if self.closed:
+            raise ConnectionResetError(f"{self} is closed")
+        body = encode_request(request)
+        req_id = next(self.ids) & 0xFFFFFFFF
+        write_frame(self.writer, FLAG_ONEWAY, req_id, body)
+        await self.writer.drain()
+
+    async def _read_responses(self):
+        try:
+            while True:
+                flags, req_id, body = await read_frame(self.reader)
+                command, future = self.pending.pop(req_id, (None, None))
+                # Late responses of timed out requests are dropped
+                if future is None or future.done():
+                    continue
+                if flags & FLAG_BUSY:
+                    future.set_exception(BusyError(f"{self} is busy"))
+                    continue
+                if flags & FLAG_ERROR:
+                    future.set_exception(RemoteError(decode_error(body)))
+                    continue
+                try:
+                    future.set_result(decode_response(command, body))
+                except Exception as e:
+                    future.set_exception(RemoteError(
+                        f"Bad response to {command}: {e}"))
+        except (asyncio.IncompleteReadError, socket.error):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        pending, self.pending = self.pending, {}
+        for _, future in pending.values():
+            if not future.done():
+                future.set_exception(
+                    ConnectionResetError(f"{self} was closed")
+                )
+
+
+class ConnectionPool(object):
+    '''
+    Pool of persistent connections to a single peer, shared by every
+    reference to that peer in the process.
+    '''
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    @classmethod
+    def for_address(cls, address):
+        with cls._pools_lock:
+            try:
+                return cls._pools[address]
+            except KeyError:
+                pool = cls._pools[address] = cls(address)
+                return pool
+
+    def __init__(self, address, size=POOL_SIZE):
+        self.address = address
+        self.size = size
+        self.connections = []
+        self.lock = threading.Lock()
+        self.async_connections = []
+        self.async_lock = None
+        self.rtt = None
+
+    def record_rtt(self, sample):
+        '''
+        Update the round trip time estimate of the peer. Samples include the
+        time the peer took serving the request, so the estimate follows the
+        lowest ones right away and the higher ones only slowly.
+        '''
+        if self.rtt is None or sample < self.rtt:
+            self.rtt = sample
+        else:
+            self.rtt += RTT_DECAY * (sample - self.rtt)
+
+    def connection(self):
+        with self.lock:
+            self.connections = [c for c in self.connections if not c.closed]
+            idle = [c for c in self.connections if not c.in_flight()]
+            if idle:
+                return idle[0]
+            if len(self.connections) < self.size:
+                conn = Connection(self.address)
+                logging.debug(f"Opened {conn}")
+                self.connections.append(conn)
+                return conn
+            return min(self.connections, key=Connection.in_flight)
+
+    async def async_connection(self):
+        # Only touched from the event loop thread
+        if self.async_lock is None:
+            self.async_lock = asyncio.Lock()
+        async with self.async_lock:
+            self.async_connections = [
+                c for c in self.async_connections if not c.closed
+            ]
+            idle = [c for c in self.async_connections if not c.in_flight()]
+            if idle:
+                return idle[0]
+            if len(self.async_connections) < self.size:
+                conn = await AsyncConnection.open(self.address)
+                logging.debug(f"Opened {conn}")
+                self.async_connections.append(conn)
+                return conn
+            return min(self.async_connections, key=AsyncConnection.in_flight)
+
+    async def call_async(self, request, timeout=RPC_TIMEOUT):
+        for attempt in range(BUSY_RETRIES):
+            start = monotonic()
+            conn = await self.async_connection()
+            try:
+                response = await conn.call(request, timeout)
+            except BusyError:
+                await asyncio.sleep(busy_backoff(attempt))
+                continue
+            self.record_rtt(monotonic() - start)
+            return response
+        conn = await self.async_connection()
+        return await conn.call(request, timeout)
+
+    async def send_async(self, request):
+        conn = await self.async_connection()
+        await conn.send(request)
+
+    def call(self, request, timeout=RPC_TIMEOUT):
+        loop = _event_loop
+        if loop is None:
+            for attempt in range(BUSY_RETRIES):
+                start = monotonic()
+                try:
+                    response = self.connection().call(request, timeout)
+                except BusyError:
+                    sleep(busy_backoff(attempt))
+                    continue
+                self.record_rtt(monotonic() - start)
+                return response
+            return self.connection().call(request, timeout)
+        # Blocking callers never run on the loop thread, they are served by\
+        #  the executor of the node.
+        return asyncio.run_coroutine_threadsafe(
+            self.call_async(request, timeout),
+            loop
+        ).result()
+
+    def send(self, request):
+        '''
+        Send a one way request, returns as soon as it is on the wire.
+        '''
+        loop = _event_loop
+        if loop is None:
+            return self.connection().send(request)
+        return asyncio.run_coroutine_threadsafe(
+            self.send_async(request),
+            loop
+        ).result()
+
+    def retire(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.retire()
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
@@ -0,0 +1,759 @@
+'''
+Storage engines for the keys and message queues held by a CHORD node.
+
+Queued messages are (sequence number, message) pairs kept in order, so they
+can be read a page at a time and trimmed once acknowledged.
+
+Stores account the bytes taken by every queue and by all of them, so nodes
+can put a quota on them.
+
+MemoryStore keeps the values in a python dict, as nodes always did, and
+packs the queued messages in a MessageArena. LogStore
+appends every change to a log file and only keeps in memory where the live
+records are, so a restarted node finds its data again and long offline
+queues don't grow the memory of the process. The log is compacted, copying
+the live records to a new file, once most of it is garbage.
+
+Stores also keep a small meta value for the node, like its place in the
+ring, so a restarted node can find its way back.
+'''
+import os
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from operator import itemgetter
+try:
+    from .codec import VALUE, KEY_BYTES
+except ImportError:
+    from codec import VALUE, KEY_BYTES
+
+# Log records: operation, key, payload size and payload checksum, followed\
+#  by the payload: a value encoded by codec, preceded by its sequence number\
+#  for queued messages, or the sequence numbers acknowledged (up to) or\
+#  dropped
+RECORD = struct.Struct(f"!B{KEY_BYTES}sII")
+SEQUENCE = struct.Struct("!q")
+PUT, REMOVE, ENQUEUE, CLEAR, ACK, UNSET, DROP = range(1, 8)
+# Compact when there are at least this many garbage bytes and they are more\
+#  than the live ones
+COMPACTION_MIN_GARBAGE = 2**20
+COMPACTION_RATIO = 1.0
+# Same for the message arenas, which are compacted in memory
+ARENA_MIN_GARBAGE = 2**16
+
+
+class QuotaError(Exception):
+    '''
+    Exception raised when a message doesn't fit in the quota of its queue
+    or in the one of all the queues of the store.
+    '''
+    pass
+
+
+class KeyIndex(object):
+    '''
+    Sorted list of the stored keys, to extract ranges of the ring.
+    '''
+    def __init__(self, keys=()):
+        self.keys = sorted(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        i = bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            self.keys.insert(i, key)
+
+    def discard(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+    def range(self, start, end, limit=None):
+        '''
+        Keys in the ring interval (start, end], walking clockwise from start.\
+        The interval wraps around zero when end <= start, and covers the\
+        whole ring when they are equal. At most limit keys if given.
+        '''
+        first = bisect_right(self.keys, start)
+        last = bisect_right(self.keys, end)
+        if start < end:
+            if limit is not None:
+                last = min(last, first + limit)
+            return self.keys[first:last]
+        keys = self.keys[first:first + limit] if limit is not None else\
+            self.keys[first:]
+        if limit is not None:
+            last = min(last, limit - len(keys))
+        return keys + self.keys[:last]
+
+
+class Store(object):
+    '''
+    Values and message queues by key. Every store keeps a KeyIndex of the\
+    keys holding a value or a queue.
+    '''
+    # Whether reads and writes go to a file, blocking on the disk
+    persistent = False
+    # Callbacks told about every change, see watch
+    watchers = ()
+
+    def watch(self, callback):
+        '''
+        Call callback(key) after every change to the value or the queue of\
+        key. It runs under the lock of the store, it must be quick and leave\
+        the store alone.
+        '''
+        self.watchers += (callback,)
+
+    def _changed(self, key):
+        for callback in self.watchers:
+            callback(key)
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def put(self, key, value):
+        raise NotImplementedError
+
+    def remove(self, key):
+        '''
+        Drop both the value and the queue of key.
+        '''
+        raise NotImplementedError
+
+    def enqueue(self, key, entry, queue_quota=None, total_quota=None):
+        '''
+        Queue the (sequence, message) entry in order. Sequence numbers\
+        already queued are ignored, replicas may get an entry twice. Raises\
+        QuotaError, queueing nothing, when the queue would take more than\
+        queue_quota bytes or all the queues more than total_quota.
+        '''
+        raise NotImplementedError
+
+    def dequeue(self, key):
+        '''
+        Empty the queue of key, returning its entries.
+        '''
+        raise NotImplementedError
+
+    def fetch(self, key, after, limit):
+        '''
+        First limit entries of the queue of key with a sequence number\
+        greater than after.
+        '''
+        raise NotImplementedError
+
+    def ack(self, key, upto):
+        '''
+        Drop the entries of the queue of key up to the sequence number upto.
+        '''
+        raise NotImplementedError
+
+    def discard_value(self, key):
+        '''
+        Drop the value of key, keeping its queue.
+        '''
+        raise NotImplementedError
+
+    def discard_messages(self, key, seqs):
+        '''
+        Drop the entries of the queue of key with the given sequence numbers.
+        '''
+        raise NotImplementedError
+
+    def queue_size(self, key):
+        '''
+        Bytes taken by the queue of key. messages_size has the total.
+        '''
+        raise NotImplementedError
+
+    def _check_quota(self, key, size, queue_quota, total_quota):
+        if queue_quota is not None and\
+                self.queue_size(key) + size > queue_quota:
+            raise QuotaError(f"The queue of {key:x} is full")
+        if total_quota is not None and\
+                self.messages_size + size > total_quota:
+            raise QuotaError("No room left for messages")
+
+    def remove_many(self, keys):
+        for key in keys:
+            self.remove(key)
+
+    def range(self, start, end, limit=None):
+        '''
+        Stored keys in the ring interval (start, end], see KeyIndex.range.
+        '''
+        return self.index.range(start, end, limit)
+
+    def items(self, keys=None):
+        '''
+        (key, value) pairs of the stored values, only of the given keys if\
+        any.
+        '''
+        raise NotImplementedError
+
+    def queues(self, keys=None):
+        '''
+        (key, entries) pairs of the message queues, only of the given keys\
+        if any.
+        '''
+        raise NotImplementedError
+
+    def load_meta(self):
+        '''
+        The last value given to save_meta, None if there is none.
+        '''
+        raise NotImplementedError
+
+    def save_meta(self, meta):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MessageArena(object):
+    '''
+    Message queues packed in one bytearray as length prefixed records: the\
+    sequence number, the size and the message encoded by codec. A queue is\
+    an array with the offsets of its records in sequence order, so queued\
+    messages take little more than their encoding instead of a few python\
+    objects each. Dropped records are garbage until the arena is compacted.
+    '''
+    HEADER = struct.Struct("!qI")
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = {}
+        self.sizes = {}
+        # Bytes of the live records
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def keys(self):
+        return list(self.offsets)
+
+    def encode(self, seq, msg):
+        record = bytearray(self.HEADER.size)
+        VALUE.pack(record, msg)
+        self.HEADER.pack_into(record, 0, seq, len(record) - self.HEADER.size)
+        return record
+
+    def seq(self, offset):
+        return self.HEADER.unpack_from(self.data, offset)[0]
+
+    def record_size(self, offset):
+        return self.HEADER.size + self.HEADER.unpack_from(self.data, offset)[1]
+
+    def contains(self, key, seq):
+        offsets = self.offsets.get(key, ())
+        i = bisect_left(offsets, seq, key=self.seq)
+        return i < len(offsets) and self.seq(offsets[i]) == seq
+
+    def add(self, key, seq, record):
+        offsets = self.offsets.get(key)
+        if offsets is None:
+            offsets = self.offsets[key] = array('q')
+        if offsets and self.seq(offsets[-1]) > seq:
+            offsets.insert(bisect_left(offsets, seq, key=self.seq),
+                           len(self.data))
+        else:
+            offsets.append(len(self.data))
+        self.data += record
+        self.sizes[key] = self.sizes.get(key, 0) + len(record)
+        self.size += len(record)
+
+    def read(self, offsets):
+        entries = []
+        with memoryview(self.data) as view:
+            for offset in offsets:
+                seq, _ = self.HEADER.unpack_from(view, offset)
+                msg, _ = VALUE.unpack(view, offset + self.HEADER.size)
+                entries.append((seq, msg))
+        return entries
+
+    def entries(self, key):
+        return self.read(self.offsets.get(key, ()))
+
+    def fetch(self, key, after, limit):
+        offsets = self.offsets.get(key, ())
+        first = bisect_right(offsets, after, key=self.seq)
+        return self.read(offsets[first:first + limit])
+
+    def trim(self, key, upto):
+        '''
+        Drop the records of key up to the sequence number upto.
+        '''
+        offsets = self.offsets.get(key)
+        if not offsets:
+            return
+        count = bisect_right(offsets, upto, key=self.seq)
+        freed = sum(self.record_size(offset) for offset in offsets[:count])
+        del offsets[:count]
+        self.sizes[key] -= freed
+        self.size -= freed
+        if not offsets:
+            self.discard(key)
+
+    def drop(self, key, seqs):
+        '''
+        Drop the records of key with the given sequence numbers.
+        '''
+        offsets = self.offsets.get(key)
+        if not offsets:
+            return
+        seqs = set(seqs)
+        kept = array('q')
+        freed = 0
+        for offset in offsets:
+            if self.seq(offset) in seqs:
+                freed += self.record_size(offset)
+            else:
+                kept.append(offset)
+        self.offsets[key] = kept
+        self.sizes[key] -= freed
+        self.size -= freed
+        if not kept:
+            self.discard(key)
+
+    def discard(self, key):
+        self.offsets.pop(key, None)
+        self.size -= self.sizes.pop(key, 0)
+
+    def maybe_compact(self):
+        garbage = len(self.data) - self.size
+        if not self.size:
+            self.data = bytearray()
+        elif garbage >= ARENA_MIN_GARBAGE and\
+                garbage > COMPACTION_RATIO * self.size:
+            self.compact()
+
+    def compact(self):
+        '''
+        Copy the live records to a new arena.
+        '''
+        data = bytearray()
+        with memoryview(self.data) as view:
+            for offsets in self.offsets.values():
+                for i, offset in enumerate(offsets):
+                    end = offset + self.record_size(offset)
+                    offsets[i] = len(data)
+                    data += view[offset:end]
+        self.data = data
+
+
+class MemoryStore(Store):
+    def __init__(self):
+        self.values = {}
+        self.messages = MessageArena()
+        self.index = KeyIndex()
+        self.lock = threading.Lock()
+        self.meta = None
+
+    @property
+    def messages_size(self):
+        return self.messages.size
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def put(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            self.index.add(key)
+            self._changed(key)
+
+    def remove(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+            self.messages.discard(key)
+            self.messages.maybe_compact()
+            self.index.discard(key)
+            self._changed(key)
+
+    def enqueue(self, key, entry, queue_quota=None, total_quota=None):
+        seq, msg = entry
+        record = self.messages.encode(seq, msg)
+        with self.lock:
+            if self.messages.contains(key, seq):
+                return
+            self._check_quota(key, len(record), queue_quota, total_quota)
+            self.messages.add(key, seq, record)
+            self.index.add(key)
+            self._changed(key)
+
+    def dequeue(self, key):
+        with self.lock:
+            messages = self.messages.entries(key)
+            self.messages.discard(key)
+            self.messages.maybe_compact()
+            if key not in self.values:
+                self.index.discard(key)
+            self._changed(key)
+            return messages
+
+    def fetch(self, key, after, limit):
+        with self.lock:
+            return self.messages.fetch(key, after, limit)
+
+    def ack(self, key, upto):
+        with self.lock:
+            self.messages.trim(key, upto)
+            self.messages.maybe_compact()
+            if key not in self.messages and key not in self.values:
+                self.index.discard(key)
+            self._changed(key)
+
+    def discard_value(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+            if key not in self.messages:
+                self.index.discard(key)
+            self._changed(key)
+
+    def discard_messages(self, key, seqs):
+        with self.lock:
+            self.messages.drop(key, seqs)
+            self.messages.maybe_compact()
+            if key not in self.messages and key not in self.values:
+                self.index.discard(key)
+            self._changed(key)
+
+    def queue_size(self, key):
+        return self.messages.sizes.get(key, 0)
+
+    def load_meta(self):
+        return self.meta
+
+    def save_meta(self, meta):
+        self.meta = meta
+
+    def items(self, keys=None):
+        if keys is None:
+            return list(self.values.items())
+        return [(key, self.values[key]) for key in keys if key in self.values]
+
+    def queues(self, keys=None):
+        with self.lock:
+            if keys is None:
+                keys = self.messages.keys()
+            return [
+                (key, self.messages.entries(key))
+                for key in keys if key in self.messages
+            ]
+
+
+class LogStore(Store):
+    '''
+    Append only log with an in memory index. The index maps every key to
+    the position of its value and of its queued messages in the log, the
+    latter along with their sequence numbers.
+    '''
+    persistent = True
+
+    def __init__(self, path, sync=False):
+        self.path = path
+        # fsync after every write, to survive crashes of the machine and\
+        #  not only of the process
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.values = {}
+        self.messages = {}
+        self.index = KeyIndex()
+        self.live = 0
+        self.queue_sizes = {}
+        self.messages_size = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = self._load()
+
+    def _load(self):
+        with open(self.path, 'rb') as log:
+            data = log.read()
+        view = memoryview(data)
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            op, key, size, checksum = RECORD.unpack_from(view, offset)
+            start = offset + RECORD.size
+            payload = view[start:start + size]
+            if len(payload) < size or zlib.crc32(payload) != checksum:
+                break
+            if op in (ENQUEUE, ACK):
+                seq = SEQUENCE.unpack_from(payload)[0]
+            elif op == DROP:
+                seq = {seq for seq, in SEQUENCE.iter_unpack(payload)}
+            else:
+                seq = None
+            self._apply(op, int.from_bytes(key, 'big'), start, size, seq)
+            offset = start + size
+        self.index = KeyIndex(self.values.keys() | self.messages.keys())
+        if offset < len(data):
+            # Torn write of the last record, the process died writing it
+            os.ftruncate(self.fd, offset)
+        return offset
+
+    def _apply(self, op, key, offset, size, seq=None):
+        # seq is the sequence number of the message queued or acknowledged,\
+        #  or the set of them for DROP. The key index is left to the caller,\
+        #  a replay builds it once at the end.
+        record_size = RECORD.size + size
+        if op == PUT:
+            old = self.values.get(key)
+            if old is not None:
+                self.live -= RECORD.size + old[1]
+            self.values[key] = (offset, size)
+            self.live += record_size
+        elif op == ENQUEUE:
+            positions = self.messages.setdefault(key, [])
+            if positions and positions[-1][2] > seq:
+                insort(positions, (offset, size, seq), key=itemgetter(2))
+            else:
+                positions.append((offset, size, seq))
+            self.live += record_size
+            self._account(key, record_size)
+        elif op in (ACK, DROP):
+            positions = self.messages.get(key, [])
+            if op == ACK:
+                count = bisect_right(positions, seq, key=itemgetter(2))
+                dropped, kept = positions[:count], positions[count:]
+            else:
+                dropped = [p for p in positions if p[2] in seq]
+                kept = [p for p in positions if p[2] not in seq]
+            for _, msg_size, _ in dropped:
+                self.live -= RECORD.size + msg_size
+                self._account(key, -RECORD.size - msg_size)
+            if kept:
+                self.messages[key] = kept
+            else:
+                self.messages.pop(key, None)
+        elif op == UNSET:
+            old = self.values.pop(key, None)
+            if old is not None:
+                self.live -= RECORD.size + old[1]
+        else:
+            old = self.values.pop(key, None) if op == REMOVE else None
+            if old is not None:
+                self.live -= RECORD.size + old[1]
+            for _, msg_size, _ in self.messages.pop(key, ()):
+                self.live -= RECORD.size + msg_size
+                self._account(key, -RECORD.size - msg_size)
+
+    def _account(self, key, size):
+        self.messages_size += size
+        size += self.queue_sizes.get(key, 0)
+        if size:
+            self.queue_sizes[key] = size
+        else:
+            self.queue_sizes.pop(key, None)
+
+    def _append(self, op, key, payload=b'', seq=None):
+        record = RECORD.pack(
+            op,
+            key.to_bytes(KEY_BYTES, 'big'),
+            len(payload),
+            zlib.crc32(payload)
+        ) + payload
+        os.write(self.fd, record)
+        if self.sync:
+            os.fsync(self.fd)
+        offset = self.size + RECORD.size
+        self.size += len(record)
+        self._apply(op, key, offset, len(payload), seq)
+        if key in self.values or key in self.messages:
+            self.index.add(key)
+        else:
+            self.index.discard(key)
+        self._changed(key)
+
+    def _read(self, position):
+        offset, size = position
+        data = os.pread(self.fd, size, offset)
+        return VALUE.unpack(memoryview(data), 0)[0]
+
+    def _read_entry(self, position):
+        offset, size, seq = position
+        data = os.pread(self.fd, size, offset)
+        return seq, VALUE.unpack(memoryview(data), SEQUENCE.size)[0]
+
+    def get(self, key, default=None):
+        with self.lock:
+            position = self.values.get(key)
+            if position is None:
+                return default
+            return self._read(position)
+
+    def put(self, key, value):
+        payload = bytearray()
+        VALUE.pack(payload, value)
+        with self.lock:
+            self._append(PUT, key, payload)
+            self._maybe_compact()
+
+    def remove(self, key):
+        self.remove_many((key,))
+
+    def remove_many(self, keys):
+        with self.lock:
+            for key in keys:
+                if key in self.values or key in self.messages:
+                    self._append(REMOVE, key)
+            self._maybe_compact()
+
+    def enqueue(self, key, entry, queue_quota=None, total_quota=None):
+        seq, msg = entry
+        payload = bytearray(SEQUENCE.pack(seq))
+        VALUE.pack(payload, msg)
+        with self.lock:
+            positions = self.messages.get(key, [])
+            i = bisect_left(positions, seq, key=itemgetter(2))
+            if i < len(positions) and positions[i][2] == seq:
+                return
+            self._check_quota(key, RECORD.size + len(payload), queue_quota,
+                              total_quota)
+            self._append(ENQUEUE, key, payload, seq)
+            self._maybe_compact()
+
+    def dequeue(self, key):
+        with self.lock:
+            positions = self.messages.get(key)
+            if not positions:
+                return []
+            messages = [self._read_entry(position) for position in positions]
+            self._append(CLEAR, key)
+            self._maybe_compact()
+            return messages
+
+    def fetch(self, key, after, limit):
+        with self.lock:
+            positions = self.messages.get(key, [])
+            first = bisect_right(positions, after, key=itemgetter(2))
+            return [
+                self._read_entry(position)
+                for position in positions[first:first + limit]
+            ]
+
+    def ack(self, key, upto):
+        with self.lock:
+            positions = self.messages.get(key)
+            if not positions or positions[0][2] > upto:
+                return
+            self._append(ACK, key, SEQUENCE.pack(upto), upto)
+            self._maybe_compact()
+
+    def discard_value(self, key):
+        with self.lock:
+            if key in self.values:
+                self._append(UNSET, key)
+                self._maybe_compact()
+
+    def discard_messages(self, key, seqs):
+        with self.lock:
+            positions = self.messages.get(key, [])
+            seqs = [p[2] for p in positions if p[2] in set(seqs)]
+            if seqs:
+                payload = b''.join(SEQUENCE.pack(seq) for seq in seqs)
+                self._append(DROP, key, payload, set(seqs))
+                self._maybe_compact()
+
+    def queue_size(self, key):
+        return self.queue_sizes.get(key, 0)
+
+    def load_meta(self):
+        # Kept in a file next to the log, replaced whole on every save
+        try:
+            with open(self.path + ".meta", 'rb') as meta:
+                data = meta.read()
+        except FileNotFoundError:
+            return None
+        return VALUE.unpack(memoryview(data), 0)[0]
+
+    def save_meta(self, meta):
+        data = bytearray()
+        VALUE.pack(data, meta)
+        path = self.path + ".meta.tmp"
+        with open(path, 'wb') as tmp:
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(path, self.path + ".meta")
+
+    def items(self, keys=None):
+        with self.lock:
+            if keys is None:
+                keys = list(self.values)
+            return [
+                (key, self._read(self.values[key]))
+                for key in keys if key in self.values
+            ]
+
+    def queues(self, keys=None):
+        with self.lock:
+            if keys is None:
+                keys = list(self.messages)
+            return [
+                (key, [self._read_entry(position) for position in
+                       self.messages[key]])
+                for key in keys if key in self.messages
+            ]
+
+    def _maybe_compact(self):
+        garbage = self.size - self.live
+        if garbage >= COMPACTION_MIN_GARBAGE and\
+                garbage > COMPACTION_RATIO * self.live:
+            self._compact()
+
+    def compact(self):
+        '''
+        Rewrite the log with only the live records.
+        '''
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        path = self.path + ".compact"
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        values, messages = {}, {}
+        size = 0
+        try:
+            records = [
+                (PUT, key, position + (None,))
+                for key, position in self.values.items()
+            ]
+            for key, positions in self.messages.items():
+                messages[key] = []
+                records += [(ENQUEUE, key, position) for position in positions]
+            for op, key, (offset, payload_size, seq) in records:
+                payload = os.pread(self.fd, payload_size, offset)
+                record = RECORD.pack(
+                    op,
+                    key.to_bytes(KEY_BYTES, 'big'),
+                    payload_size,
+                    zlib.crc32(payload)
+                ) + payload
+                os.write(fd, record)
+                position = (size + RECORD.size, payload_size)
+                if op == PUT:
+                    values[key] = position
+                else:
+                    messages[key].append(position + (seq,))
+                size += len(record)
+            os.fsync(fd)
+        except BaseException:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        os.close(fd)
+        os.replace(path, self.path)
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+        self.values, self.messages = values, messages
+        self.size = self.live = size
+
+    def close(self):
+        with self.lock:
+            os.close(self.fd)
@@ -0,0 +1,141 @@
+'''
+CHORD nodes running in their own processes, for the tests that need the
+RPCs to go over the wire between them.
+'''
+import os
+import socket
+import subprocess
+import sys
+from time import monotonic, sleep
+
+from tracker.dht import chord
+
+HANDLER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "handler.py"
+)
+HOST = "127.0.0.1"
+START_TIMEOUT = 10
+STABLE_TIMEOUT = 30
+
+
+def bindable(port):
+    # Nodes listen on the same port over TCP and UDP
+    with socket.socket() as tcp, \
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+        try:
+            tcp.bind((HOST, port))
+            udp.bind((HOST, port))
+        except OSError:
+            return False
+        return True
+
+
+def free_port(count=1):
+    '''
+    First of count consecutive ports free on HOST.
+    '''
+    while True:
+        with socket.socket() as tcp:
+            tcp.bind((HOST, 0))
+            port = tcp.getsockname()[1]
+        if port + count <= 65536 and\
+                all(bindable(port + i) for i in range(count)):
+            return port
+
+
+def wait_for(predicate, timeout, message):
+    deadline = monotonic() + timeout
+    while not predicate():
+        if monotonic() > deadline:
+            raise AssertionError(message)
+        sleep(0.1)
+
+
+class Cluster(object):
+    '''
+    Processes running handler.py, killed on close. Each one logs to its\
+    own file in log_dir.
+    '''
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.processes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self, *args, join=None):
+        '''
+        Start a node with the extra handler arguments, joining the node\
+        join if given. Returns its reference once it serves.
+        '''
+        return self.start_virtual(1, *args, join=join)[0]
+
+    def start_virtual(self, count, *args, join=None):
+        '''
+        Same as start for a process running count virtual nodes, returns\
+        the reference of every one.
+        '''
+        port = free_port(count)
+        command = [sys.executable, HANDLER, "-i", HOST, "-p", str(port),
+                   "-v", str(count)]
+        if join is not None:
+            command += ["-t", f"{join.ip}:{join.port}"]
+        log = open(os.path.join(self.log_dir, f"node-{port}.log"), "wb")
+        process = subprocess.Popen(
+            command + list(args),
+            stdout=log,
+            stderr=subprocess.STDOUT
+        )
+        log.close()
+        nodes = []
+        for i in range(count):
+            self.processes[port + i] = process
+            node = chord.RemoteNodeReference(HOST, port + i)
+            wait_for(lambda: self.answers(node), START_TIMEOUT,
+                     f"{node} did not start")
+            nodes.append(node)
+        return nodes
+
+    def answers(self, node):
+        if self.processes[node.port].poll() is not None:
+            raise AssertionError(f"{node} exited")
+        try:
+            return node.pool.call(("ping",), chord.PING_TIMEOUT)
+        except (socket.error, chord.RemoteError):
+            return False
+
+    def wait_stable(self, nodes):
+        '''
+        Wait until every node has the next one in id order as succesor and\
+        the previous one as predecessor.
+        '''
+        ring = sorted(nodes, key=lambda node: node.id())
+
+        def stable():
+            for pred, node, succ in zip(
+                ring[-1:] + ring[:-1], ring, ring[1:] + ring[:1]
+            ):
+                try:
+                    if node.succesor().id() != succ.id():
+                        return False
+                    current = node.predecessor()
+                    if current is None or current.id() != pred.id():
+                        return False
+                except (socket.error, chord.RemoteError):
+                    return False
+            return True
+
+        wait_for(stable, STABLE_TIMEOUT, "The ring did not stabilize")
+
+    def exited(self, node):
+        return self.processes[node.port].poll() is not None
+
+    def close(self):
+        for process in set(self.processes.values()):
+            if process.poll() is None:
+                process.kill()
+            process.wait()
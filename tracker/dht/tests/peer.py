@@ -0,0 +1,82 @@
+'''
+A fake peer speaking the RPC protocol, for the tests of the client side and
+of a node talking to peers that misbehave.
+'''
+import socket
+import threading
+
+from tracker.dht import rpc
+from tracker.dht.codec import decode_request, encode_error, encode_response
+
+
+class Peer(object):
+    '''
+    Serves every request on its own thread with handler(command, args),\
+    answering an error when it raises, busy for BusyError. Requests are\
+    recorded in order.
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.address = self.sock.getsockname()
+        self.connections = []
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections.append(client)
+            threading.Thread(target=self.serve, args=(client,),
+                             daemon=True).start()
+
+    def serve(self, client):
+        reader = rpc.FrameReader(client)
+        lock = threading.Lock()
+        while True:
+            try:
+                flags, req_id, body = reader.read()
+            except (OSError, EOFError):
+                return
+            request = decode_request(body)
+            self.requests.append(request)
+            threading.Thread(
+                target=self.answer,
+                args=(client, lock, flags, req_id, request),
+                daemon=True
+            ).start()
+
+    def answer(self, client, lock, flags, req_id, request):
+        command, args = request[0], request[1:]
+        try:
+            flags_out = rpc.FLAG_RESPONSE
+            body = encode_response(command, self.handler(command, args))
+        except Exception as e:
+            flags_out = rpc.FLAG_RESPONSE | rpc.FLAG_ERROR
+            if isinstance(e, rpc.BusyError):
+                flags_out |= rpc.FLAG_BUSY
+            body = encode_error(f"{type(e).__name__}: {e}")
+        if flags & rpc.FLAG_ONEWAY:
+            return
+        try:
+            with lock:
+                rpc.send_frame(client, flags_out, req_id, body)
+        except OSError:
+            pass
+
+    def commands(self):
+        return [request[0] for request in self.requests]
+
+    def close(self):
+        self.sock.close()
+        for client in self.connections:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
@@ -0,0 +1,118 @@
+import unittest
+
+from tracker.dht import codec
+from tracker.dht.codec import (
+    ADDRESS, ADDRESS_LIST, ENTRY_LIST, INT, KEY, KEY_BYTES, KEY_LIST,
+    MESSAGE_LIST, OPTIONAL_ADDRESS, QUEUE_LIST, RANGE_CHUNK, SCHEMAS, STEP,
+    UINT, UINT_LIST, VALUE, VALUE_LIST, CodecError
+)
+
+MAX_KEY = 2**(KEY_BYTES * 8)
+ENTRY = (1700000000123456789, b'value', 1700000060)
+MESSAGE = (42, ('message', 1700000060))
+
+# Sample values of every field used by the schemas, as they decode
+SAMPLES = [
+    (KEY, MAX_KEY - 1),
+    (UINT, 2**32 - 1),
+    (INT, -2**63),
+    (ADDRESS, ('127.0.0.1', 8000)),
+    (OPTIONAL_ADDRESS, ('localhost', 8001)),
+    (ADDRESS_LIST, [('10.0.0.1', 1), ('node-b', 65535)]),
+    (VALUE, ENTRY),
+    (VALUE_LIST, [None, 'text', ENTRY]),
+    (KEY_LIST, [0, 1, MAX_KEY - 1]),
+    (UINT_LIST, [0, 7, 1023]),
+    (ENTRY_LIST, [(5, ENTRY), (MAX_KEY - 1, (1, None, None))]),
+    (STEP, (True, ('127.0.0.1', 8002))),
+    (MESSAGE_LIST, [MESSAGE, (43, ('other', None))]),
+    (QUEUE_LIST, [(9, [MESSAGE]), (10, [])]),
+    (RANGE_CHUNK, (77, False, [(5, ENTRY)], [(9, [MESSAGE])])),
+]
+
+
+def sample(field):
+    for known, value in SAMPLES:
+        if known is field:
+            return value
+    raise AssertionError(f"No sample value for {field!r}")
+
+
+def round_trip(field, value):
+    out = bytearray()
+    field.pack(out, value)
+    decoded, offset = field.unpack(memoryview(bytes(out)), 0)
+    assert offset == len(out), "Unpacking didn't consume the buffer"
+    return decoded
+
+
+class SchemasTest(unittest.TestCase):
+    def test_opcodes_are_unique(self):
+        opcodes = [opcode for opcode, _, _ in SCHEMAS.values()]
+        self.assertEqual(len(opcodes), len(set(opcodes)))
+        self.assertNotIn(codec.OP_PICKLE, opcodes)
+
+    def test_requests_round_trip(self):
+        for command, (opcode, fields, _) in SCHEMAS.items():
+            request = [command] + [sample(field) for field in fields]
+            body = codec.encode_request(request)
+            self.assertEqual(body[0], opcode)
+            self.assertEqual(codec.decode_request(body), request, command)
+
+    def test_responses_round_trip(self):
+        for command, (_, _, field) in SCHEMAS.items():
+            value = sample(field)
+            body = codec.encode_response(command, value)
+            self.assertEqual(
+                codec.decode_response(command, body),
+                value,
+                command
+            )
+
+    def test_optional_address_none(self):
+        self.assertIsNone(round_trip(OPTIONAL_ADDRESS, None))
+
+    def test_wrong_argument_count(self):
+        with self.assertRaises(CodecError):
+            codec.encode_request(["get", 1, 2])
+
+    def test_unknown_opcode(self):
+        with self.assertRaises(CodecError):
+            codec.decode_request(bytes([255]))
+
+    def test_invalid_key(self):
+        for key in (MAX_KEY, -1, 'key'):
+            with self.assertRaises(CodecError):
+                round_trip(KEY, key)
+
+    def test_commands_without_schema_are_pickled(self):
+        request = ["callback", {'a': 1}]
+        body = codec.encode_request(request)
+        self.assertEqual(body[0], codec.OP_PICKLE)
+        self.assertEqual(codec.decode_request(body), request)
+        self.assertEqual(
+            codec.decode_response("callback", codec.encode_response(
+                "callback", {'b': 2})),
+            {'b': 2}
+        )
+
+
+class ValueTest(unittest.TestCase):
+    def test_round_trip(self):
+        values = [
+            None, True, False, 0, -1, 2**63 - 1, -2**63, 2**63, -2**200,
+            MAX_KEY, b'', b'\x00bytes', '', 'unicode é中',
+            (), [], (1, [2, (3, None)], 'x'), {'pickled': {1, 2}},
+        ]
+        for value in values:
+            decoded = round_trip(VALUE, value)
+            self.assertEqual(decoded, value)
+            self.assertIs(type(decoded), type(value))
+
+    def test_buffers_decode_as_bytes(self):
+        self.assertEqual(round_trip(VALUE, bytearray(b'ab')), b'ab')
+        self.assertEqual(round_trip(VALUE, memoryview(b'cd')), b'cd')
+
+    def test_unknown_tag(self):
+        with self.assertRaises(CodecError):
+            VALUE.unpack(memoryview(bytes([200])), 0)
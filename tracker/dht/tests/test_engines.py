@@ -0,0 +1,96 @@
+import os
+import random
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from tracker.dht import chord
+from tracker.dht.storage import LogStore, MemoryStore
+from tracker.dht.tests.cluster import Cluster, HOST, free_port
+
+# Few workers, so the forwarded writes take all of them
+WORKERS = 4
+FORWARDED_PUTS = 200
+
+
+class ForwardedWritesTest(unittest.TestCase):
+    '''
+    Writes sent to a node that doesn't own their keys: its workers wait for\
+    the owner, which replicates the writes back to it.
+    '''
+    def run_engine(self, engine, persistent=False):
+        with tempfile.TemporaryDirectory() as log_dir, \
+                Cluster(log_dir) as cluster:
+            args = ("-m", engine, "-w", str(WORKERS), "-q", "1024")
+
+            def store(name):
+                if not persistent:
+                    return ()
+                return ("-d", os.path.join(log_dir, name))
+
+            first = cluster.start(*args, *store("first"))
+            second = cluster.start(*args, *store("second"), join=first)
+            cluster.wait_stable([first, second])
+
+            rand = random.Random(13)
+            keys = []
+            while len(keys) < FORWARDED_PUTS:
+                key = rand.getrandbits(chord.KEY_SIZE)
+                if chord.between(key, first.id(1), second.id(1)):
+                    keys.append(key)
+            started = monotonic()
+            with ThreadPoolExecutor(FORWARDED_PUTS) as executor:
+                list(executor.map(lambda key: first.put(key, key), keys))
+            self.assertLess(monotonic() - started, chord.RPC_TIMEOUT)
+            for key in keys:
+                self.assertEqual(second.simple_get(key)[1], key)
+                self.assertEqual(first.simple_get(key)[1], key)
+
+    def test_threaded(self):
+        self.run_engine(chord.THREADED)
+
+    def test_async(self):
+        self.run_engine(chord.ASYNC)
+
+    def test_async_persistent(self):
+        self.run_engine(chord.ASYNC, persistent=True)
+
+
+class BlocksTest(unittest.TestCase):
+    def test_store_rpcs_block_on_disk(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            log_store = LogStore(os.path.join(data_dir, "log"))
+            try:
+                for store in (MemoryStore(), log_store):
+                    node = chord.Node(HOST, free_port(), store=store)
+                    self.assertFalse(node.blocks("ping"))
+                    for command in chord.STORE_RPCS:
+                        self.assertEqual(
+                            node.blocks(command),
+                            store is log_store
+                        )
+            finally:
+                log_store.close()
+
+
+class BoundedExecutorTest(unittest.TestCase):
+    def test_full_pool_rejects(self):
+        executor = chord.BoundedExecutor(1, 1)
+        release = threading.Event()
+        running = executor.submit(release.wait)
+        queued = executor.submit(lambda: "queued")
+        self.assertIsNotNone(queued)
+        self.assertIsNone(executor.submit(lambda: "rejected"))
+        stats = executor.stats()
+        self.assertEqual((stats["pending"], stats["rejected"]), (2, 1))
+
+        release.set()
+        self.assertTrue(running.result(1))
+        self.assertEqual(queued.result(1), "queued")
+        self.assertEqual(executor.submit(lambda: "again").result(1), "again")
+        stats = executor.stats()
+        self.assertEqual((stats["pending"], stats["completed"],
+                          stats["rejected"]), (0, 3, 1))
+        self.assertGreater(stats["max_queue_time"], 0)
@@ -0,0 +1,79 @@
+import unittest
+from time import time
+
+from tracker.dht import chord
+from tracker.dht.chord import EXPIRE_QUEUE, EXPIRE_VALUE, ExpiryIndex
+from tracker.dht.tests.cluster import HOST, free_port
+
+
+class ExpiryIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = ExpiryIndex()
+
+    def test_due_in_deadline_order(self):
+        self.index.add(EXPIRE_VALUE, 1, 30)
+        self.index.add(EXPIRE_QUEUE, 2, 10)
+        self.index.add(EXPIRE_VALUE, 3, 20)
+        self.assertEqual(self.index.due(5), [])
+        self.assertEqual(self.index.due(20),
+                         [(EXPIRE_QUEUE, 2), (EXPIRE_VALUE, 3)])
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.due(100), [(EXPIRE_VALUE, 1)])
+        self.assertEqual(self.index.due(100), [])
+
+    def test_no_deadline_is_not_tracked(self):
+        self.index.add(EXPIRE_VALUE, 1, 0)
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.due(2**40), [])
+
+    def test_only_the_earliest_deadline_counts(self):
+        self.index.add(EXPIRE_VALUE, 1, 20)
+        self.index.add(EXPIRE_VALUE, 1, 30)
+        self.index.add(EXPIRE_VALUE, 1, 10)
+        # The value and the queue of a key have their own deadlines
+        self.index.add(EXPIRE_QUEUE, 1, 15)
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.due(10), [(EXPIRE_VALUE, 1)])
+        # The replaced deadline is skipped once due
+        self.assertEqual(self.index.due(25), [(EXPIRE_QUEUE, 1)])
+        self.assertEqual(self.index.heap, [])
+
+
+class ExpireTest(unittest.TestCase):
+    '''
+    A sweep of the expire task of a node that doesn't serve.
+    '''
+    def setUp(self):
+        self.node = chord.Node(HOST, free_port())
+        self.now = int(time())
+
+    def sweep(self):
+        chord.Node.expire.__wrapped__(self.node)
+
+    def test_expired_values_are_dropped(self):
+        self.node.store_value(1, (1, "old", self.now - 1))
+        self.node.store_value(2, (2, "new", self.now + 3600))
+        self.node.store_value(3, (3, "kept", 0))
+        self.sweep()
+        self.assertEqual(self.node.store.range(0, 0), [2, 3])
+        self.assertEqual(len(self.node.expiry), 1)
+
+    def test_rewritten_value_gets_its_new_deadline(self):
+        self.node.store_value(1, (1, "old", self.now - 1))
+        self.node.store.put(1, (2, "new", self.now + 3600))
+        self.sweep()
+        self.assertEqual(self.node.store.get(1), (2, "new", self.now + 3600))
+        self.assertEqual(self.node.expiry.heap,
+                         [(self.now + 3600, EXPIRE_VALUE, 1)])
+
+    def test_expired_messages_are_dropped(self):
+        for seq, ttl in ((1, -1), (2, 3600), (3, -2), (4, 0)):
+            deadline = self.now + ttl if ttl else 0
+            self.node.store_message(1, (seq, (f"msg {seq}", deadline)))
+        self.sweep()
+        self.assertEqual(
+            self.node.store.fetch(1, 0, 10),
+            [(2, ("msg 2", self.now + 3600)), (4, ("msg 4", 0))]
+        )
+        self.assertEqual(self.node.expiry.heap,
+                         [(self.now + 3600, EXPIRE_QUEUE, 1)])
@@ -0,0 +1,69 @@
+import math
+import random
+import unittest
+
+from tracker.dht import failure_detector
+from tracker.dht.failure_detector import PeerState
+
+
+def direct_phi(intervals, since):
+    # phi over the mean and deviation computed from the samples themselves
+    mean = sum(intervals) / len(intervals)
+    std = math.sqrt(sum((x - mean)**2 for x in intervals) / len(intervals))
+    mean += failure_detector.ACCEPTABLE_PAUSE
+    std = max(std, failure_detector.MIN_STD_DEVIATION)
+    y = (since - mean) / std
+    e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+    if y > 0:
+        return -math.log10(e / (1 + e))
+    return -math.log10(1 - 1 / (1 + e))
+
+
+class PeerStateTest(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(6)
+        self.state = PeerState(("127.0.0.1", 1), 1)
+
+    def beat(self, count, low, high):
+        now = self.state.last_heartbeat or 0.0
+        intervals = []
+        for _ in range(count):
+            if self.state.last_heartbeat is not None:
+                interval = self.rand.uniform(low, high)
+                intervals.append(interval)
+                now += interval
+            self.state.heartbeat(now)
+        return intervals, now
+
+    def test_phi_matches_the_window(self):
+        intervals, now = self.beat(failure_detector.SAMPLES_WINDOW * 3,
+                                   0.3, 1.5)
+        window = intervals[-failure_detector.SAMPLES_WINDOW:]
+        self.assertEqual(len(self.state.intervals), len(window))
+        for kept, interval in zip(self.state.intervals, window):
+            self.assertAlmostEqual(kept, interval)
+        for since in (0.1, 1.0, 2.0, 3.0):
+            self.assertAlmostEqual(self.state.phi(now + since),
+                                   direct_phi(window, since), places=6)
+
+    def test_phi_of_steady_heartbeats(self):
+        # All the same interval: the deviation is the minimum, not negative
+        state = self.state
+        for i in range(failure_detector.SAMPLES_WINDOW * 2):
+            state.heartbeat(i * 0.1)
+        now = state.last_heartbeat
+        interval = 0.1 + failure_detector.ACCEPTABLE_PAUSE
+        self.assertLess(state.phi(now + interval / 2), 1)
+        self.assertGreater(state.phi(now + interval * 3),
+                           failure_detector.PHI_THRESHOLD)
+
+    def test_phi_of_a_long_silence(self):
+        self.beat(10, 0.5, 0.5)
+        self.assertEqual(self.state.phi(self.state.last_heartbeat + 60),
+                         math.inf)
+
+    def test_phi_without_samples(self):
+        self.state.heartbeat(10.0)
+        self.assertLess(self.state.phi(10.1), 1)
+        self.assertGreater(self.state.phi(20.0),
+                           failure_detector.PHI_THRESHOLD)
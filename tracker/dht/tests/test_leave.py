@@ -0,0 +1,136 @@
+import random
+import signal
+import socket
+import tempfile
+import threading
+import unittest
+
+from tracker.dht import chord
+from tracker.dht.tests.cluster import Cluster, HOST, free_port, wait_for
+from tracker.dht.tests.peer import Peer
+
+# Keys only the leaving node holds, enough for its handoff to take a while
+HANDED_KEYS = 20000
+EXIT_TIMEOUT = 10
+
+
+def owned_keys(rand, pred, node, count):
+    keys = []
+    while len(keys) < count:
+        key = rand.getrandbits(chord.KEY_SIZE)
+        if chord.between(key, pred.id(1), node.id(1)):
+            keys.append(key)
+    return keys
+
+
+class LeaveTest(unittest.TestCase):
+    '''
+    A node leaves a ring of two while the other one keeps writing to the\
+    replicas it holds: those writes reach the leaving node, which passes\
+    them on to the other one, its heir.
+    '''
+    def run_leave(self, engine, signum=None):
+        rand = random.Random(25)
+        with tempfile.TemporaryDirectory() as log_dir, \
+                Cluster(log_dir) as cluster:
+            stays = cluster.start("-m", engine)
+            # Lazy, so the keys it owns must all go in the handoff
+            leaves = cluster.start("-m", engine, "-r", chord.LAZY_REPLICATION,
+                                   join=stays)
+            cluster.wait_stable([stays, leaves])
+
+            handed = owned_keys(rand, stays, leaves, HANDED_KEYS)
+            for start in range(0, len(handed), 1000):
+                leaves.multi_put([
+                    (key, key) for key in handed[start:start + 1000]
+                ])
+            written = []
+            done = threading.Event()
+
+            def write():
+                for key in owned_keys(rand, leaves, stays, 100000):
+                    if done.is_set():
+                        return
+                    try:
+                        stays.put(key, key)
+                    except (socket.error, chord.RemoteError):
+                        # Once the other node is gone the writes miss their\
+                        #  replica, only the acknowledged ones count
+                        continue
+                    written.append(key)
+
+            writer = threading.Thread(target=write)
+            writer.start()
+            try:
+                wait_for(lambda: len(written) > 50, EXIT_TIMEOUT,
+                         "No write went through")
+                if signum is None:
+                    self.assertTrue(leaves.leave())
+                else:
+                    cluster.processes[leaves.port].send_signal(signum)
+                wait_for(lambda: cluster.exited(leaves), EXIT_TIMEOUT,
+                         f"{leaves} did not exit")
+            finally:
+                done.set()
+                writer.join()
+            self.assertEqual(cluster.processes[leaves.port].returncode, 0)
+
+            self.assertEqual(stays.multi_get(handed), handed)
+            self.assertEqual(stays.multi_get(written), written)
+
+    def test_threaded(self):
+        self.run_leave(chord.THREADED)
+
+    def test_async(self):
+        self.run_leave(chord.ASYNC)
+
+    def test_sigterm(self):
+        self.run_leave(chord.THREADED, signal.SIGTERM)
+
+
+class FailedLeaveTest(unittest.TestCase):
+    '''
+    A node whose succesor fails to take its keys stays in the ring.
+    '''
+    def setUp(self):
+        self.failing = True
+        self.succ = Peer(self.answer)
+        self.node = chord.Node(HOST, free_port())
+        self.node.fingers[0] = chord.RemoteNodeReference(*self.succ.address)
+        # Without predecessor we hand over (succ, node]
+        succ_id = self.node.fingers[0].id()
+        self.keys = sorted((succ_id + i) % chord.MAX_KEY for i in range(1, 50))
+        for key in self.keys:
+            self.node.store.put(key, (1, key, 0))
+
+    def tearDown(self):
+        self.succ.close()
+
+    def answer(self, command, args):
+        if command == "ping" or command == "node_left":
+            return True
+        if command == "sync_range" and not self.failing:
+            return []
+        raise chord.RemoteError(f"{command} failed")
+
+    def test_failed_handoff_keeps_the_node(self):
+        self.assertFalse(self.node.leave())
+        self.assertIn("sync_range", self.succ.commands())
+        self.assertFalse(self.node.leaving.is_set())
+        self.assertFalse(self.node.left.is_set())
+        self.assertIsNone(self.node.heir)
+
+        self.failing = False
+        self.assertTrue(self.node.leave())
+        self.assertTrue(self.node.left.is_set())
+        self.assertIn("node_left", self.succ.commands())
+        handed = [
+            key for request in self.succ.requests
+            if request[0] == "sync_range" for key, _ in request[3]
+        ]
+        self.assertEqual(sorted(set(handed)), self.keys)
+
+    def test_forced_leave_goes_anyway(self):
+        self.assertTrue(self.node.leave(force=True))
+        self.assertTrue(self.node.left.is_set())
+        self.assertIn("node_left", self.succ.commands())
@@ -0,0 +1,88 @@
+import unittest
+from time import sleep
+
+from tracker.dht import chord
+from tracker.dht.chord import LookupCache
+
+
+class Ref(object):
+    '''
+    Stand in for a node reference, only its id matters to the cache.
+    '''
+    def __init__(self, node_id):
+        self._id = node_id % chord.MAX_KEY
+
+    def id(self):
+        return self._id
+
+
+class LookupCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = LookupCache()
+        self.nodes = {i: Ref(i) for i in (-100, 100, 200, 300, 400)}
+
+    def put(self, pred, owner):
+        self.cache.put(self.nodes[pred], self.nodes[owner])
+
+    def test_range_is_open_at_the_predecessor(self):
+        self.put(100, 200)
+        self.assertIs(self.cache.get(101), self.nodes[200])
+        self.assertIs(self.cache.get(200), self.nodes[200])
+        self.assertIsNone(self.cache.get(100))
+        self.assertIsNone(self.cache.get(201))
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+
+    def test_range_wrapping_around_zero(self):
+        self.put(-100, 100)
+        self.put(200, 300)
+        for key in (chord.MAX_KEY - 99, chord.MAX_KEY - 1, 0, 100):
+            self.assertIs(self.cache.get(key), self.nodes[100])
+        self.assertIsNone(self.cache.get(chord.MAX_KEY - 100))
+        self.assertIs(self.cache.get(250), self.nodes[300])
+        self.assertIsNone(self.cache.get(150))
+
+    def test_entries_expire(self):
+        cache = LookupCache(ttl=0.05)
+        cache.put(self.nodes[100], self.nodes[200])
+        self.assertIs(cache.get(150), self.nodes[200])
+        sleep(0.1)
+        self.assertIsNone(cache.get(150))
+
+    def test_overlapping_ranges_are_replaced(self):
+        self.put(100, 200)
+        self.put(200, 300)
+        self.put(300, 400)
+        # The owner of 200 left, 300 took its keys
+        self.put(100, 300)
+        self.assertEqual(self.cache.ends, [300, 400])
+        self.assertIs(self.cache.get(150), self.nodes[300])
+        self.assertIs(self.cache.get(350), self.nodes[400])
+        # A node joined at 200 again, keys past it still go to 300
+        self.put(100, 200)
+        self.assertIs(self.cache.get(150), self.nodes[200])
+        self.assertIs(self.cache.get(250), self.nodes[300])
+
+    def test_oldest_entry_is_evicted(self):
+        cache = LookupCache(size=2)
+        for pred, owner in ((100, 200), (200, 300), (300, 400)):
+            cache.put(self.nodes[pred], self.nodes[owner])
+        self.assertEqual(cache.ends, [300, 400])
+        self.assertIsNone(cache.get(150))
+
+    def test_invalidate_node(self):
+        self.put(100, 200)
+        self.put(200, 300)
+        self.put(300, 400)
+        self.cache.invalidate_node(self.nodes[200])
+        self.assertEqual(self.cache.ends, [400])
+
+    def test_invalidate_point(self):
+        self.put(100, 200)
+        self.put(200, 300)
+        self.cache.invalidate_point(250)
+        self.assertEqual(self.cache.ends, [200])
+        # A node joining at an end doesn't split the range before it
+        self.cache.invalidate_point(200)
+        self.assertEqual(self.cache.ends, [200])
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(150))
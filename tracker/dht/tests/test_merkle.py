@@ -0,0 +1,188 @@
+import os
+import random
+import tempfile
+import unittest
+
+from tracker.dht.merkle import MAX_KEY, MerkleTree, MerkleTrees, range_size
+from tracker.dht.storage import LogStore, MemoryStore
+
+
+def inside(key, start, end):
+    # Ring interval (start, end], the whole ring when they are equal
+    return (key - start - 1) % MAX_KEY < range_size(start, end)
+
+
+class BucketTest(unittest.TestCase):
+    RANGES = [
+        (0, 1000),
+        (1000, 0),
+        (MAX_KEY - 100, 5000),
+        (12345, 12345),
+        (0, MAX_KEY - 1),
+        (7, 7 + 2**10 - 3),
+    ]
+
+    def test_bounds_fall_in_the_first_and_last_bucket(self):
+        for start, end in self.RANGES:
+            tree = MerkleTree(start, end)
+            self.assertEqual(tree.bucket((start + 1) % MAX_KEY), 0)
+            # Narrower ranges than the buckets leave some of them empty
+            if tree.size >= 2**tree.depth:
+                self.assertEqual(tree.bucket(end), 2**tree.depth - 1)
+
+    def test_all_buckets_cover_the_range(self):
+        for start, end in self.RANGES:
+            tree = MerkleTree(start, end)
+            self.assertEqual(
+                tree.bucket_range(0, 2**tree.depth - 1),
+                (start, end)
+            )
+
+    def test_bucket_range_holds_exactly_the_keys_of_its_buckets(self):
+        rand = random.Random(15)
+        for start, end in self.RANGES:
+            tree = MerkleTree(start, end, depth=4)
+            keys = [
+                (start + 1 + rand.randrange(tree.size)) % MAX_KEY
+                for _ in range(300)
+            ]
+            for first in range(2**tree.depth):
+                last = rand.randrange(first, 2**tree.depth)
+                range_start, range_end = tree.bucket_range(first, last)
+                for key in keys:
+                    self.assertEqual(
+                        inside(key, range_start, range_end),
+                        first <= tree.bucket(key) <= last,
+                        (start, end, first, last, key)
+                    )
+
+    def test_small_range_has_empty_buckets(self):
+        # Fewer keys than buckets, some buckets are empty ranges
+        tree = MerkleTree(0, 4, depth=3)
+        self.assertEqual([tree.bucket(key) for key in (1, 2, 3, 4)],
+                         [0, 2, 4, 6])
+        start, end = tree.bucket_range(1, 1)
+        self.assertEqual(start, end)
+
+
+class TreeDiffTest(unittest.TestCase):
+    def test_diff_finds_the_differing_bucket(self):
+        start, end = MAX_KEY - 2**20, 2**20
+        keys = [(start + 1 + i * 997) % MAX_KEY for i in range(2000)]
+        ours, theirs = MemoryStore(), MemoryStore()
+        for key in keys:
+            ours.put(key, (1, key, None))
+            theirs.put(key, (1, key, None))
+        theirs.put(keys[1234], (2, 'newer', None))
+        our_tree = MerkleTree.build(ours, start, end)
+        their_tree = MerkleTree.build(theirs, start, end)
+        self.assertNotEqual(our_tree.node(0, 0), their_tree.node(0, 0))
+
+        indices = [0]
+        for level in range(our_tree.depth + 1):
+            digests = [their_tree.node(level, i) for i in indices]
+            differing = our_tree.diff(level, indices, digests)
+            self.assertEqual(len(differing), 1)
+            if level < our_tree.depth:
+                indices = [2 * differing[0], 2 * differing[0] + 1]
+        self.assertEqual(differing, [our_tree.bucket(keys[1234])])
+        self.assertTrue(
+            inside(keys[1234], *our_tree.bucket_range(*differing * 2))
+        )
+
+    def test_same_content_same_root(self):
+        store = MemoryStore()
+        self.assertEqual(
+            MerkleTree.build(store, 0, 0).node(0, 0),
+            MerkleTree.build(MemoryStore(), 0, 0).node(0, 0)
+        )
+        store.put(5, (1, 'value', None))
+        self.assertNotEqual(
+            MerkleTree.build(store, 0, 0).node(0, 0),
+            MerkleTree.build(MemoryStore(), 0, 0).node(0, 0)
+        )
+
+
+class MerkleTreesTest(unittest.TestCase):
+    RANGES = [(0, 0), (MAX_KEY - 2**150, 2**150), (2**159, 2**159 + 20)]
+
+    def setUp(self):
+        self.rand = random.Random(17)
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.log_store = LogStore(os.path.join(self.data_dir.name, "log"))
+
+    def tearDown(self):
+        self.log_store.close()
+        self.data_dir.cleanup()
+
+    def random_key(self, keys):
+        if keys and self.rand.random() < 0.5:
+            return self.rand.choice(keys)
+        if self.rand.random() < 0.2:
+            return 2**159 + self.rand.randrange(1, 21)
+        return self.rand.randrange(MAX_KEY)
+
+    def change(self, store, keys):
+        key = self.random_key(keys)
+        keys.append(key)
+        op = self.rand.randrange(6)
+        if op == 0:
+            store.put(key, (self.rand.randrange(100), key, None))
+        elif op == 1:
+            store.enqueue(key, (self.rand.randrange(100), ('msg', 0)))
+        elif op == 2:
+            store.ack(key, self.rand.randrange(100))
+        elif op == 3:
+            store.discard_value(key)
+        elif op == 4:
+            store.dequeue(key)
+        else:
+            store.remove(key)
+
+    def test_follows_the_changes_of_the_store(self):
+        for store in (MemoryStore(), self.log_store):
+            trees = MerkleTrees(store)
+            keys = []
+            for round in range(20):
+                for _ in range(self.rand.randrange(50)):
+                    self.change(store, keys)
+                for start, end in self.RANGES:
+                    self.assertEqual(
+                        trees.tree(start, end).levels,
+                        MerkleTree.build(store, start, end).levels,
+                        (store, round, start, end)
+                    )
+
+    def test_copies_are_not_updated(self):
+        store = MemoryStore()
+        trees = MerkleTrees(store)
+        before = trees.tree(0, 0)
+        store.put(5, (1, 'value', None))
+        self.assertNotEqual(trees.tree(0, 0).node(0, 0), before.node(0, 0))
+        self.assertEqual(
+            before.levels,
+            MerkleTree.build(MemoryStore(), 0, 0).levels
+        )
+
+    def test_only_dirty_buckets_are_read(self):
+        store = MemoryStore()
+        for i in range(5000):
+            store.put(i * 2**146, (1, i, None))
+        trees = MerkleTrees(store, depth=6)
+        trees.tree(0, 0)
+        read = []
+        items = store.items
+        store.items = lambda keys=None: read.extend(keys) or items(keys)
+        self.assertEqual(len(trees.tree(0, 0).levels), 7)
+        self.assertEqual(read, [])
+        store.put(3, (2, 'new', None))
+        trees.tree(0, 0)
+        bucket_start, bucket_end = MerkleTree(0, 0, 6).bucket_range(0, 0)
+        self.assertEqual(read, store.range(bucket_start, bucket_end))
+
+    def test_unused_trees_are_dropped(self):
+        store = MemoryStore()
+        trees = MerkleTrees(store, ttl=0)
+        trees.tree(0, 0)
+        trees.tree(1, 2)
+        self.assertEqual(len(trees), 1)
@@ -0,0 +1,60 @@
+import unittest
+
+from tracker.dht import chord
+from tracker.dht.tests.cluster import HOST, free_port
+from tracker.dht.tests.peer import Peer
+
+SUCCESORS = 3
+
+
+class ReleaseRangeTest(unittest.TestCase):
+    '''
+    A node joining right before ours takes a range that our last replica\
+    doesn't have to keep anymore.
+    '''
+    def setUp(self):
+        self.peers = [Peer(self.answer) for _ in range(SUCCESORS)]
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.close()
+
+    def answer(self, command, args):
+        return True if command == "ping" else None
+
+    def release(self, replicas):
+        node = chord.Node(HOST, free_port(), replicas=replicas)
+        node.succesors = [
+            chord.RemoteNodeReference(*peer.address) for peer in self.peers
+        ]
+        node.fingers[0] = node.succesors[0]
+        start = node.id()
+        end = (start + 100) % chord.MAX_KEY
+        keys = [(start + i) % chord.MAX_KEY for i in range(1, 11)]
+        for key in keys:
+            node.store.put(key, (1, key, 0))
+        self.assertTrue(node.release_range(start, end))
+        return sorted(keys)
+
+    def removed(self, peer):
+        return [
+            key for request in peer.requests if request[0] == "remove_keys"
+            for key in request[1]
+        ]
+
+    def test_last_replica_releases(self):
+        keys = self.release(2)
+        holders = [self.removed(peer) for peer in self.peers]
+        self.assertEqual(holders, [[], keys, []])
+
+    def test_single_replica_releases(self):
+        keys = self.release(1)
+        holders = [self.removed(peer) for peer in self.peers]
+        self.assertEqual(holders, [keys, [], []])
+
+    def test_small_ring_keeps(self):
+        for peer in self.peers[1:]:
+            peer.close()
+        del self.peers[1:]
+        self.release(2)
+        self.assertEqual(self.removed(self.peers[0]), [])
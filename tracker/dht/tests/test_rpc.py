@@ -0,0 +1,240 @@
+import socket
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+from tracker.dht import rpc
+from tracker.dht.tests.peer import Peer
+
+
+def echo(command, args):
+    # The arguments back, after sleeping the seconds of the first if any
+    sleep(args[0] if args and isinstance(args[0], float) else 0)
+    if command == "fail":
+        raise ValueError(f"failed {args}")
+    return args
+
+
+class FrameReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.reader = rpc.FrameReader(self.ours, buffer_size=16)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def frame(self, flags, req_id, body, version=rpc.PROTOCOL_VERSION):
+        return rpc.FRAME_HEADER.pack(version, flags, req_id, len(body)) + body
+
+    def test_frames_in_one_stream(self):
+        self.theirs.sendall(self.frame(rpc.FLAG_RESPONSE, 7, b"first") +
+                            self.frame(0, 8, b""))
+        flags, req_id, body = self.reader.read()
+        self.assertEqual((flags, req_id, bytes(body)),
+                         (rpc.FLAG_RESPONSE, 7, b"first"))
+        flags, req_id, body = self.reader.read()
+        self.assertEqual((flags, req_id, bytes(body)), (0, 8, b""))
+
+    def test_frame_split_across_reads(self):
+        data = self.frame(rpc.FLAG_ONEWAY, 1, b"split in bytes")
+
+        def send():
+            for i in range(len(data)):
+                self.theirs.sendall(data[i:i + 1])
+                sleep(0.001)
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        flags, req_id, body = self.reader.read()
+        sender.join()
+        self.assertEqual((flags, req_id, bytes(body)),
+                         (rpc.FLAG_ONEWAY, 1, b"split in bytes"))
+
+    def test_big_frame_grows_the_buffer_for_a_while(self):
+        big = bytes(range(256)) * 4
+        sender = threading.Thread(target=self.theirs.sendall, args=(
+            self.frame(0, 1, big) + self.frame(0, 2, b"small"),
+        ))
+        sender.start()
+        self.assertEqual(bytes(self.reader.read()[2]), big)
+        self.assertEqual(len(self.reader.buffer), len(big))
+        self.assertEqual(bytes(self.reader.read()[2]), b"small")
+        self.assertEqual(len(self.reader.buffer), 16)
+        sender.join()
+
+    def test_send_frame(self):
+        for body in (b"short", b"x" * (rpc.COALESCE_SIZE + 1)):
+            sender = threading.Thread(target=rpc.send_frame, args=(
+                self.theirs, rpc.FLAG_ERROR, 3, body
+            ))
+            sender.start()
+            flags, req_id, read = self.reader.read()
+            sender.join()
+            self.assertEqual((flags, req_id, bytes(read)),
+                             (rpc.FLAG_ERROR, 3, body))
+
+    def test_unknown_version(self):
+        self.theirs.sendall(self.frame(0, 1, b"body", version=1))
+        with self.assertRaises(rpc.ProtocolError):
+            self.reader.read()
+
+    def test_oversized_frame(self):
+        self.theirs.sendall(rpc.FRAME_HEADER.pack(
+            rpc.PROTOCOL_VERSION, 0, 1, rpc.MAX_FRAME_SIZE + 1
+        ))
+        with self.assertRaises(rpc.ProtocolError):
+            self.reader.read()
+
+    def test_peer_closing_mid_frame(self):
+        self.theirs.sendall(self.frame(0, 1, b"cut short")[:-3])
+        self.theirs.close()
+        with self.assertRaises(ConnectionResetError):
+            self.reader.read()
+
+
+class ConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Peer(echo)
+        self.conn = rpc.Connection(self.server.address)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.close()
+
+    def test_calls_share_the_connection(self):
+        # Answered in the reverse order of the requests
+        delays = [0.05 * i for i in reversed(range(10))]
+        with ThreadPoolExecutor(len(delays)) as executor:
+            results = list(executor.map(
+                lambda delay: self.conn.call(("echo", delay + 0.01, delay)),
+                delays
+            ))
+        self.assertEqual(results,
+                         [(delay + 0.01, delay) for delay in delays])
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(self.conn.in_flight(), 0)
+
+    def test_remote_error(self):
+        with self.assertRaisesRegex(rpc.RemoteError, "failed"):
+            self.conn.call(("fail", 1))
+        self.assertEqual(self.conn.call(("echo", 2)), (2,))
+
+    def test_late_answer_is_dropped(self):
+        with self.assertRaises(socket.timeout):
+            self.conn.call(("echo", 0.3, "late"), timeout=0.1)
+        self.assertEqual(self.conn.in_flight(), 0)
+        sleep(0.3)
+        self.assertEqual(self.conn.call(("echo", "next")), ("next",))
+
+    def test_oneway_send(self):
+        self.conn.send(("echo", "oneway"))
+        self.assertEqual(self.conn.call(("echo", "after")), ("after",))
+        self.assertEqual(self.server.requests,
+                         [("echo", "oneway"), ("echo", "after")])
+
+    def test_closed_peer_fails_the_calls_in_flight(self):
+        caller = threading.Thread(target=lambda: self.assertRaises(
+            ConnectionResetError, self.conn.call, ("echo", 1.0)
+        ))
+        caller.start()
+        sleep(0.1)
+        self.server.close()
+        caller.join()
+        self.assertTrue(self.conn.closed)
+
+    def test_retire_waits_for_the_calls_in_flight(self):
+        results = []
+        caller = threading.Thread(target=lambda: results.append(
+            self.conn.call(("echo", 0.3, "late"))
+        ))
+        caller.start()
+        sleep(0.1)
+        self.conn.retire()
+        self.assertFalse(self.conn.closed)
+        caller.join()
+        self.assertEqual(results, [(0.3, "late")])
+        for _ in range(50):
+            if self.conn.closed:
+                break
+            sleep(0.01)
+        self.assertTrue(self.conn.closed)
+        with self.assertRaises(ConnectionResetError):
+            self.conn.call(("echo",))
+
+    def test_retire_idle_closes_right_away(self):
+        self.conn.retire()
+        self.assertTrue(self.conn.closed)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Peer(echo)
+        self.pool = rpc.ConnectionPool(self.server.address, size=2)
+
+    def tearDown(self):
+        for conn in self.pool.connections:
+            conn.close()
+        self.server.close()
+
+    def test_idle_connection_is_reused(self):
+        for i in range(5):
+            self.assertEqual(self.pool.call(("echo", i)), (i,))
+        self.assertEqual(len(self.pool.connections), 1)
+        self.assertIsNotNone(self.pool.rtt)
+
+    def test_busy_connections_are_shared_up_to_the_size(self):
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(
+                lambda i: self.pool.call(("echo", 0.2, i)), range(8)
+            ))
+        self.assertEqual(results, [(0.2, i) for i in range(8)])
+        self.assertEqual(len(self.pool.connections), 2)
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_closed_connection_is_replaced(self):
+        self.pool.call(("echo",))
+        self.pool.connections[0].close()
+        self.assertEqual(self.pool.call(("echo", 1)), (1,))
+        self.assertEqual(len(self.pool.connections), 1)
+        self.assertFalse(self.pool.connections[0].closed)
+
+
+class BusyPeerTest(unittest.TestCase):
+    '''
+    A peer that sheds the first requests it gets.
+    '''
+    def setUp(self):
+        self.busy = 0
+        self.server = Peer(self.answer)
+        self.pool = rpc.ConnectionPool(self.server.address)
+
+    def tearDown(self):
+        for conn in self.pool.connections:
+            conn.close()
+        self.server.close()
+
+    def answer(self, command, args):
+        if self.busy:
+            self.busy -= 1
+            raise rpc.BusyError("Busy")
+        return args
+
+    def test_busy_calls_are_retried(self):
+        self.busy = rpc.BUSY_RETRIES - 1
+        self.assertEqual(self.pool.call(("echo", "served")), ("served",))
+        self.assertEqual(len(self.server.requests), rpc.BUSY_RETRIES)
+
+    def test_gives_up_after_the_retries(self):
+        self.busy = rpc.BUSY_RETRIES + 1
+        with self.assertRaises(rpc.BusyError):
+            self.pool.call(("echo",))
+        self.assertEqual(len(self.server.requests), rpc.BUSY_RETRIES + 1)
+
+    def test_other_errors_are_not_retried(self):
+        self.server.handler = echo
+        with self.assertRaises(rpc.RemoteError) as raised:
+            self.pool.call(("fail",))
+        self.assertNotIsInstance(raised.exception, rpc.BusyError)
+        self.assertEqual(len(self.server.requests), 1)
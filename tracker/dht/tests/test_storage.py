@@ -0,0 +1,322 @@
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+from tracker.dht import storage
+from tracker.dht.codec import KEY_BYTES
+from tracker.dht.storage import KeyIndex, LogStore, MemoryStore,\
+    MessageArena, QuotaError
+
+MAX_KEY = 2**(KEY_BYTES * 8)
+
+
+def clockwise(keys, start, end):
+    '''
+    Reference for KeyIndex.range: the keys of (start, end] in the order\
+    met walking the ring from start.
+    '''
+    size = (end - start) % MAX_KEY or MAX_KEY
+    inside = [key for key in keys if (key - start - 1) % MAX_KEY < size]
+    return sorted(inside, key=lambda key: (key - start - 1) % MAX_KEY)
+
+
+class KeyIndexRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.keys = [10, 20, 30, 40, 50]
+        self.index = KeyIndex(self.keys)
+
+    def test_interval_is_open_at_start_closed_at_end(self):
+        self.assertEqual(self.index.range(10, 30), [20, 30])
+        self.assertEqual(self.index.range(9, 31), [10, 20, 30])
+        self.assertEqual(self.index.range(20, 21), [])
+
+    def test_limit(self):
+        self.assertEqual(self.index.range(0, 50, 2), [10, 20])
+        self.assertEqual(self.index.range(0, 50, 10), self.keys)
+        self.assertEqual(self.index.range(0, 50, 0), [])
+
+    def test_wraps_around_zero(self):
+        self.assertEqual(self.index.range(40, 20), [50, 10, 20])
+        self.assertEqual(self.index.range(50, 10), [10])
+        self.assertEqual(self.index.range(MAX_KEY - 1, 10), [10])
+
+    def test_wraparound_limit(self):
+        # The limit keeps the first keys walking clockwise from start
+        self.assertEqual(self.index.range(40, 20, 1), [50])
+        self.assertEqual(self.index.range(40, 20, 2), [50, 10])
+        self.assertEqual(self.index.range(40, 20, 3), [50, 10, 20])
+        self.assertEqual(self.index.range(40, 20, 4), [50, 10, 20])
+        self.assertEqual(self.index.range(50, 20, 1), [10])
+
+    def test_equal_bounds_cover_the_whole_ring(self):
+        self.assertEqual(self.index.range(30, 30), [40, 50, 10, 20, 30])
+        self.assertEqual(self.index.range(35, 35), [40, 50, 10, 20, 30])
+        self.assertEqual(self.index.range(30, 30, 3), [40, 50, 10])
+        self.assertEqual(self.index.range(50, 50, 2), [10, 20])
+
+    def test_empty(self):
+        index = KeyIndex()
+        self.assertEqual(index.range(0, 0), [])
+        self.assertEqual(index.range(10, 5, 3), [])
+
+    def test_add_and_discard_keep_it_sorted(self):
+        self.index.add(25)
+        self.index.add(25)
+        self.index.discard(40)
+        self.index.discard(41)
+        self.assertEqual(self.index.range(0, 0), [10, 20, 25, 30, 50])
+
+    def test_matches_a_walk_of_the_ring(self):
+        rand = random.Random(15)
+        keys = [rand.randrange(MAX_KEY) for _ in range(200)]
+        index = KeyIndex(keys)
+        for _ in range(500):
+            start = rand.choice([rand.randrange(MAX_KEY), rand.choice(keys)])
+            end = rand.choice([rand.randrange(MAX_KEY), rand.choice(keys)])
+            if rand.random() < 0.1:
+                end = start
+            expected = clockwise(keys, start, end)
+            self.assertEqual(index.range(start, end), expected)
+            limit = rand.randrange(len(keys))
+            self.assertEqual(index.range(start, end, limit), expected[:limit])
+
+
+class MessageArenaTest(unittest.TestCase):
+    def setUp(self):
+        self.arena = MessageArena()
+
+    def add(self, key, seq, msg):
+        record = self.arena.encode(seq, msg)
+        self.arena.add(key, seq, record)
+        return len(record)
+
+    def test_entries_are_kept_in_sequence_order(self):
+        for seq in (3, 1, 4, 2):
+            self.add(1, seq, (f"msg {seq}", 0))
+        self.assertEqual([seq for seq, _ in self.arena.entries(1)],
+                         [1, 2, 3, 4])
+        self.assertTrue(self.arena.contains(1, 3))
+        self.assertFalse(self.arena.contains(1, 5))
+        self.assertEqual(self.arena.fetch(1, 2, 1), [(3, ("msg 3", 0))])
+        self.assertEqual(self.arena.fetch(1, 4, 10), [])
+
+    def test_sizes(self):
+        sizes = [self.add(key, seq, ["x" * seq])
+                 for key, seq in ((1, 1), (1, 2), (2, 3))]
+        self.assertEqual(self.arena.sizes, {1: sizes[0] + sizes[1],
+                                            2: sizes[2]})
+        self.assertEqual(self.arena.size, sum(sizes))
+        self.arena.trim(1, 1)
+        self.assertEqual(self.arena.sizes[1], sizes[1])
+        self.arena.drop(1, [2])
+        self.assertNotIn(1, self.arena)
+        self.arena.discard(2)
+        self.assertEqual(self.arena.size, 0)
+        self.assertEqual(self.arena.keys(), [])
+
+    def test_compaction_keeps_the_live_records(self):
+        rand = random.Random(22)
+        queues = {}
+        for seq in range(2000):
+            key = rand.randrange(10)
+            msg = ("x" * rand.randrange(100), seq)
+            self.add(key, seq, msg)
+            queues.setdefault(key, []).append((seq, msg))
+        for key in range(5):
+            upto = queues[key][len(queues[key]) // 2][0]
+            self.arena.trim(key, upto)
+            queues[key] = [entry for entry in queues[key] if entry[0] > upto]
+        dropped = [seq for seq, _ in queues[5][::2]]
+        self.arena.drop(5, dropped)
+        del queues[5][::2]
+        self.arena.discard(6)
+        del queues[6]
+        live, size = self.arena.size, len(self.arena.data)
+        # Less garbage than live records
+        with mock.patch.object(storage, "ARENA_MIN_GARBAGE", 1):
+            self.arena.maybe_compact()
+        self.assertEqual(len(self.arena.data), size)
+        self.arena.compact()
+        self.assertEqual(len(self.arena.data), live)
+        for key, entries in queues.items():
+            self.assertEqual(self.arena.entries(key), entries)
+
+    def test_compacts_once_most_of_it_is_garbage(self):
+        for seq in range(100):
+            self.add(1, seq, "x" * 100)
+        self.add(2, 100, "kept")
+        self.arena.trim(1, 98)
+        with mock.patch.object(storage, "ARENA_MIN_GARBAGE", 1):
+            self.arena.maybe_compact()
+        self.assertEqual(len(self.arena.data), self.arena.size)
+        self.assertEqual(self.arena.entries(1), [(99, "x" * 100)])
+        self.assertEqual(self.arena.entries(2), [(100, "kept")])
+
+    def test_empty_arena_frees_its_data(self):
+        self.add(1, 1, "msg")
+        self.arena.discard(1)
+        self.arena.maybe_compact()
+        self.assertEqual(len(self.arena.data), 0)
+
+
+class QuotaTest(object):
+    '''
+    Quotas of the queues, for every store.
+    '''
+    def test_queue_quota(self):
+        self.store.enqueue(1, (1, ("x" * 10, 0)), queue_quota=1000)
+        size = self.store.queue_size(1)
+        quota = 2 * size
+        self.store.enqueue(1, (2, ("x" * 10, 0)), queue_quota=quota)
+        with self.assertRaises(QuotaError):
+            self.store.enqueue(1, (3, ("x" * 10, 0)), queue_quota=quota)
+        self.assertEqual([seq for seq, _ in self.store.fetch(1, 0, 10)],
+                         [1, 2])
+        # Other queues have their own quota, and acks make room
+        self.store.enqueue(2, (3, ("x" * 10, 0)), queue_quota=quota)
+        self.store.ack(1, 1)
+        self.store.enqueue(1, (3, ("x" * 10, 0)), queue_quota=quota)
+        self.assertEqual(self.store.queue_size(1), quota)
+
+    def test_total_quota(self):
+        self.store.enqueue(1, (1, ("x" * 10, 0)))
+        quota = 2 * self.store.messages_size
+        self.store.enqueue(2, (2, ("x" * 10, 0)), total_quota=quota)
+        with self.assertRaises(QuotaError):
+            self.store.enqueue(3, (3, ("x" * 10, 0)), total_quota=quota)
+        self.assertEqual(self.store.range(0, 0), [1, 2])
+        self.store.dequeue(1)
+        self.store.enqueue(3, (3, ("x" * 10, 0)), total_quota=quota)
+        self.assertEqual(self.store.messages_size, quota)
+
+    def test_duplicates_take_no_room(self):
+        self.store.enqueue(1, (1, ("x" * 10, 0)))
+        size = self.store.queue_size(1)
+        self.store.enqueue(1, (1, ("x" * 10, 0)), queue_quota=size)
+        self.assertEqual(self.store.queue_size(1), size)
+
+
+class MemoryStoreQuotaTest(QuotaTest, unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore()
+
+
+class LogStoreQuotaTest(QuotaTest, unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = LogStore(os.path.join(self.dir.name, "node.log"))
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+
+class LogStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "node.log")
+        self.store = LogStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def reopen(self):
+        self.store.close()
+        self.store = LogStore(self.path)
+        return self.store
+
+    def contents(self, store):
+        return store.items(), store.queues(), store.range(0, 0),\
+            store.messages_size
+
+    def fill(self, store):
+        store.put(1, (1, "one", 0))
+        store.put(2, (2, "two", 0))
+        store.put(1, (3, "uno", 0))
+        store.remove(2)
+        store.put(3, (4, [3, "three"], 0))
+        store.discard_value(3)
+        for seq in (5, 7, 6, 8, 9):
+            store.enqueue(3, (seq, (f"msg {seq}", 0)))
+        store.enqueue(3, (6, ("again", 0)))
+        store.ack(3, 6)
+        store.discard_messages(3, [8])
+        store.enqueue(4, (10, ("gone", 0)))
+        store.dequeue(4)
+
+    def test_writes_are_read_back(self):
+        self.fill(self.store)
+        self.assertEqual(self.store.get(1), (3, "uno", 0))
+        self.assertIsNone(self.store.get(2))
+        self.assertIsNone(self.store.get(3))
+        self.assertEqual(self.store.queues(),
+                         [(3, [(7, ("msg 7", 0)), (9, ("msg 9", 0))])])
+        self.assertEqual(self.store.fetch(3, 7, 10), [(9, ("msg 9", 0))])
+        self.assertEqual(self.store.range(0, 0), [1, 3])
+
+    def test_replay(self):
+        self.fill(self.store)
+        before = self.contents(self.store)
+        self.assertEqual(self.contents(self.reopen()), before)
+        self.assertEqual(self.store.queue_size(3),
+                         self.store.messages_size)
+
+    def test_compaction_keeps_the_live_records(self):
+        self.fill(self.store)
+        before = self.contents(self.store)
+        size = os.path.getsize(self.path)
+        self.store.compact()
+        self.assertLess(os.path.getsize(self.path), size)
+        self.assertEqual(self.store.size, self.store.live)
+        self.assertEqual(self.contents(self.store), before)
+        # Writes after compacting go to the new log
+        self.store.put(5, (11, "five", 0))
+        self.assertEqual(self.reopen().get(5), (11, "five", 0))
+        self.assertEqual(self.contents(self.store)[:2],
+                         (before[0] + [(5, (11, "five", 0))], before[1]))
+
+    def test_compacts_once_most_of_the_log_is_garbage(self):
+        with mock.patch.object(storage, "COMPACTION_MIN_GARBAGE", 1000):
+            for i in range(100):
+                self.store.put(1, (i, "x" * 100, 0))
+        self.assertLess(os.path.getsize(self.path), 2 * 1000)
+        self.assertEqual(self.reopen().get(1), (99, "x" * 100, 0))
+
+    def test_torn_record_is_truncated(self):
+        self.fill(self.store)
+        before = self.contents(self.store)
+        size = os.path.getsize(self.path)
+        self.store.put(6, (12, "torn", 0))
+        self.store.close()
+        with open(self.path, 'r+b') as log:
+            log.truncate(os.path.getsize(self.path) - 3)
+        self.store = LogStore(self.path)
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(self.contents(self.store), before)
+        self.store.put(6, (13, "whole", 0))
+        self.assertEqual(self.reopen().get(6), (13, "whole", 0))
+
+    def test_corrupt_record_ends_the_replay(self):
+        self.store.put(1, (1, "one", 0))
+        size = os.path.getsize(self.path)
+        self.store.put(2, (2, "two", 0))
+        self.store.close()
+        with open(self.path, 'r+b') as log:
+            log.seek(-1, os.SEEK_END)
+            last = log.read(1)
+            log.seek(-1, os.SEEK_END)
+            log.write(bytes([last[0] ^ 0xff]))
+        self.store = LogStore(self.path)
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(self.store.items(), [(1, (1, "one", 0))])
+
+    def test_meta_survives_a_restart(self):
+        self.assertIsNone(self.store.load_meta())
+        self.store.save_meta([["127.0.0.1", 1], ["127.0.0.1", 2]])
+        self.store.save_meta([["127.0.0.1", 3]])
+        self.assertEqual(self.reopen().load_meta(), [["127.0.0.1", 3]])
+        self.assertEqual(sorted(os.listdir(self.dir.name)),
+                         ["node.log", "node.log.meta"])
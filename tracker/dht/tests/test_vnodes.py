@@ -0,0 +1,38 @@
+import random
+import tempfile
+import unittest
+
+from tracker.dht import chord
+from tracker.dht.tests.cluster import Cluster
+
+VIRTUAL_NODES = 3
+KEYS = 300
+
+
+class VirtualNodesTest(unittest.TestCase):
+    def test_replicas_are_in_other_processes(self):
+        with tempfile.TemporaryDirectory() as log_dir, \
+                Cluster(log_dir) as cluster:
+            first = cluster.start_virtual(VIRTUAL_NODES, "-n", "1")
+            second = cluster.start_virtual(VIRTUAL_NODES, "-n", "1",
+                                           join=first[0])
+            nodes = first + second
+            cluster.wait_stable(nodes)
+
+            process = {node.port: i for i, group in enumerate((first, second))
+                       for node in group}
+            for node in nodes:
+                replicas = node.get_replicas()
+                self.assertEqual(len(replicas), 1)
+                self.assertNotEqual(process[replicas[0].port],
+                                    process[node.port])
+
+            rand = random.Random(20)
+            keys = [rand.getrandbits(chord.KEY_SIZE) for _ in range(KEYS)]
+            first[0].multi_put([(key, key) for key in keys])
+            for key in keys:
+                holders = {
+                    process[node.port] for node in nodes
+                    if node.simple_get(key) is not None
+                }
+                self.assertEqual(holders, {0, 1})
@@ -8,6 +8,7 @@ from threading import Thread
 from cloudpickle import dumps, loads
 import zmq
 from dht.chord import request, NoResponseException, RemoteNodeReference
+from dht.rpc import RemoteError
 
 
 logging.basicConfig(
@@ -15,6 +16,9 @@ logging.basicConfig(
     level=logging.DEBUG
     )
 
+# Queued messages read from the DHT per request
+MESSAGES_PAGE = 100
+
 
 def request_tracker_action(tracker_ip, tracker_port, action, **kwargs):
     '''
@@ -147,12 +151,31 @@ class ClientInformationTracker:
                 (client_ip, client_port,)
             )
 
-        # Return, if any, all queued messages for this client
-            response = request(
-                "chord://%s:%d" % chord_peer,
-                "dequeue_messages",
-                client_key
-            )
+        # Return, if any, all queued messages for this client. They are
+        # read a page at a time and only acknowledged, so removed from the
+        # DHT, once all of them were read: a failure midway loses nothing.
+            response = []
+            last_seq = -1
+            while True:
+                page = request(
+                    "chord://%s:%d" % chord_peer,
+                    "fetch",
+                    client_key,
+                    last_seq,
+                    MESSAGES_PAGE
+                )
+                response += [message for _, message in page]
+                if page:
+                    last_seq = page[-1][0]
+                if len(page) < MESSAGES_PAGE:
+                    break
+            if response:
+                request(
+                    "chord://%s:%d" % chord_peer,
+                    "ack",
+                    client_key,
+                    last_seq
+                )
             return response
 
     def register_client(self, client_id, client_ip, client_port):
@@ -226,12 +249,17 @@ class ClientInformationTracker:
         user_id = int(sha1(bytes("%s" % client_id, 'ascii')).hexdigest(), 16)
 
         chord_peer = self.__find_alive_chord()
-        request(
-            "chord://%s:%d" % chord_peer,
-            'enqueue_message',
-            user_id,
-            message
-        )
+        try:
+            request(
+                "chord://%s:%d" % chord_peer,
+                'enqueue_message',
+                user_id,
+                message
+            )
+        except RemoteError as e:
+            # The inbox of the user, or the node holding it, is full
+            logging.info("Message for %s rejected: %s", client_id, e)
+            return False
         return True
 
     def __dispatch_object_method(self, method, *args):